@@ -17,11 +17,12 @@ from channels.auth import AuthMiddlewareStack
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'a_core.settings')
 
 django_asgi_app = get_asgi_application()
-from a_rtchat import routing
+from a_rtchat import routing, workers
+from a_rtchat.uploads import UploadSizeLimitMiddleware
 
-application = ProtocolTypeRouter({
-    'http': django_asgi_app,
+application = workers.track_loop(ProtocolTypeRouter({
+    'http': UploadSizeLimitMiddleware(django_asgi_app),
     'websocket': AllowedHostsOriginValidator(
         AuthMiddlewareStack((URLRouter(routing.websocket_urlpatterns)))
     )
-})
+}))
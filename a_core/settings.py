@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/5.0/ref/settings/
 """
 
 from pathlib import Path
+import tempfile
 from environ import Env
 
 env = Env()
@@ -102,6 +103,7 @@ TEMPLATES = [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
+                'a_rtchat.context_processors.socket_protocol',
             ],
         },
     },
@@ -118,15 +120,67 @@ if ENVIRONMENT=='development':
         }
     }
 else:
+    # rooms are spread over every Redis listed here (a_rtchat/layers.py), CHAT_CHANNEL_LAYER
+    # is 'core' (queued per socket) or 'pubsub' (one publish per group_send)
+    CHANNEL_REDIS_URLS = env.list('CHANNEL_REDIS_URLS', default=[env('REDIS_URL')])
+    CHAT_CHANNEL_LAYER = env('CHAT_CHANNEL_LAYER', default='core')
     CHANNEL_LAYERS = {
         "default": {
-            "BACKEND": "channels_redis.core.RedisChannelLayer",
+            "BACKEND": {
+                'core': 'a_rtchat.layers.ShardedRedisChannelLayer',
+                'pubsub': 'a_rtchat.layers.ShardedRedisPubSubChannelLayer',
+            }[CHAT_CHANNEL_LAYER],
             "CONFIG": {
-                "hosts":[(env('REDIS_URL'))],
+                "hosts": CHANNEL_REDIS_URLS,
             },
         },
     }
 
+# shared between workers in production, access checks are cached here (a_rtchat/access.py)
+if ENVIRONMENT=='development':
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django_redis.cache.RedisCache',
+            'LOCATION': env('REDIS_URL'),
+        }
+    }
+
+# who is online in which chat room (a_rtchat/presence.py)
+if ENVIRONMENT=='development':
+    CHAT_PRESENCE = {
+        'BACKEND': 'a_rtchat.presence.MemoryPresence',
+        'CONFIG': {
+            'ttl': 60,
+        },
+    }
+else:
+    CHAT_PRESENCE = {
+        'BACKEND': 'a_rtchat.presence.RedisPresence',
+        'CONFIG': {
+            'url': env('REDIS_URL'),
+            'ttl': 60,
+        },
+    }
+
+# token buckets for chat message rate limits (a_rtchat/ratelimit.py)
+if ENVIRONMENT=='development':
+    CHAT_RATE_LIMITER = {
+        'BACKEND': 'a_rtchat.ratelimit.MemoryRateLimiter',
+    }
+else:
+    CHAT_RATE_LIMITER = {
+        'BACKEND': 'a_rtchat.ratelimit.RedisRateLimiter',
+        'CONFIG': {
+            'url': env('REDIS_URL'),
+        },
+    }
+
 # Database
 # https://docs.djangoproject.com/en/5.0/ref/settings/#databases
 
@@ -226,3 +280,61 @@ ACCOUNT_EMAIL_SUBJECT_PREFIX = ''
 
 ACCOUNT_LOGIN_METHODS = {'email', 'username'}
 ACCOUNT_EMAIL_REQUIRED = True
+
+# Real-time chat tuning
+
+# notification triggers for the same user within this many seconds are coalesced into one
+CHAT_NOTIFICATION_WINDOW = env.float('CHAT_NOTIFICATION_WINDOW', default=0.5)
+
+# presence changes in a chat room within this many seconds go out as one online count update
+CHAT_PRESENCE_BROADCAST_WINDOW = env.float('CHAT_PRESENCE_BROADCAST_WINDOW', default=0.25)
+
+# number of messages rendered with the chat page, and per older page loaded on scroll
+CHAT_HISTORY_FIRST_PAGE = env.int('CHAT_HISTORY_FIRST_PAGE', default=50)
+CHAT_HISTORY_PAGE_SIZE = env.int('CHAT_HISTORY_PAGE_SIZE', default=50)
+
+# messages per page of search results
+CHAT_SEARCH_PAGE_SIZE = env.int('CHAT_SEARCH_PAGE_SIZE', default=20)
+
+# threads for background jobs like building image variants, eager runs them inline (tests)
+CHAT_WORKERS = env.int('CHAT_WORKERS', default=4)
+CHAT_WORKERS_EAGER = env.bool('CHAT_WORKERS_EAGER', default=False)
+
+# chat file uploads, larger or other files are turned away while the upload is read
+CHAT_UPLOAD_MAX_SIZE = env.int('CHAT_UPLOAD_MAX_SIZE', default=10 * 1024 * 1024)
+CHAT_UPLOAD_ALLOWED_TYPES = env.list('CHAT_UPLOAD_ALLOWED_TYPES', default=[
+    'image/*', 'video/*', 'audio/*', 'text/plain', 'application/pdf', 'application/zip',
+])
+# accepted uploads wait here until a worker has written them to storage
+CHAT_UPLOAD_SPOOL_DIR = env('CHAT_UPLOAD_SPOOL_DIR', default=str(Path(tempfile.gettempdir()) / 'chat-uploads'))
+
+# chat message rate limits as (messages per second, burst) per connection, user and room
+CHAT_RATE_LIMITS = {
+    'connection': (env.float('CHAT_RATE_LIMIT_CONNECTION', default=2), env.int('CHAT_RATE_BURST_CONNECTION', default=10)),
+    'user': (env.float('CHAT_RATE_LIMIT_USER', default=3), env.int('CHAT_RATE_BURST_USER', default=15)),
+    'room': (env.float('CHAT_RATE_LIMIT_ROOM', default=50), env.int('CHAT_RATE_BURST_ROOM', default=200)),
+}
+
+# write-behind mode: socket messages are broadcast first and saved in batches
+# every CHAT_WRITE_BEHIND_INTERVAL seconds or CHAT_WRITE_BEHIND_BATCH messages
+CHAT_WRITE_BEHIND = env.bool('CHAT_WRITE_BEHIND', default=False)
+CHAT_WRITE_BEHIND_INTERVAL = env.float('CHAT_WRITE_BEHIND_INTERVAL', default=0.05)
+CHAT_WRITE_BEHIND_BATCH = env.int('CHAT_WRITE_BEHIND_BATCH', default=100)
+
+# seconds a room membership / ban lookup is cached, changes invalidate it right away
+CHAT_ACCESS_CACHE_TIMEOUT = env.int('CHAT_ACCESS_CACHE_TIMEOUT', default=300)
+
+# seconds a rendered chat message stays cached, profile changes make new entries
+CHAT_FRAGMENT_CACHE_TIMEOUT = env.int('CHAT_FRAGMENT_CACHE_TIMEOUT', default=24 * 60 * 60)
+
+# what the pages ask the chat sockets for: 'html' partials or 'json' frames rendered
+# by static/js/chat_protocol.js (see a_rtchat/protocol.py)
+CHAT_SOCKET_PROTOCOL = env('CHAT_SOCKET_PROTOCOL', default='html')
+
+# seconds the chat sockets hold events to send them as one frame, 0 sends each
+# event right away. Consumers can set their own `batch_window`.
+CHAT_SOCKET_BATCH_WINDOW = env.float('CHAT_SOCKET_BATCH_WINDOW', default=0.005)
+
+# messages a reconnecting chat socket is sent that it missed, with more
+# missing the page is reloaded instead
+CHAT_REPLAY_LIMIT = env.int('CHAT_REPLAY_LIMIT', default=100)
@@ -0,0 +1,58 @@
+"""
+Who may open a chat room.
+
+Membership and bans are looked up together in one indexed query and the
+answer is cached per (room, user). Every change to the members or banned
+users of a room drops the entries of the users involved (see signals.py),
+so the timeout only bounds how long unused entries stay around.
+"""
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Exists, OuterRef
+
+from .models import ChatGroup
+
+
+def cache_key(group_id, user_id):
+    return f'chat-access:{group_id}:{user_id}'
+
+
+# (is member, is banned) of the user in the group
+def state(group, user_id):
+    key = cache_key(group.id, user_id)
+    cached = cache.get(key)
+    if cached is not None:
+        return cached
+
+    members = ChatGroup.members.through.objects.filter(chatgroup_id=OuterRef('pk'), user_id=user_id)
+    banned = ChatGroup.banned_users.through.objects.filter(chatgroup_id=OuterRef('pk'), user_id=user_id)
+    member, banned = ChatGroup.objects.filter(id=group.id).values_list(
+        Exists(members), Exists(banned)
+    ).get()
+
+    cache.set(key, (member, banned), settings.CHAT_ACCESS_CACHE_TIMEOUT)
+    return member, banned
+
+
+def is_member(group, user):
+    return user.is_authenticated and state(group, user.id)[0]
+
+
+def is_banned(group, user):
+    return user.is_authenticated and state(group, user.id)[1]
+
+
+# Private chats and group chats are open to their members that are not
+# banned, the public chat to every user that is logged in
+def can_join(group, user):
+    if not user.is_authenticated:
+        return False
+    if not group.is_private and not group.groupchat_name:
+        return True
+    member, banned = state(group, user.id)
+    return member and not banned
+
+
+def invalidate(group_ids, user_ids):
+    cache.delete_many([cache_key(group_id, user_id) for group_id in group_ids for user_id in user_ids])
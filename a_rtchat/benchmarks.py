@@ -0,0 +1,284 @@
+"""
+Scenarios of the chat_benchmark command, and the fixtures the benchmark
+commands (chat_benchmark, chat_loadtest, chat_write_benchmark) share.
+
+Each scenario drives the real consumers through Channels' WebsocketCommunicator
+(see loadtest.py) or the views through the test client, on whatever channel
+layer is configured, and returns a flat dict of numbers: throughput,
+p50/p99 latency in ms, database queries per event and, for the connect storm,
+memory per socket.
+"""
+
+import asyncio
+import contextlib
+import json
+import time
+import tracemalloc
+import uuid
+
+from channels.db import database_sync_to_async
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import DEFAULT_DB_ALIAS, connection, connections
+from django.test import Client
+from django.test.utils import (
+    CaptureQueriesContext, setup_databases, setup_test_environment, teardown_databases, teardown_test_environment,
+)
+from django.urls import reverse
+
+from . import loadtest, ratelimit
+from .models import ChatGroup, GroupMessage
+from .routing import websocket_urlpatterns
+from a_users.models import Profile
+
+
+class count_queries:
+    """
+    CaptureQueriesContext for async code. database_sync_to_async runs in the
+    thread that called async_to_sync, so that is where the queries are counted.
+    """
+
+    async def __aenter__(self):
+        return await database_sync_to_async(self.enter)()
+
+    # the connection of that thread itself, `connection` would be looked up again
+    # in the thread that reads the queries
+    def enter(self):
+        self.context = CaptureQueriesContext(connections[DEFAULT_DB_ALIAS])
+        return self.context.__enter__()
+
+    async def __aexit__(self, *exc_info):
+        await database_sync_to_async(self.context.__exit__)(*exc_info)
+
+
+def latency_summary(latencies):
+    return {
+        'p50_ms': round(loadtest.percentile(latencies, 50), 2) if latencies else None,
+        'p99_ms': round(loadtest.percentile(latencies, 99), 2) if latencies else None,
+    }
+
+
+def per_second(count, seconds):
+    return round(count / seconds, 1) if seconds else None
+
+
+def per_event(queries, events):
+    return round(len(queries) / events, 2) if events else None
+
+
+# A test database for the length of the block, with the test client's host
+# and the locmem outbox like the test runner sets them up
+@contextlib.contextmanager
+def throwaway_database():
+    setup_test_environment()
+    old_config = setup_databases(verbosity=0, interactive=False)
+    try:
+        yield
+    finally:
+        teardown_databases(old_config, verbosity=0)
+        teardown_test_environment()
+
+
+# CHAT_RATE_LIMITS that one sender never reaches, the benchmarks measure broadcasting
+def no_rate_limits():
+    return {scope: (10 ** 9, 10 ** 9) for scope in ratelimit.SCOPES}
+
+
+def create_users(count, prefix='bench'):
+    users = User.objects.bulk_create([User(username=f'{prefix}{i}') for i in range(count)])
+    Profile.objects.bulk_create([Profile(user=user) for user in users])
+    return users
+
+
+def create_room(users, messages=0, name='Benchmark'):
+    room = ChatGroup.objects.create(groupchat_name=name, admin=users[0])
+    room.members.add(*users)
+    for index in range(messages):
+        GroupMessage.objects.create(body=f'message {index}', author=users[index % len(users)], group=room)
+    return room
+
+
+async def open_room(users, path):
+    sockets = await loadtest.open_sockets(websocket_urlpatterns, path, users)
+    # throw away the presence updates of the connects
+    for communicator in sockets:
+        await loadtest.drain(communicator)
+    return sockets
+
+
+# Every user opens a chat socket at once, then they all leave at once
+async def connect_storm(users):
+    room = await database_sync_to_async(create_room)(users)
+    path = f'/ws/chatroom/{room.group_name}'
+
+    async def connect(user):
+        started = time.perf_counter()
+        sockets = await loadtest.open_sockets(websocket_urlpatterns, path, [user])
+        return sockets, (time.perf_counter() - started) * 1000
+
+    tracemalloc.start()
+    try:
+        memory_before = tracemalloc.get_traced_memory()[0]
+        async with count_queries() as queries:
+            started = time.perf_counter()
+            connected = await asyncio.gather(*[connect(user) for user in users])
+            connect_seconds = time.perf_counter() - started
+        memory = tracemalloc.get_traced_memory()[0] - memory_before
+    finally:
+        tracemalloc.stop()
+
+    sockets = [communicator for result, latency in connected for communicator in result]
+    for communicator in sockets:
+        await loadtest.drain(communicator)
+
+    started = time.perf_counter()
+    await loadtest.close_sockets(sockets)
+    disconnect_seconds = time.perf_counter() - started
+
+    return dict(
+        latency_summary([latency for result, latency in connected if result]),
+        sockets=len(users),
+        connected=len(sockets),
+        connects_per_second=per_second(len(sockets), connect_seconds),
+        disconnects_per_second=per_second(len(sockets), disconnect_seconds),
+        queries_per_connect=per_event(queries, len(sockets)),
+        memory_per_socket_kb=round(memory / len(sockets) / 1024, 1) if sockets else None,
+    )
+
+
+# One member sends `messages` messages, every socket in the room receives them
+async def message_fanout(users, messages):
+    room = await database_sync_to_async(create_room)(users)
+    sockets = await open_room(users, f'/ws/chatroom/{room.group_name}')
+
+    async with count_queries() as queries:
+        started = time.perf_counter()
+        latencies, lost = await loadtest.measure_broadcast(sockets, messages)
+        seconds = time.perf_counter() - started
+    await loadtest.close_sockets(sockets)
+
+    return dict(
+        latency_summary(latencies),
+        sockets=len(sockets),
+        messages=messages,
+        deliveries_per_second=per_second(len(latencies), seconds),
+        deliveries_lost=lost,
+        queries_per_message=per_event(queries, messages),
+    )
+
+
+# Every member but the sender has a notification socket, each message
+# updates all of them
+async def notification_fanout(users, messages):
+    room = await database_sync_to_async(create_room)(users)
+    [sender] = await open_room(users[:1], f'/ws/chatroom/{room.group_name}')
+    sockets = []
+    for user in users[1:]:
+        sockets += await loadtest.open_sockets(websocket_urlpatterns, '/ws/notifications/', [user])
+    for communicator in sockets:
+        await loadtest.drain(communicator)
+
+    async def arrival(communicator):
+        try:
+            await loadtest.next_frame(communicator, 10)
+        except asyncio.TimeoutError:
+            return None
+        return time.perf_counter()
+
+    latencies, lost = [], 0
+    async with count_queries() as queries:
+        started = time.perf_counter()
+        for index in range(messages):
+            sent = time.perf_counter()
+            await sender.send_to(text_data=json.dumps({'body': f'notify {index}'}))
+            for arrived in await asyncio.gather(*[arrival(communicator) for communicator in sockets]):
+                if arrived is None:
+                    lost += 1
+                else:
+                    latencies.append((arrived - sent) * 1000)
+        seconds = time.perf_counter() - started
+    await loadtest.drain(sender)
+    await loadtest.close_sockets(sockets + [sender])
+
+    return dict(
+        latency_summary(latencies),
+        sockets=len(sockets),
+        messages=messages,
+        notifications_per_second=per_second(len(latencies), seconds),
+        notifications_lost=lost,
+        queries_per_message=per_event(queries, messages),
+    )
+
+
+# A member uploads files, every socket in the room gets the message once the
+# file is stored. Needs CHAT_WORKERS_EAGER so the upload is stored inline.
+async def upload_fanout(users, uploads):
+    room = await database_sync_to_async(create_room)(users)
+    sockets = await open_room(users, f'/ws/chatroom/{room.group_name}')
+
+    client = Client()
+    await database_sync_to_async(client.force_login)(users[0])
+    url = reverse('chat-file-upload', args=[room.group_name])
+
+    @database_sync_to_async
+    def upload(name):
+        return client.post(url, {'file': SimpleUploadedFile(name, b'benchmark')}, HTTP_HX_REQUEST='true')
+
+    latencies, lost = [], 0
+    async with count_queries() as queries:
+        started = time.perf_counter()
+        for _ in range(uploads):
+            name = f'bench-{uuid.uuid4().hex}.txt'
+            sent = time.perf_counter()
+            await upload(name)
+            for arrived in await asyncio.gather(*[loadtest.wait_for(communicator, name) for communicator in sockets]):
+                if arrived is None:
+                    lost += 1
+                else:
+                    latencies.append((arrived - sent) * 1000)
+        seconds = time.perf_counter() - started
+    await loadtest.close_sockets(sockets)
+
+    return dict(
+        latency_summary(latencies),
+        sockets=len(sockets),
+        uploads=uploads,
+        deliveries_per_second=per_second(len(latencies), seconds),
+        deliveries_lost=lost,
+        queries_per_upload=per_event(queries, uploads),
+    )
+
+
+# Renders the chat page of a room with `messages` messages, the first time
+# with nothing cached and then `requests` more times
+def chat_view_render(users, messages, requests):
+    room = create_room(users, messages)
+    client = Client()
+    client.force_login(users[0])
+    url = reverse('chatroom', args=[room.group_name])
+
+    cache.clear()
+    started = time.perf_counter()
+    with CaptureQueriesContext(connection) as cold_queries:
+        client.get(url)
+    cold_ms = (time.perf_counter() - started) * 1000
+
+    latencies = []
+    with CaptureQueriesContext(connection) as queries:
+        started = time.perf_counter()
+        for _ in range(requests):
+            sent = time.perf_counter()
+            client.get(url)
+            latencies.append((time.perf_counter() - sent) * 1000)
+        seconds = time.perf_counter() - started
+
+    return dict(
+        latency_summary(latencies),
+        messages=messages,
+        requests=requests,
+        requests_per_second=per_second(requests, seconds),
+        cold_ms=round(cold_ms, 2),
+        cold_queries=len(cold_queries),
+        queries_per_request=per_event(queries, requests),
+    )
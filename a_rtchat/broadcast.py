@@ -0,0 +1,204 @@
+import asyncio
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.template.loader import render_to_string
+from .models import ChatGroup, GroupMessage, members_with_profiles
+from .presence import get_presence
+from . import fragments, inbox, metrics, protocol
+
+
+# Sockets that want html partials are also registered in this presence room,
+# events only carry rendered html while it has anyone in it (see protocol.py)
+def html_room(chatroom_name):
+    return f'{chatroom_name}:html'
+
+
+# Builds the channel layer event for a new message.
+# The message is loaded and rendered once on the sending side, every
+# socket in the room then only picks the variant that matches its user.
+def message_event(message_id, author_online=False, html=True):
+    message = GroupMessage.objects.select_related(
+        'author__profile', 'group'
+    ).get(id=message_id)
+    return render_message_event(message, message.id, author_online, html)
+
+
+# Builds the event from a message object, which may not be saved yet (see writebehind.py)
+def render_message_event(message, message_id, author_online=False, html=True):
+    event = {
+        'type': 'message_handler',
+        'message_id': message_id,
+        'author_id': message.author_id,
+        'data': protocol.message_data(message, message_id),
+    }
+    if not html:
+        return event
+
+    # "mine" is rendered for the author, "theirs" for everyone else
+    context = {'message': message, 'chat_group': message.group, 'author_online': author_online}
+    event['html_mine'] = render_to_string('a_rtchat/partials/chat_message_p.html', dict(context, user=message.author))
+    event['html_theirs'] = render_to_string('a_rtchat/partials/chat_message_p.html', dict(context, user=None))
+    return event
+
+
+# Renders messages a reconnected socket missed, appended like new ones
+def replay_html(messages, user):
+    context = {'message_html': fragments.render_messages(messages, user)}
+    return render_to_string('a_rtchat/partials/chat_replay.html', context)
+
+
+# Builds the online count event of a room, rendered once for every socket.
+# Data sockets only need the ids, without html sockets nothing is queried.
+def online_count_event(chatroom_name, online_ids, html=True):
+    event = {
+        'type': 'online_count_handler',
+        'online_ids': sorted(online_ids),
+    }
+    if not html:
+        return event
+
+    chat_group = ChatGroup.objects.prefetch_related(members_with_profiles()).filter(group_name=chatroom_name).first()
+    if chat_group is None:
+        return None
+
+    # authors of the latest messages, to update the dots next to them
+    author_ids = set(chat_group.chat_messages.values_list('author_id', flat=True)[:50])
+
+    context = {
+        'online_count': max(len(online_ids) - 1, 0), # everyone but the viewer
+        'online_ids': online_ids,
+        'chat_group': chat_group,
+        'users': User.objects.filter(id__in=author_ids),
+    }
+    event['html'] = render_to_string('a_rtchat/partials/online_count.html', context)
+    return event
+
+
+def presence_group(user_id):
+    return f'presence_{user_id}'
+
+
+# Renders the header online status and chat list of a user from their inbox rows.
+# `online_count` is the number of the user's contacts that are online.
+def online_status_html(user, chats, online_count, public_chat_online):
+    context = {
+        'online_count': online_count,
+        'online_in_chats': public_chat_online or any(chat.online for chat in chats),
+        'public_chat_online': public_chat_online,
+        'chats': chats,
+        'user': user,
+    }
+    return render_to_string('a_rtchat/partials/online_status.html', context)
+
+
+# Renders only the parts of the online status that changed, every element
+# replaces the one with the same id. `dots` is a list of (group_name, online).
+def online_status_delta_html(online_count=None, online_in_chats=None, dots=()):
+    context = {
+        'online_count': online_count,
+        'online_in_chats': online_in_chats,
+        'dots': dots,
+    }
+    return render_to_string('a_rtchat/partials/online_status_delta.html', context)
+
+
+# Sends an event to the online status sockets of each user
+async def send_to_users(user_ids, event):
+    channel_layer = get_channel_layer()
+    await asyncio.gather(*[
+        channel_layer.group_send(presence_group(user_id), event)
+        for user_id in user_ids
+    ])
+    metrics.incr('presence.deltas_sent', len(user_ids))
+
+
+# A user came online or went offline, only their contacts that are online are told
+async def contact_presence_changed(user_id, online):
+    contact_ids = await database_sync_to_async(inbox.contact_ids)(user_id)
+    contact_ids = await get_presence().online_among('online-status', contact_ids)
+    await send_to_users(contact_ids, {
+        'type': 'contact_presence',
+        'user_id': user_id,
+        'online': online,
+    })
+
+
+# The event that sets the dot of a room in the chat lists. With two or more
+# users in the room everyone sees someone else, so the ids are left out.
+def room_presence_event(chatroom_name, online_ids):
+    return {
+        'type': 'room_presence',
+        'group_name': chatroom_name,
+        'online_ids': sorted(online_ids) if len(online_ids) < 2 else None,
+    }
+
+
+class OnlineCountBroadcaster:
+    """
+    Coalesces presence changes per room.
+
+    The first change in a room opens a window of `window` seconds, changes
+    that arrive while it is open are folded into it. When it closes the
+    online count payload is computed once and sent to the whole room.
+    """
+
+    def __init__(self, window=None):
+        self._window = window
+        self.loop = None
+        self.pending = set()
+
+    @property
+    def window(self):
+        if self._window is None:
+            return settings.CHAT_PRESENCE_BROADCAST_WINDOW
+        return self._window
+
+    async def changed(self, chatroom_name):
+        loop = asyncio.get_running_loop()
+
+        # timers from another (closed) event loop never fire, start over
+        if self.loop is not loop:
+            self.loop = loop
+            self.pending = set()
+
+        if chatroom_name in self.pending:
+            metrics.incr('presence.updates_suppressed')
+            return
+
+        if not self.window:
+            await self.flush(chatroom_name)
+            return
+
+        self.pending.add(chatroom_name)
+        loop.call_later(self.window, lambda: asyncio.ensure_future(self.flush(chatroom_name)))
+
+    async def flush(self, chatroom_name):
+        self.pending.discard(chatroom_name)
+
+        presence = get_presence()
+        online_ids = await presence.online_ids(chatroom_name)
+        html = await presence.count(html_room(chatroom_name)) > 0
+        event = await database_sync_to_async(online_count_event)(chatroom_name, online_ids, html)
+        if event is not None:
+            await get_channel_layer().group_send(chatroom_name, event)
+            metrics.incr('presence.updates_sent')
+        await self.send_room_presence(chatroom_name, online_ids)
+
+    # Updates the dot of the room in the chat list of its members
+    async def send_room_presence(self, chatroom_name, online_ids):
+        event = room_presence_event(chatroom_name, online_ids)
+
+        # everyone has the public chat in their list, but from a third user
+        # on nobody's dot changes any more
+        if chatroom_name == 'public-chat':
+            if len(online_ids) <= 2:
+                await get_channel_layer().group_send('online-status', event)
+            return
+
+        member_ids = await database_sync_to_async(inbox.member_ids)(chatroom_name)
+        await send_to_users(member_ids, event)
+
+
+online_counts = OnlineCountBroadcaster()
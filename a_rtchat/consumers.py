@@ -1,255 +1,532 @@
-from channels.generic.websocket import WebsocketConsumer, AsyncWebsocketConsumer
-from .models import ChatGroup, GroupMessage, User
-from django.shortcuts import get_object_or_404
-from django.template.loader import render_to_string
-from asgiref.sync import async_to_sync
+from channels.generic.websocket import AsyncWebsocketConsumer
+from channels.db import database_sync_to_async
+from django.conf import settings
+from .models import ChatGroup, GroupMessage
+from . import access, broadcast, history, inbox, metrics, notifications, protocol, ratelimit, unread, writebehind
+from .presence import get_presence
+import asyncio
 import json
 
-class ChatRoomConsumer(WebsocketConsumer):
+
+class ProtocolMixin:
+    """
+    html partials by default, data frames if the socket asked for them (see protocol.py).
+
+    Partials and frames are held for `batch_window` seconds and go out as
+    one WebSocket frame: partials are concatenated (htmx swaps each of them),
+    several data frames become one 'batch' frame.
+    """
+
+    # seconds events are held, None for CHAT_SOCKET_BATCH_WINDOW, 0 sends right away
+    batch_window = None
+    # accept permessage-deflate on this socket when served by a_rtchat.server
+    compression = True
+
+    outbox = ()
+    flush_handle = None
+
+    @property
+    def wants_html(self):
+        return self.format == 'html'
+
+    def window(self):
+        if self.batch_window is None:
+            return settings.CHAT_SOCKET_BATCH_WINDOW
+        return self.batch_window
+
+    async def send_frame(self, type, **fields):
+        await self.queue(dict(fields, type=type))
+
+    async def send_html(self, html):
+        await self.queue(html)
+
+    # Control messages of html sockets are read by the page's own script,
+    # they go out on their own after whatever is queued
+    async def send_action(self, action, **fields):
+        await self.flush()
+        await self.send(text_data=json.dumps(dict(action=action, **fields)))
+
+    async def queue(self, event):
+        window = self.window()
+        if not window:
+            await self.send_events([event])
+            return
+
+        if not self.outbox:
+            self.outbox = []
+            loop = asyncio.get_running_loop()
+            self.flush_handle = loop.call_later(window, lambda: asyncio.ensure_future(self.flush()))
+        self.outbox.append(event)
+
+    async def flush(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        events, self.outbox = self.outbox, ()
+        if events:
+            await self.send_events(events)
+
+    async def send_events(self, events):
+        if self.wants_html:
+            frame = {'text_data': ''.join(events)}
+        elif len(events) == 1:
+            frame = protocol.encode(self.format, **events[0])
+        else:
+            frame = protocol.encode(self.format, 'batch', frames=events)
+        await self.send(**frame)
+
+        metrics.incr('socket.frames')
+        metrics.incr('socket.events', len(events))
+        metrics.incr('socket.bytes', len(frame.get('text_data') or frame.get('bytes_data')))
+
+    async def close(self, code=None, reason=None):
+        await self.flush()
+        await super().close(code, reason)
+
+    # whatever is still queued has nowhere to go
+    async def websocket_disconnect(self, message):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        self.outbox = ()
+        await super().websocket_disconnect(message)
+
+
+class ChatRoomConsumer(ProtocolMixin, AsyncWebsocketConsumer):
 
     # Connect to WebSocket
-    def connect(self):
+    async def connect(self):
         self.user = self.scope['user']
         self.chatroom_name = self.scope['url_route']['kwargs']['chatroom_name']
-        self.chatroom = get_object_or_404(ChatGroup, group_name=self.chatroom_name)
-
-        # Implementing the channel layer communication system and making it asynchronous
-        async_to_sync(self.channel_layer.group_add)(
+        self.chatroom = await self.get_chatroom()
+        self.presence = get_presence()
+        self.format = protocol.socket_format(self.scope)
+        self.last_message_id = 0
+        self.online_ids = set()
+        # sequence numbers sent before the client asked for a replay (None once it
+        # did, or when it never does), and the newest replayed
+        self.live_seqs = set()
+        self.replayed_seq = 0
+
+        # unknown chatroom or no access to it, refuse the socket before joining the group
+        if self.chatroom is None:
+            await self.close()
+            return
+
+        # Implementing the channel layer communication system
+        await self.channel_layer.group_add(
             self.chatroom_name, self.channel_name
         )
 
-        # To add and update online users
-        if self.user not in self.chatroom.user_online.all():
-            self.chatroom.user_online.add(self.user)
-            self.update_online_count()
+        await self.accept()
+
+        # html sockets are counted on their own, rooms without any skip rendering
+        if self.wants_html:
+            await self.presence.join(broadcast.html_room(self.chatroom_name), self.user.id, self.channel_name)
+            self.html_heartbeat = self.presence.keep_alive(broadcast.html_room(self.chatroom_name), self.user.id, self.channel_name)
 
-        self.accept()
+        # To add and update online users
+        if await self.presence.join(self.chatroom_name, self.user.id, self.channel_name):
+            await self.update_online_count()
+        self.heartbeat = self.presence.keep_alive(self.chatroom_name, self.user.id, self.channel_name)
 
     # Disconnect from WebSocket (to remove channel from chat room)
-    def disconnect(self, close_code):
-        async_to_sync(self.channel_layer.group_discard)(
+    async def disconnect(self, close_code):
+        if getattr(self, 'chatroom', None) is None:
+            return
+
+        await self.channel_layer.group_discard(
             self.chatroom_name, self.channel_name
         )
 
+        if self.wants_html:
+            self.html_heartbeat.cancel()
+            await self.presence.leave(broadcast.html_room(self.chatroom_name), self.user.id, self.channel_name)
+
         # remove and update online users
-        if self.user in self.chatroom.user_online.all():
-            self.chatroom.user_online.remove(self.user)
-            self.update_online_count()
+        self.heartbeat.cancel()
+        if await self.presence.leave(self.chatroom_name, self.user.id, self.channel_name):
+            await self.update_online_count()
+
+        # everything delivered to this socket has been read
+        if self.last_message_id:
+            await database_sync_to_async(unread.mark_read_up_to)(
+                self.user, self.chatroom.id, self.last_message_id
+            )
 
     # Recieve message from WebSocket
-    def receive(self,text_data):
-        text_data_json = json.loads(text_data)
+    async def receive(self, text_data=None, bytes_data=None):
+        text_data_json = protocol.decode(text_data, bytes_data)
+
+        # a client that reconnected sends the newest sequence number it has
+        since = text_data_json.get('since')
+        if isinstance(since, int):
+            await self.replay(since)
+            return
+
         body = text_data_json.get('body','').strip()  # Trim whitespace
 
         # Prevent sending empty messages
         if not body:
-            return  
-        
-        # Create message object and attach author and chatroom
-        message = GroupMessage.objects.create(
-            body=body,
-            author=self.user,
-            group=self.chatroom
-        )
+            return
+
+        # over the limit of this connection, user or room, tell the client and drop it
+        limited = await ratelimit.check(self.channel_name, self.user.id, self.chatroom_name)
+        if limited:
+            if not self.wants_html:
+                await self.send_frame('rate_limited', scope=limited.scope, retry_after=round(limited.retry_after, 2))
+                return
+            await self.send_action("rate_limited", scope=limited.scope, retry_after=round(limited.retry_after, 2))
+            return
+
+        # write-behind: broadcast now under a provisional id, saved with the next batch
+        if settings.CHAT_WRITE_BEHIND:
+            message, event = await self.prepare_message(body)
+            await self.channel_layer.group_send(
+                self.chatroom_name, event
+            )
+            await writebehind.writer.add(message)
+            return
 
-        event = {
-            'type': 'message_handler',
-            'message_id': message.id
-        }
+        # Create message object and render it once for the whole room, if anyone in it wants html
+        html = await self.presence.count(broadcast.html_room(self.chatroom_name)) > 0
+        event, member_ids = await self.create_message(body, html)
 
         # calling the group_send fucntion to broadcast to everyone in the chat room
-        async_to_sync(self.channel_layer.group_send)(
+        await self.channel_layer.group_send(
             self.chatroom_name, event
         )
 
-    # in order to send the htmx partial we create an event and an event handler
+        # Trigger notifications update for all other users in the chat, once per message
+        await notifications.dispatcher.notify(member_ids)
 
-    def message_handler(self, event):
-
-        message_id = event['message_id']
-        message = GroupMessage.objects.get(id=message_id) # grabbing a message using message_id from event dict
-
-        # Defining context for render_to_string
-        context = {
-            'message': message,
-            'user': self.user,
-            'chat_group': self.chatroom
-        }
-
-        html = render_to_string('a_rtchat/partials/chat_message_p.html', context = context)
-
-        # Calling send function to send data back to frontend in form of html partial
-        self.send(text_data=html)
-
-        # Trigger notifications update for all other users in the chat.
-        # For a group chat, iterate over members (excluding the sender).
-        for member in self.chatroom.members.exclude(id=message.author.id):
-            async_to_sync(self.channel_layer.group_send)(
-                f'notifications_{member.id}',
-                {'type': 'notification_handler'}
-            )
+    # in order to send the htmx partial we create an event and an event handler
 
-    # To update the online count
-    def update_online_count(self):
-        online_count = self.chatroom.user_online.count() - 1
+    async def message_handler(self, event):
+        seq = event['data']['seq']
+        if seq is not None:
+            # already sent by replay()
+            if seq <= self.replayed_seq:
+                return
+            if self.live_seqs is not None:
+                self.live_seqs.add(seq)
+                # clients that replay ask right after connecting, this one does not
+                if len(self.live_seqs) > settings.CHAT_REPLAY_LIMIT:
+                    self.live_seqs = None
+
+        mine = event['author_id'] == self.user.id
+        if not self.wants_html:
+            await self.send_frame('message.new', message=event['data'], mine=mine)
+        else:
+            # the event already carries the rendered partial, just pick our variant
+            variant = 'html_mine' if mine else 'html_theirs'
+            html = event.get(variant)
+
+            # this socket connected after the event was built without html
+            if html is None:
+                html = (await database_sync_to_async(broadcast.message_event)(event['message_id'], True))[variant]
+
+            # Calling send function to send data back to frontend in form of html partial
+            await self.send_html(html)
+
+        # provisional ids of unsaved messages are not read cursors
+        if isinstance(event['message_id'], int):
+            self.last_message_id = max(self.last_message_id, event['message_id'])
+
+    # Sends the messages the client missed while it was disconnected, or
+    # tells it to reload the page when there are too many. Once per socket,
+    # a reconnect is a new socket.
+    async def replay(self, since):
+        if self.live_seqs is None:
+            return
+        missed = await database_sync_to_async(history.replay)(self.chatroom.id, since, exclude=self.live_seqs)
+        self.live_seqs = None
+        if missed is None:
+            metrics.incr('replay.reloads')
+            if self.wants_html:
+                await self.send_action('reload')
+            else:
+                await self.send_frame('reload')
+            return
+        if not missed:
+            return
+
+        metrics.incr('replay.messages', len(missed))
+        self.replayed_seq = missed[-1].seq
+        self.last_message_id = max(self.last_message_id, max(message.id for message in missed))
+        if not self.wants_html:
+            for message in missed:
+                mine = message.author_id == self.user.id
+                await self.send_frame('message.new', message=protocol.message_data(message, message.id), mine=mine)
+            return
+        await self.send_html(await database_sync_to_async(broadcast.replay_html)(missed, self.user))
+
+    # a batch of write-behind messages was saved, these are the id and sequence
+    # number of the newest. The client broadcast them without a sequence number,
+    # it replays from this one on after a reconnect.
+    async def messages_persisted(self, event):
+        self.last_message_id = max(self.last_message_id, event['last_id'])
+        if self.wants_html:
+            await self.send_action('persisted', last_seq=event['last_seq'])
+        else:
+            await self.send_frame('persisted', last_seq=event['last_seq'])
 
-        event = {
-            'type': 'online_count_handler',
-            'online_count':online_count
-        }
-        
-        async_to_sync(self.channel_layer.group_send)(self.chatroom_name,event)
+    # To update the online count, changes are coalesced per room
+    async def update_online_count(self):
+        await broadcast.online_counts.changed(self.chatroom_name)
 
     # Defining the event handler
-    def online_count_handler(self,event):
-        online_count = event['online_count']
-
-        users = User.objects.all()
-
-        chat_messages = ChatGroup.objects.get(group_name=self.chatroom_name).chat_messages.all()[:50]
-        author_ids = set([message.author.id for message in chat_messages])
-
-        # users list of those ids
-        users = User.objects.filter(id__in=author_ids)
-
-        context = {
-            'online_count':online_count,
-            'chat_group':self.chatroom,
-            'users':users,
-        }
-
-        # Creating html partial
-        html = render_to_string('a_rtchat/partials/online_count.html', context)
+    async def online_count_handler(self, event):
+        online_ids = set(event['online_ids'])
+        if not self.wants_html:
+            # only who came and went since the last frame
+            came_online, went_offline = online_ids - self.online_ids, self.online_ids - online_ids
+            self.online_ids = online_ids
+            if came_online or went_offline:
+                await self.send_frame(
+                    'presence.delta',
+                    online=sorted(came_online),
+                    offline=sorted(went_offline),
+                    count=len(online_ids - {self.user.id}),
+                )
+            return
+
+        # this socket connected after the event was built without html
+        if 'html' not in event:
+            event = await database_sync_to_async(broadcast.online_count_event)(self.chatroom_name, online_ids)
+            if event is None:
+                return
 
         # Calling send function to send data back to frontend in form of html partial
-        self.send(text_data=html)
-
+        await self.send_html(event['html'])
 
     # Ban user handler
-    def user_banned(self, event):
+    async def user_banned(self, event):
         user_id = event["user_id"]
         if self.user.id == user_id:
-            self.send(text_data=json.dumps({
-                "action": "user_banned"
-            }))
-            self.close()  # Forcefully disconnect banned user
+            if self.wants_html:
+                await self.send_action("user_banned")
+            else:
+                await self.send_frame('ban', banned=True)
+            await self.close()  # Forcefully disconnect banned user
 
     # Unban user handler
-    def user_unbanned(self, event):
+    async def user_unbanned(self, event):
         user_id = event["user_id"]
         if self.user.id == user_id:
-            self.send(text_data=json.dumps({
-                "action": "user_unbanned"
-            }))
+            if self.wants_html:
+                await self.send_action("user_unbanned")
+            else:
+                await self.send_frame('ban', banned=False)
+
+    # Database helpers, each one is a single trip to the sync thread
+
+    @database_sync_to_async
+    def get_chatroom(self):
+        chatroom = ChatGroup.objects.filter(group_name=self.chatroom_name).first()
+        if chatroom is None or not access.can_join(chatroom, self.user):
+            return None
+        return chatroom
+
+    @database_sync_to_async
+    def create_message(self, body, html=True):
+        # Create message object and attach author and chatroom
+        message = GroupMessage.objects.create(
+            body=body,
+            author=self.user,
+            group=self.chatroom
+        )
+        unread.message_created(message)
+        # the author is sending from this socket, so they are online
+        return broadcast.message_event(message.id, author_online=True, html=html), notifications.members_to_notify(message)
+
+    @database_sync_to_async
+    def prepare_message(self, body):
+        message = writebehind.prepare_message(body, self.user, self.chatroom)
+        return message, broadcast.render_message_event(message, message.provisional_id, author_online=True)
+
+class OnlineStatusConsumer(ProtocolMixin, AsyncWebsocketConsumer):
+    """
+    Header online count and chat list dots of a user.
 
-class OnlineStatusConsumer(WebsocketConsumer):
+    The whole status is rendered once when the socket connects, after that
+    it only gets deltas: contacts coming online or going offline through the
+    user's own presence group, and the dots of the rooms in their chat list.
+    """
 
-    def connect(self):
+    async def connect(self):
         # retrieving the user info
         self.user = self.scope['user']
         self.group_name = 'online-status'
-        self.group = get_object_or_404(ChatGroup, group_name=self.group_name)
+        self.presence = get_presence()
+        self.format = protocol.socket_format(self.scope)
 
-        # if user not present in database
-        if self.user not in self.group.user_online.all():
-            # add to user_online property
-            self.group.user_online.add(self.user)
-
-        # add user channel to channel layer group
-        async_to_sync(self.channel_layer.group_add)(
+        # the global group only carries the public chat dot
+        await self.channel_layer.group_add(
             self.group_name, self.channel_name
         )
+        await self.channel_layer.group_add(
+            broadcast.presence_group(self.user.id), self.channel_name
+        )
 
-        self.accept()
-        self.online_status()
-
-    
-    def disconnect(self, close_code):
+        await self.accept()
 
-        # if user is present in user_online property
-        if self.user in self.group.user_online.all():
-            self.group.user_online.remove(self.user)
+        came_online = await self.presence.join(self.group_name, self.user.id, self.channel_name)
+        await self.send_online_status()
+        self.heartbeat = self.presence.keep_alive(self.group_name, self.user.id, self.channel_name)
 
-        # discard user channel from channel layer group
-        async_to_sync(self.channel_layer.group_discard)(
-            self.group_name, self.channel_name
-        )
-        self.online_status()
+        # let the user's contacts know if the user just came online
+        if came_online:
+            await broadcast.contact_presence_changed(self.user.id, True)
 
-    def online_status(self):
 
-        # the online_status_handler will render htmx partial for each user
-        event = {
-            'type': 'online_status_handler',  
-        }
+    async def disconnect(self, close_code):
+        # not there if connect failed before it, that error is the one to see
+        heartbeat = getattr(self, 'heartbeat', None)
+        if heartbeat is not None:
+            heartbeat.cancel()
+        went_offline = await self.presence.leave(self.group_name, self.user.id, self.channel_name)
 
-        async_to_sync(self.channel_layer.group_send)(
-            self.group_name, event
+        # discard user channel from channel layer groups
+        await self.channel_layer.group_discard(
+            self.group_name, self.channel_name
         )
+        await self.channel_layer.group_discard(
+            broadcast.presence_group(self.user.id), self.channel_name
+        )
+        if went_offline:
+            await broadcast.contact_presence_changed(self.user.id, False)
+
+    async def send_online_status(self):
+        chats = await inbox.mark_online(await database_sync_to_async(inbox.for_user)(self.user), self.user.id)
+        contact_ids = await database_sync_to_async(inbox.contact_ids)(self.user.id)
+        self.online_contacts = await self.presence.online_among(self.group_name, contact_ids)
+
+        # someone other than this user is in the public chat
+        in_public_chat = await self.presence.count('public-chat')
+        if await self.presence.is_online('public-chat', self.user.id):
+            in_public_chat -= 1
+        self.public_chat_online = in_public_chat > 0
+        self.online_chats = {chat.group.group_name for chat in chats if chat.online}
+
+        if not self.wants_html:
+            await self.send_frame(
+                'chats',
+                chats=[protocol.chat_data(chat) for chat in chats],
+                online_count=len(self.online_contacts),
+                public_chat_online=self.public_chat_online,
+            )
+            return
 
-    def online_status_handler(self, event):
-
-        # exclude current user and show other online users
-        online_users = self.group.user_online.exclude(id=self.user.id)
-
-        # to show online status in the header for public chats
-        public_chat_users = ChatGroup.objects.get(group_name='public-chat').user_online.exclude(id=self.user.id)
+        html = await database_sync_to_async(broadcast.online_status_html)(
+            self.user, chats, len(self.online_contacts), self.public_chat_online
+        )
+        await self.send_html(html)
 
-        # online status for private chats logic
-        my_chats = self.user.chat_groups.all()
+    def online_in_chats(self):
+        return self.public_chat_online or bool(self.online_chats)
 
-        # using list comprehension to get all private chats with other users
-        private_chats_with_users = [chat for chat in my_chats.filter(is_private=True) if chat.user_online.exclude(id=self.user.id)]
-        group_chats_with_users = [chat for chat in my_chats.filter(groupchat_name__isnull=False) if chat.user_online.exclude(id=self.user.id)]
+    # A contact came online or went offline, only the count changes
+    async def contact_presence(self, event):
+        online_count = len(self.online_contacts)
+        if event['online']:
+            self.online_contacts.add(event['user_id'])
+        else:
+            self.online_contacts.discard(event['user_id'])
 
-        if public_chat_users or private_chats_with_users or group_chats_with_users:
-            online_in_chats = True
+        if len(self.online_contacts) == online_count:
+            return
+        if not self.wants_html:
+            await self.send_frame('presence.contacts', count=len(self.online_contacts))
         else:
-            online_in_chats = False
-        
-        context = {
-            'online_users': online_users,
-            'online_in_chats':online_in_chats,
-            'public_chat_users':public_chat_users,
-            'user':self.user,
-        }
-
-        # create html partial and return with send function
-        html = render_to_string('a_rtchat/partials/online_status.html', context)
-        self.send(text_data=html)
-
-class NotificationConsumer(WebsocketConsumer):
-    def connect(self):
+            await self.send_html(broadcast.online_status_delta_html(online_count=len(self.online_contacts)))
+
+    # The users in a room of the chat list changed, update its dot
+    async def room_presence(self, event):
+        group_name = event['group_name']
+        online_ids = event['online_ids']
+        online = online_ids is None or bool(set(online_ids) - {self.user.id})
+
+        if group_name == 'public-chat':
+            if online == self.public_chat_online:
+                return
+            self.public_chat_online = online
+        else:
+            if online == (group_name in self.online_chats):
+                return
+            if online:
+                self.online_chats.add(group_name)
+            else:
+                self.online_chats.discard(group_name)
+
+        if not self.wants_html:
+            await self.send_frame('presence.room', room=group_name, online=online)
+            return
+        await self.send_html(broadcast.online_status_delta_html(
+            online_in_chats=self.online_in_chats(), dots=[(group_name, online)]
+        ))
+
+class NotificationConsumer(ProtocolMixin, AsyncWebsocketConsumer):
+    # the dispatcher already coalesces notifications (see notifications.py)
+    batch_window = 0
+
+    async def connect(self):
         self.user = self.scope['user']
+        self.format = protocol.socket_format(self.scope)
         # Create a notifications group unique for each user.
-        self.group_name = f'notifications_{self.user.id}'
+        self.group_name = notifications.notification_group(self.user.id)
+
+        # unread count per group as last sent to this socket
+        self.unread_counts = {}
 
-        async_to_sync(self.channel_layer.group_add)(
+        await self.channel_layer.group_add(
             self.group_name, self.channel_name
         )
-        self.accept()
+        await self.accept()
         # Optionally, send initial notifications state
-        self.send_notifications_update()
+        await self.send_notifications_update()
 
-    def disconnect(self, close_code):
-        async_to_sync(self.channel_layer.group_discard)(
+    async def disconnect(self, close_code):
+        await self.channel_layer.group_discard(
             self.group_name, self.channel_name
         )
-        
-    def notification_handler(self, event):
-        # Called when a notification update is triggered.
-        self.send_notifications_update()
-
-    def send_notifications_update(self):
-        # Query for unread notifications or messages.
-        # For this example, we assume unread messages are those with is_seen=False.
-        unread_messages = GroupMessage.objects.filter(is_seen=False,group__in=self.user.chat_groups.all()).exclude(group__group_name='public-chat').exclude(author=self.user)
-
-        # Create context for partial.
-        context = {
-            'unread_messages': unread_messages,
-            'user': self.user,
-        }
-        # Render the notifications dropdown partial.
-        html = render_to_string('a_rtchat/partials/notifications.html', context)
-        self.send(text_data=html)
\ No newline at end of file
+
+    async def notification_handler(self, event):
+        # Called when a notification update is triggered, only push what changed.
+        if not self.wants_html:
+            delta = await self.unread_delta()
+            if delta:
+                await self.send_frame('unread.delta', **delta)
+            return
+
+        html = await self.render_notifications_delta()
+        if html:
+            await self.send_html(html)
+
+    async def send_notifications_update(self):
+        if not self.wants_html:
+            await self.send_frame('unread', chats=await self.unread())
+            return
+
+        html = await self.render_notifications()
+        await self.send_html(html)
+
+    @database_sync_to_async
+    def render_notifications(self):
+        html, self.unread_counts = notifications.notifications_html(self.user)
+        return html
+
+    @database_sync_to_async
+    def render_notifications_delta(self):
+        html, self.unread_counts = notifications.notifications_delta_html(self.user, self.unread_counts)
+        return html
+
+    @database_sync_to_async
+    def unread(self):
+        chats, self.unread_counts = notifications.unread_data(self.user)
+        return chats
+
+    @database_sync_to_async
+    def unread_delta(self):
+        delta, self.unread_counts = notifications.unread_delta_data(self.user, self.unread_counts)
+        return delta
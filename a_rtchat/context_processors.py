@@ -0,0 +1,9 @@
+from django.conf import settings
+
+
+# query string the pages add to the chat socket urls, see protocol.py.
+# msgpack is for other clients, the pages only render json frames
+def socket_protocol(request):
+    if settings.CHAT_SOCKET_PROTOCOL == 'json':
+        return {'socket_query': '?protocol=json'}
+    return {'socket_query': ''}
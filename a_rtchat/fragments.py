@@ -0,0 +1,43 @@
+"""
+Rendered chat messages, cached.
+
+A message renders the same for every viewer except its author, and it only
+changes when the author's profile does (name, avatar) or when the resized
+variants of its image are built. The html is cached under all of these, so
+a changed profile simply stops matching the old entries (see
+Profile.version), and a page of messages is one get_many.
+"""
+
+from django.conf import settings
+from django.core.cache import cache
+from django.template.loader import render_to_string
+
+from . import metrics
+
+
+def cache_key(message, is_author):
+    return 'chat-message:{}:{}:{}:{}:{}'.format(
+        message.id, message.seq, int(is_author), message.author.profile.version, int(bool(message.variants)),
+    )
+
+
+# The html of `messages` as seen by `user`, in the same order. The messages
+# need their author and profile loaded (see history.get_page).
+def render_messages(messages, user):
+    keys = [cache_key(message, message.author_id == user.id) for message in messages]
+    rendered = cache.get_many(keys)
+    metrics.incr('fragments.hits', len(rendered))
+
+    missing = {}
+    for message, key in zip(messages, keys):
+        if key in rendered or key in missing:
+            continue
+        # same as the "mine" / "theirs" variants of a broadcast message
+        context = {'message': message, 'user': message.author if message.author_id == user.id else None}
+        missing[key] = render_to_string('a_rtchat/chat_message.html', context)
+
+    if missing:
+        cache.set_many(missing, settings.CHAT_FRAGMENT_CACHE_TIMEOUT)
+        metrics.incr('fragments.misses', len(missing))
+        rendered.update(missing)
+    return [rendered[key] for key in keys]
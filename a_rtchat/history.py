@@ -0,0 +1,64 @@
+from datetime import datetime, timedelta, timezone
+from django.conf import settings
+from django.db.models import Q
+from .models import GroupMessage
+
+
+# Keyset pagination over a chat group's messages, newest first.
+# A cursor is the (created, id) pair of the oldest message already shown,
+# so every page is one range scan on the (group, created, id) index no
+# matter how deep into the history it is.
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def encode_cursor(message):
+    micros = (message.created - EPOCH) // timedelta(microseconds=1)
+    return f'{micros}-{message.id}'
+
+
+def decode_cursor(cursor):
+    try:
+        micros, message_id = cursor.split('-')
+        return EPOCH + timedelta(microseconds=int(micros)), int(message_id)
+    except (AttributeError, ValueError, OverflowError, OSError):
+        return None
+
+
+# Returns (messages newest first, cursor of the next older page or None)
+def get_page(chat_group, before=None, size=None):
+    if size is None:
+        size = settings.CHAT_HISTORY_PAGE_SIZE
+    return paginate(chat_group.chat_messages.select_related('author__profile'), before, size)
+
+
+# One page of `chat_messages` (ordered newest first) older than the `before` cursor
+def paginate(chat_messages, before, size):
+    if before is not None:
+        created, message_id = before
+        chat_messages = chat_messages.filter(
+            Q(created__lt=created) | Q(created=created, id__lt=message_id)
+        )
+
+    # one extra row tells us if there is an older page
+    page = list(chat_messages[:size + 1])
+    if len(page) > size:
+        return page[:size], encode_cursor(page[size - 1])
+    return page, None
+
+
+# Messages of a chat group with a sequence number above `since`, oldest
+# first, for a socket that reconnected. One range scan on the (group, seq)
+# index. Returns None if more than `limit` were missed, the client reloads then.
+def replay(chat_group_id, since, limit=None, exclude=()):
+    if limit is None:
+        limit = settings.CHAT_REPLAY_LIMIT
+    missed = list(
+        GroupMessage.objects.filter(group_id=chat_group_id, seq__gt=since)
+        .exclude(seq__in=exclude)
+        .select_related('author__profile')
+        .order_by('seq')[:limit + 1]
+    )
+    if len(missed) > limit:
+        return None
+    return missed
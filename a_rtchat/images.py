@@ -0,0 +1,64 @@
+"""
+Resized variants of uploaded images.
+
+Every variant is stored next to the original as WebP and JPEG, and the
+names are kept on the model as {format: [[width, name], ...]} so that
+templates can build srcset attributes without touching storage.
+"""
+
+import io
+import os
+
+from django.core.files.base import ContentFile
+from PIL import Image, ImageOps
+
+# widths for images in chat messages, shown at most 18rem wide
+MESSAGE_WIDTHS = (320, 640, 1280)
+
+# widths for avatars, shown from 32px up to 144px
+AVATAR_WIDTHS = (64, 160, 320)
+
+FORMATS = {
+    'webp': ('WEBP', {'quality': 80, 'method': 4}),
+    'jpeg': ('JPEG', {'quality': 82, 'optimize': True, 'progressive': True}),
+}
+
+
+# Builds and stores the variants of an image file, returns the names per format
+def build_variants(file, widths):
+    with file.open('rb'):
+        image = Image.open(file)
+        image.load()
+
+    # phone pictures are often stored sideways with an orientation tag
+    image = ImageOps.exif_transpose(image)
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if 'transparency' in image.info else 'RGB')
+
+    # never upscale, an image smaller than every width gets one variant at its own size
+    sizes = [width for width in widths if width < image.width] or [image.width]
+
+    stem = os.path.splitext(file.name)[0]
+    variants = {name: [] for name in FORMATS}
+    for width in sizes:
+        resized = image if width == image.width else image.resize(
+            (width, round(image.height * width / image.width)), Image.LANCZOS
+        )
+        for name, (pil_format, options) in FORMATS.items():
+            data = io.BytesIO()
+            frame = resized.convert('RGB') if pil_format == 'JPEG' else resized
+            frame.save(data, pil_format, **options)
+            saved = file.storage.save(f'{stem}_{width}w.{name}', ContentFile(data.getvalue()))
+            variants[name].append([width, saved])
+    return variants
+
+
+def srcset(storage, variants, format):
+    return ', '.join(f'{storage.url(name)} {width}w' for width, name in variants.get(format, []))
+
+
+# Deletes stored variants, used when the original is replaced
+def delete_variants(storage, variants):
+    for names in variants.values():
+        for width, name in names:
+            storage.delete(name)
@@ -0,0 +1,85 @@
+"""
+The chat list of a user, one ChatMember row per (user, group).
+
+Every row carries what the sidebar shows: the name of the chat, the other
+user of a private chat, a preview of the last message and the unread
+count. The rows are updated as things happen (members, messages, renames)
+so that the whole list is a single indexed query. Whether someone else is
+in a chat room comes from the presence service when the list is rendered,
+changes after that are pushed over the online status socket.
+"""
+
+from django.db.models import F
+
+from .models import ChatGroup, ChatMember, members_with_profiles
+from .presence import get_presence
+
+
+def preview(message):
+    if message.body:
+        return message.body[:100]
+    return f'\N{PAPERCLIP} {message.filename}'[:100]
+
+
+# The chat list fields for the newest message of a group, or for none
+def last_message_fields(message):
+    if message is None:
+        return {'last_message_preview': '', 'last_message_at': None}
+    return {'last_message_preview': preview(message), 'last_message_at': message.created}
+
+
+# Fills in the chat names of the member rows of the groups, for group
+# chats only the rows of `user_ids` if given
+def refresh_names(group_ids, user_ids=None):
+    groups = ChatGroup.objects.filter(id__in=group_ids).prefetch_related(members_with_profiles())
+    for group in groups:
+        if not group.is_private:
+            rows = ChatMember.objects.filter(group=group)
+            if user_ids is not None:
+                rows = rows.filter(user_id__in=user_ids)
+            rows.update(display_name=group.groupchat_name or group.group_name, other_user=None)
+            continue
+
+        members = list(group.members.all())
+        for member in members:
+            others = [other for other in members if other != member]
+            other = others[0] if others else None
+            ChatMember.objects.filter(group=group, user=member).update(
+                display_name=other.profile.name if other else '', other_user=other
+            )
+
+
+# The user's name changed, in private chats it is the chat name of the other member
+def user_renamed(user):
+    ChatMember.objects.filter(other_user=user).update(display_name=user.profile.name)
+
+
+# Sets `online` on the rows of a chat list, someone other than the user is
+# in the chat room. One presence lookup for all the rooms on the list.
+async def mark_online(chats, user_id):
+    online = await get_presence().online_map([chat.group.group_name for chat in chats])
+    for chat in chats:
+        chat.online = bool(online[chat.group.group_name] - {user_id})
+    return chats
+
+
+# Users that share a chat with the user, they are the ones shown the user's presence
+def contact_ids(user_id):
+    group_ids = ChatMember.objects.filter(user_id=user_id).exclude(
+        group__group_name='public-chat'
+    ).values('group_id')
+    return set(
+        ChatMember.objects.filter(group_id__in=group_ids).exclude(user_id=user_id)
+        .values_list('user_id', flat=True).distinct()
+    )
+
+
+def member_ids(group_name):
+    return list(ChatMember.objects.filter(group__group_name=group_name).values_list('user_id', flat=True))
+
+
+# The chat list of a user, newest conversation first
+def for_user(user):
+    return list(ChatMember.objects.filter(user=user).exclude(
+        group__group_name='public-chat'
+    ).select_related('group').order_by(F('last_message_at').desc(nulls_last=True), '-group_id'))
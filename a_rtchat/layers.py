@@ -0,0 +1,104 @@
+"""
+Channel layers that spread the chat rooms over several Redis servers.
+
+channels_redis can already use more than one host, but it picks a host by
+CRC modulo the number of hosts, so adding or removing a Redis moves almost
+every room and socket. These layers put the hosts on a hash ring instead:
+a changed host list only moves what was on the host that came or went.
+
+    ShardedRedisChannelLayer        channels_redis.core. group_send reads the
+                                    room's members from the room's shard and
+                                    queues the message for every socket.
+    ShardedRedisPubSubChannelLayer  channels_redis.pubsub. group_send is one
+                                    PUBLISH on the room's shard, every worker
+                                    with sockets in the room fans it out
+                                    locally. Cheaper for wide rooms, but
+                                    nothing is queued for a worker that is away.
+
+settings.CHAT_CHANNEL_LAYER picks one, CHANNEL_REDIS_URLS lists the servers.
+HashRing is also what a load balancer can use to send every socket of a room
+to the same worker (see the chat_layer_benchmark command).
+"""
+
+import asyncio
+import bisect
+import hashlib
+
+from channels_redis.core import RedisChannelLayer
+from channels_redis.pubsub import RedisPubSubChannelLayer, RedisPubSubLoopLayer
+from channels_redis.utils import _wrap_close
+
+
+class HashRing:
+    """
+    Consistent hashing of names onto nodes. Every node gets `replicas`
+    points on the ring, a name belongs to the node of the next point.
+    """
+
+    replicas = 160
+
+    def __init__(self, nodes, replicas=None):
+        self.nodes = list(nodes)
+        ring = sorted(
+            (self.hash(f'{node}#{replica}'), index)
+            for index, node in enumerate(self.nodes)
+            for replica in range(replicas or self.replicas)
+        )
+        self.points = [point for point, index in ring]
+        self.indexes = [index for point, index in ring]
+
+    @staticmethod
+    def hash(value):
+        if isinstance(value, str):
+            value = value.encode('utf8')
+        return int.from_bytes(hashlib.blake2b(value, digest_size=8).digest(), 'big')
+
+    # index in `nodes` of the node that `name` is placed on
+    def index(self, name):
+        if len(self.nodes) == 1:
+            return 0
+        position = bisect.bisect(self.points, self.hash(name)) % len(self.points)
+        return self.indexes[position]
+
+    def node(self, name):
+        return self.nodes[self.index(name)]
+
+
+# hosts are placed by address, so reordering CHANNEL_REDIS_URLS moves nothing
+def host_name(host):
+    return host.get('address') or f"{host.get('host')}:{host.get('port')}"
+
+
+class ShardedRedisChannelLayer(RedisChannelLayer):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.ring = HashRing([host_name(host) for host in self.hosts])
+
+    # used for groups and for the queues of sockets
+    def consistent_hash(self, value):
+        return self.ring.index(value)
+
+
+class ShardedRedisPubSubLoopLayer(RedisPubSubLoopLayer):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.ring = HashRing([host_name(shard.host) for shard in self._shards])
+
+    def _get_shard(self, channel_or_group_name):
+        return self._shards[self.ring.index(channel_or_group_name)]
+
+
+class ShardedRedisPubSubChannelLayer(RedisPubSubChannelLayer):
+
+    # same as the parent, one layer per event loop, with the ring
+    def _get_layer(self):
+        loop = asyncio.get_running_loop()
+        try:
+            return self._layers[loop]
+        except KeyError:
+            layer = ShardedRedisPubSubLoopLayer(*self._args, **self._kwargs, channel_layer=self)
+            self._layers[loop] = layer
+            _wrap_close(self, loop)
+            return layer
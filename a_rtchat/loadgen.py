@@ -0,0 +1,175 @@
+"""
+Standalone WebSocket load generator for a running chat server.
+
+Opens N sockets to a chat room at once, has the first one send messages
+and measures how long each one takes to reach every socket, then closes
+them all. Talks to the server over the network like browsers do, so it
+measures the whole stack (Daphne, compression, channel layer, workers):
+
+    python -m a_rtchat.loadgen ws://localhost:8000/ws/chatroom/public-chat \\
+        --cookie "sessionid=..." --sockets 500 --messages 20
+
+The sockets log in with the session cookie of one user (copy it from the
+browser). The server's rate limits still apply to the sender, raise
+CHAT_RATE_LIMIT_* there or use --interval. Prints one JSON line.
+"""
+
+import argparse
+import asyncio
+import json
+import ssl
+import sys
+import time
+import uuid
+
+from autobahn.asyncio.websocket import WebSocketClientFactory, WebSocketClientProtocol
+from autobahn.websocket.compress import (
+    PerMessageDeflateOffer, PerMessageDeflateResponse, PerMessageDeflateResponseAccept,
+)
+
+from .loadtest import percentile
+
+
+class LoadSocket(WebSocketClientProtocol):
+
+    def connection_made(self, transport):
+        loop = asyncio.get_running_loop()
+        self.opened = loop.create_future()
+        self.closed = loop.create_future()
+        self.frames = asyncio.Queue()
+        self.compressed = False
+        super().connection_made(transport)
+
+    def onOpen(self):
+        self.compressed = self._perMessageCompress is not None
+        self.opened.set_result(time.perf_counter())
+
+    def onMessage(self, payload, isBinary):
+        self.frames.put_nowait((time.perf_counter(), payload))
+
+    def onClose(self, wasClean, code, reason):
+        if not self.opened.done():
+            self.opened.set_exception(ConnectionError(reason or f'closed with {code}'))
+        if not self.closed.done():
+            self.closed.set_result(time.perf_counter())
+
+    # arrival time of the first frame containing `token`, None after `timeout`
+    async def wait_for(self, token, timeout):
+        deadline = time.perf_counter() + timeout
+        while True:
+            try:
+                arrived, payload = await asyncio.wait_for(self.frames.get(), deadline - time.perf_counter())
+            except (asyncio.TimeoutError, ValueError):
+                return None
+            if token in payload:
+                return arrived
+
+
+def accept_deflate(response):
+    if isinstance(response, PerMessageDeflateResponse):
+        return PerMessageDeflateResponseAccept(response)
+    return None
+
+
+def make_factory(options):
+    headers = {'Cookie': options.cookie} if options.cookie else None
+    factory = WebSocketClientFactory(options.url, origin=options.origin, headers=headers)
+    factory.protocol = LoadSocket
+    if options.deflate:
+        factory.setProtocolOptions(
+            perMessageCompressionOffers=[PerMessageDeflateOffer()],
+            perMessageCompressionAccept=accept_deflate,
+        )
+    return factory
+
+
+async def connect(factory, timeout):
+    loop = asyncio.get_running_loop()
+    started = time.perf_counter()
+    try:
+        _, socket = await asyncio.wait_for(loop.create_connection(
+            factory, factory.host, factory.port, ssl=ssl.create_default_context() if factory.isSecure else None,
+        ), timeout)
+        opened = await asyncio.wait_for(socket.opened, timeout)
+    except (OSError, ConnectionError, asyncio.TimeoutError):
+        return None, None
+    return socket, (opened - started) * 1000
+
+
+async def run(options):
+    factory = make_factory(options)
+
+    started = time.perf_counter()
+    connected = await asyncio.gather(*[connect(factory, options.timeout) for _ in range(options.sockets)])
+    connect_seconds = time.perf_counter() - started
+    sockets = [socket for socket, latency in connected if socket is not None]
+    connect_latencies = [latency for socket, latency in connected if socket is not None]
+    if not sockets:
+        raise SystemExit('no socket could connect')
+
+    # let the presence updates of the connects go by
+    await asyncio.sleep(options.settle)
+    for socket in sockets:
+        while not socket.frames.empty():
+            socket.frames.get_nowait()
+
+    latencies, lost = [], 0
+    started = time.perf_counter()
+    for _ in range(options.messages):
+        token = f'loadgen-{uuid.uuid4().hex}'
+        sent = time.perf_counter()
+        sockets[0].sendMessage(json.dumps({'body': token}).encode('utf8'))
+        arrivals = await asyncio.gather(*[socket.wait_for(token.encode('utf8'), options.timeout) for socket in sockets])
+        for arrived in arrivals:
+            if arrived is None:
+                lost += 1
+            else:
+                latencies.append((arrived - sent) * 1000)
+        if options.interval:
+            await asyncio.sleep(options.interval)
+    broadcast_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for socket in sockets:
+        socket.sendClose()
+    await asyncio.wait([socket.closed for socket in sockets], timeout=options.timeout)
+    disconnect_seconds = time.perf_counter() - started
+
+    def rounded(value):
+        return round(value, 2) if value is not None else None
+
+    return {
+        'url': options.url,
+        'sockets_requested': options.sockets,
+        'sockets_connected': len(sockets),
+        'compressed': sum(socket.compressed for socket in sockets),
+        'connects_per_second': round(len(sockets) / connect_seconds, 1),
+        'connect_p50_ms': rounded(percentile(connect_latencies, 50)),
+        'connect_p99_ms': rounded(percentile(connect_latencies, 99)),
+        'messages': options.messages,
+        'deliveries_per_second': round(len(latencies) / broadcast_seconds, 1) if broadcast_seconds else None,
+        'deliveries_lost': lost,
+        'broadcast_p50_ms': rounded(percentile(latencies, 50)),
+        'broadcast_p99_ms': rounded(percentile(latencies, 99)),
+        'disconnects_per_second': round(len(sockets) / disconnect_seconds, 1) if disconnect_seconds else None,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='WebSocket load generator for a running chat server.')
+    parser.add_argument('url', help='chat socket, e.g. ws://localhost:8000/ws/chatroom/public-chat')
+    parser.add_argument('--sockets', type=int, default=100)
+    parser.add_argument('--messages', type=int, default=20)
+    parser.add_argument('--cookie', help='Cookie header of a logged in user, e.g. "sessionid=..."')
+    parser.add_argument('--origin', help='Origin header, the server checks it against ALLOWED_HOSTS')
+    parser.add_argument('--deflate', action='store_true', help='offer permessage-deflate')
+    parser.add_argument('--interval', type=float, default=0, help='seconds between messages')
+    parser.add_argument('--settle', type=float, default=1, help='seconds to wait after connecting')
+    parser.add_argument('--timeout', type=float, default=10)
+    options = parser.parse_args(argv)
+
+    sys.stdout.write(json.dumps(asyncio.run(run(options))) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+import asyncio
+import json
+import math
+import time
+import uuid
+
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+
+
+# p50/p99 etc. using the nearest-rank method
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, math.ceil(pct / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+# wraps an ASGI app so every connection is authenticated as `user`
+def with_user(application, user):
+    async def app(scope, receive, send):
+        return await application(dict(scope, user=user), receive, send)
+    return app
+
+
+# opens one socket per user against the routed websocket consumers
+async def open_sockets(websocket_urlpatterns, path, users, timeout=10):
+    router = URLRouter(websocket_urlpatterns)
+    sockets = []
+    for user in users:
+        communicator = WebsocketCommunicator(with_user(router, user), path)
+        connected, _ = await communicator.connect(timeout=timeout)
+        if not connected:
+            break
+        sockets.append(communicator)
+    return sockets
+
+
+# like receive_output() but a timeout does not cancel the application
+async def next_frame(communicator, timeout):
+    return await asyncio.wait_for(communicator.output_queue.get(), timeout)
+
+
+# reads and throws away every frame that arrives within `idle` seconds
+async def drain(communicator, idle=0.05):
+    frames = 0
+    while True:
+        try:
+            await next_frame(communicator, idle)
+        except asyncio.TimeoutError:
+            return frames
+        frames += 1
+
+
+# waits until a frame containing `token` arrives, returns arrival time
+async def wait_for(communicator, token, timeout=10):
+    deadline = time.perf_counter() + timeout
+    while True:
+        remaining = deadline - time.perf_counter()
+        if remaining <= 0:
+            return None
+        try:
+            output = await next_frame(communicator, remaining)
+        except asyncio.TimeoutError:
+            return None
+        if token in (output.get('text') or ''):
+            return time.perf_counter()
+
+
+# sends `messages` chat frames from the first socket and measures
+# the time until every socket in the room has received each of them
+async def measure_broadcast(sockets, messages, timeout=10):
+    sender = sockets[0]
+    latencies = []
+    lost = 0
+    for _ in range(messages):
+        token = f'bench-{uuid.uuid4().hex}'
+        started = time.perf_counter()
+        await sender.send_to(text_data=json.dumps({'body': token}))
+        arrivals = await asyncio.gather(*[wait_for(s, token, timeout) for s in sockets])
+        for arrived in arrivals:
+            if arrived is None:
+                lost += 1
+            else:
+                latencies.append((arrived - started) * 1000)
+    return latencies, lost
+
+
+async def close_sockets(sockets):
+    await asyncio.gather(*[s.disconnect() for s in sockets], return_exceptions=True)
@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand
+
+from a_rtchat.models import GroupMessage
+
+
+class Command(BaseCommand):
+    help = (
+        'Fills in content type, dimensions and size of file messages that were '
+        'uploaded before this metadata was stored.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=200)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        fields = ['content_type', 'width', 'height', 'size']
+        messages = GroupMessage.objects.filter(content_type='').exclude(file='').exclude(file__isnull=True)
+
+        batch, updated, missing = [], 0, 0
+        for message in messages.only('id', 'file').iterator(chunk_size=batch_size):
+            try:
+                with message.file.open('rb'):
+                    message.read_file_metadata()
+            except OSError:
+                # gone from storage, leave it for a later run
+                missing += 1
+                continue
+
+            batch.append(message)
+            if len(batch) >= batch_size:
+                updated += GroupMessage.objects.bulk_update(batch, fields)
+                batch = []
+        if batch:
+            updated += GroupMessage.objects.bulk_update(batch, fields)
+
+        self.stdout.write(f'{updated} file messages updated, {missing} files missing')
@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from a_rtchat.models import ChatGroup, GroupMessage
+
+
+class Command(BaseCommand):
+    help = (
+        'Numbers the messages that were sent before messages had sequence '
+        'numbers, per chat group in the order they were sent, after any '
+        'number the group already handed out.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        group_ids = GroupMessage.objects.filter(seq__isnull=True).order_by().values_list('group_id', flat=True).distinct()
+
+        numbered = 0
+        for group_id in group_ids:
+            messages = list(
+                GroupMessage.objects.filter(group_id=group_id, seq__isnull=True).order_by('created', 'id').only('id')
+            )
+            with transaction.atomic():
+                first = ChatGroup.objects.get(id=group_id).allocate_seq(len(messages))
+                for seq, message in enumerate(messages, start=first):
+                    message.seq = seq
+                GroupMessage.objects.bulk_update(messages, ['seq'], batch_size=batch_size)
+            numbered += len(messages)
+
+        self.stdout.write(f'{numbered} messages numbered in {len(group_ids)} chat groups')
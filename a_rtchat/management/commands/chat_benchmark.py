@@ -0,0 +1,128 @@
+import json
+import shutil
+import subprocess
+import tempfile
+
+from asgiref.sync import async_to_sync
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+
+from a_rtchat import benchmarks
+
+LAYERS = {
+    'memory': lambda options: {'BACKEND': 'channels.layers.InMemoryChannelLayer'},
+    'redis': lambda options: {
+        'BACKEND': 'a_rtchat.layers.ShardedRedisChannelLayer',
+        'CONFIG': {'hosts': options['redis_url'].split(',')},
+    },
+}
+SCENARIOS = ['connect', 'fanout', 'notifications', 'uploads', 'chat_view']
+
+
+class Command(BaseCommand):
+    help = (
+        'Runs the real-time chat paths against a throwaway test database: connect '
+        'and disconnect storms, message, notification and file upload fan-out in '
+        'rooms of each size, and the chat page render. Prints one JSON line per '
+        'scenario, size and channel layer. Save a run with --output and pass it '
+        'to --compare on another commit to see what changed.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                            help=f'comma separated, out of {", ".join(SCENARIOS)}')
+        parser.add_argument('--sizes', default='10,100,1000', help='comma separated room sizes (sockets)')
+        parser.add_argument('--layers', default='memory', help='comma separated, memory and/or redis')
+        parser.add_argument('--redis-url', default='redis://localhost:6379',
+                            help='comma separated Redis URLs for the redis layer')
+        parser.add_argument('--messages', type=int, default=20, help='messages (and uploads) per room')
+        parser.add_argument('--requests', type=int, default=50, help='chat page renders')
+        parser.add_argument('--output', help='also write the results to this JSON file')
+        parser.add_argument('--compare', help='JSON file of an earlier run to compare with')
+
+    def handle(self, *args, **options):
+        scenarios = options['scenarios'].split(',')
+        layers = options['layers'].split(',')
+        if set(scenarios) - set(SCENARIOS) or set(layers) - set(LAYERS):
+            raise CommandError(f'--scenarios takes {", ".join(SCENARIOS)}, --layers takes {", ".join(LAYERS)}')
+        sizes = [int(size) for size in options['sizes'].split(',')]
+
+        media_root = tempfile.mkdtemp()
+        spool_dir = tempfile.mkdtemp()
+
+        results = []
+        try:
+            with benchmarks.throwaway_database():
+                for layer in layers:
+                    # the coalescing windows would only add their delay
+                    with override_settings(
+                        CHANNEL_LAYERS={'default': LAYERS[layer](options)},
+                        CHAT_RATE_LIMITS=benchmarks.no_rate_limits(),
+                        CHAT_NOTIFICATION_WINDOW=0,
+                        CHAT_PRESENCE_BROADCAST_WINDOW=0,
+                        CHAT_WORKERS_EAGER=True,
+                        MEDIA_ROOT=media_root,
+                        CHAT_UPLOAD_SPOOL_DIR=spool_dir,
+                    ):
+                        for scenario in scenarios:
+                            for size in sizes:
+                                result = dict(self.run(scenario, size, options), scenario=scenario, layer=layer, size=size)
+                                self.stdout.write(json.dumps(result))
+                                results.append(result)
+        finally:
+            shutil.rmtree(media_root, ignore_errors=True)
+            shutil.rmtree(spool_dir, ignore_errors=True)
+
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump({'commit': self.commit(), 'results': results}, output, indent=2)
+        if options['compare']:
+            self.compare(options['compare'], results)
+
+    def run(self, scenario, size, options):
+        users = benchmarks.create_users(size, prefix=f'{scenario}-{size}-')
+        if scenario == 'connect':
+            return async_to_sync(benchmarks.connect_storm)(users)
+        if scenario == 'fanout':
+            return async_to_sync(benchmarks.message_fanout)(users, options['messages'])
+        if scenario == 'notifications':
+            return async_to_sync(benchmarks.notification_fanout)(users, options['messages'])
+        if scenario == 'uploads':
+            return async_to_sync(benchmarks.upload_fanout)(users, options['messages'])
+        # the page shows the newest messages of a room with `size` of them
+        return benchmarks.chat_view_render(users, size, options['requests'])
+
+    def commit(self):
+        try:
+            return subprocess.run(
+                ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True
+            ).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    # Prints every number next to the one of the earlier run, with the change in percent
+    def compare(self, path, results):
+        with open(path) as baseline_file:
+            baseline = json.load(baseline_file)
+        earlier = {(result['scenario'], result['layer'], result['size']): result for result in baseline['results']}
+
+        for result in results:
+            before = earlier.get((result['scenario'], result['layer'], result['size']))
+            if before is None:
+                continue
+            changes = {}
+            for name, value in result.items():
+                old = before.get(name)
+                if isinstance(value, (int, float)) and isinstance(old, (int, float)) and name != 'size':
+                    changes[name] = {
+                        'before': old,
+                        'after': value,
+                        'change_pct': round((value - old) / old * 100, 1) if old else None,
+                    }
+            self.stdout.write(json.dumps({
+                'compare': baseline.get('commit'),
+                'scenario': result['scenario'],
+                'layer': result['layer'],
+                'size': result['size'],
+                'changes': changes,
+            }))
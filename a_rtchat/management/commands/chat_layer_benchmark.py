@@ -0,0 +1,205 @@
+import asyncio
+import json
+import multiprocessing
+import queue
+import shutil
+import subprocess
+import time
+import uuid
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.module_loading import import_string
+
+from a_rtchat import loadtest
+from a_rtchat.layers import HashRing
+
+BACKENDS = {
+    'core': 'a_rtchat.layers.ShardedRedisChannelLayer',
+    'pubsub': 'a_rtchat.layers.ShardedRedisPubSubChannelLayer',
+}
+
+
+class Command(BaseCommand):
+    help = (
+        'Runs several worker processes that hold the channels of chat sockets '
+        'in their rooms, the way Daphne workers do, and broadcasts to the rooms '
+        'through a sharded channel layer on local Redis servers. Reports the '
+        'group_sends and deliveries per second and the p50/p99 fan-out latency '
+        'for every combination of layer, socket routing, workers and rooms.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--hosts', default='redis://localhost:6379',
+                            help='comma separated Redis URLs the rooms are spread over')
+        parser.add_argument('--start-redis', type=int, default=0, metavar='N',
+                            help='start N redis-server processes on ports 6390 and up and use those')
+        parser.add_argument('--layer', default='core,pubsub', help='comma separated, core and/or pubsub')
+        parser.add_argument('--routing', default='spread,affinity',
+                            help='spread: the sockets of a room are spread over every worker, '
+                                 'affinity: a room is on one worker, placed by HashRing')
+        parser.add_argument('--workers', default='1,2,4', help='comma separated worker counts')
+        parser.add_argument('--rooms', default='1,10,100', help='comma separated room counts')
+        parser.add_argument('--sockets', type=int, default=20, help='sockets per room')
+        parser.add_argument('--messages', type=int, default=1000, help='group_sends per run')
+        parser.add_argument('--timeout', type=float, default=30)
+
+    def handle(self, *args, **options):
+        layers = options['layer'].split(',')
+        if set(layers) - set(BACKENDS):
+            raise CommandError(f'--layer takes {", ".join(BACKENDS)}')
+
+        redis_servers = self.start_redis(options['start_redis'])
+        try:
+            if redis_servers:
+                hosts = [f'redis://localhost:{port}' for port in redis_servers]
+            else:
+                hosts = options['hosts'].split(',')
+
+            for layer in layers:
+                for routing in options['routing'].split(','):
+                    for workers in [int(count) for count in options['workers'].split(',')]:
+                        for rooms in [int(count) for count in options['rooms'].split(',')]:
+                            result = self.run(BACKENDS[layer], hosts, routing, workers, rooms, options)
+                            self.stdout.write(json.dumps(dict(result, layer=layer, shards=len(hosts))))
+        finally:
+            for process in redis_servers.values():
+                process.terminate()
+                process.wait()
+
+    def start_redis(self, count):
+        if not count:
+            return {}
+        if shutil.which('redis-server') is None:
+            raise CommandError('redis-server is not on the PATH')
+
+        servers = {}
+        for port in range(6390, 6390 + count):
+            servers[port] = subprocess.Popen(
+                ['redis-server', '--port', str(port), '--save', '', '--appendonly', 'no'],
+                stdout=subprocess.DEVNULL,
+            )
+        time.sleep(0.5)
+        return servers
+
+    # Which worker holds each socket, as {worker: [room of each socket]}
+    def place_sockets(self, routing, workers, room_names, sockets):
+        placement = {worker: [] for worker in range(workers)}
+        ring = HashRing([f'worker-{worker}' for worker in range(workers)])
+        for room in room_names:
+            for socket in range(sockets):
+                worker = ring.index(room) if routing == 'affinity' else socket % workers
+                placement[worker].append(room)
+        return placement
+
+    def run(self, backend, hosts, routing, workers, rooms, options):
+        # a fresh prefix per run, nothing is left over from the previous one
+        prefix = f'bench-{uuid.uuid4().hex[:8]}'
+        room_names = [f'room-{index}' for index in range(rooms)]
+        sends = {room: 0 for room in room_names}
+        for index in range(options['messages']):
+            sends[room_names[index % rooms]] += 1
+
+        context = multiprocessing.get_context('fork')
+        results = context.Queue()
+        ready = [context.Event() for worker in range(workers)]
+        processes = [
+            context.Process(target=run_worker, args=(
+                backend, hosts, prefix, sockets, sends, options['timeout'], ready[worker], results,
+            ))
+            for worker, sockets in self.place_sockets(routing, workers, room_names, options['sockets']).items()
+        ]
+        for process in processes:
+            process.start()
+        try:
+            for event in ready:
+                if not event.wait(options['timeout']):
+                    raise CommandError('a worker did not join its rooms in time')
+
+            started, sent = asyncio.run(publish(backend, hosts, prefix, room_names, options['messages']))
+
+            reports = []
+            for worker in range(workers):
+                try:
+                    reports.append(results.get(timeout=options['timeout'] + 5))
+                except queue.Empty:
+                    raise CommandError('a worker did not report back')
+        finally:
+            for process in processes:
+                process.join(5)
+                if process.is_alive():
+                    process.terminate()
+
+        latencies = sorted(latency for report in reports for latency in report['latencies'])
+        # every group_send reaches the sockets of one room
+        expected = options['messages'] * options['sockets']
+        finished = max([report['last_received'] for report in reports if report['last_received']] or [sent])
+        return {
+            'routing': routing,
+            'workers': workers,
+            'rooms': rooms,
+            'sockets': rooms * options['sockets'],
+            'messages': options['messages'],
+            'group_sends_per_second': round(options['messages'] / (sent - started), 1),
+            'deliveries_per_second': round(len(latencies) / (finished - started), 1),
+            'lost': expected - len(latencies),
+            'p50_ms': round(loadtest.percentile(latencies, 50) * 1000, 2) if latencies else None,
+            'p99_ms': round(loadtest.percentile(latencies, 99) * 1000, 2) if latencies else None,
+        }
+
+
+def make_layer(backend, hosts, prefix):
+    return import_string(backend)(hosts=hosts, prefix=prefix)
+
+
+# flush() of the core layer would delete the queues other processes still read,
+# its keys expire on their own
+async def close_layer(layer):
+    if hasattr(layer, 'close_pools'):
+        await layer.close_pools()
+    else:
+        await layer.flush()
+
+
+# Sends `messages` group_sends round robin over the rooms, returns when it started and finished
+async def publish(backend, hosts, prefix, room_names, messages):
+    layer = make_layer(backend, hosts, prefix)
+    started = time.time()
+    for index in range(messages):
+        await layer.group_send(room_names[index % len(room_names)], {'type': 'bench.message', 'sent': time.time()})
+    sent = time.time()
+    await close_layer(layer)
+    return started, sent
+
+
+# One worker process: a channel per socket, in the socket's room, each waiting for
+# every message of its room. Reports the latency of every delivery.
+def run_worker(backend, hosts, prefix, sockets, sends, timeout, ready, results):
+    results.put(asyncio.run(worker(backend, hosts, prefix, sockets, sends, timeout, ready)))
+
+
+async def worker(backend, hosts, prefix, sockets, sends, timeout, ready):
+    layer = make_layer(backend, hosts, prefix)
+    report = {'latencies': [], 'last_received': None}
+
+    channels = []
+    for room in sockets:
+        channel = await layer.new_channel()
+        await layer.group_add(room, channel)
+        channels.append((room, channel))
+    ready.set()
+
+    async def receive(room, channel):
+        for _ in range(sends[room]):
+            message = await layer.receive(channel)
+            report['last_received'] = time.time()
+            report['latencies'].append(report['last_received'] - message['sent'])
+
+    tasks = [asyncio.ensure_future(receive(room, channel)) for room, channel in channels]
+    if tasks:
+        # whatever did not arrive in time is reported as lost
+        await asyncio.wait(tasks, timeout=timeout)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    await close_layer(layer)
+    return report
@@ -0,0 +1,65 @@
+import json
+import time
+
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+
+from a_rtchat import benchmarks, loadtest
+from a_rtchat.routing import websocket_urlpatterns
+
+
+class Command(BaseCommand):
+    help = (
+        'Opens N chat sockets against a throwaway test database and reports '
+        'how many sockets one worker accepts and the p50/p99 broadcast latency. '
+        'Run it on two commits to compare before and after, or see '
+        'chat_benchmark for more scenarios.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sockets', default='10,100,500',
+                            help='comma separated room sizes to test')
+        parser.add_argument('--messages', type=int, default=20,
+                            help='messages broadcast per room size')
+        parser.add_argument('--timeout', type=float, default=10)
+
+    def handle(self, *args, **options):
+        sizes = [int(size) for size in options['sockets'].split(',')]
+
+        with benchmarks.throwaway_database():
+            users = benchmarks.create_users(max(sizes), prefix='loadtest')
+            with override_settings(CHAT_RATE_LIMITS=benchmarks.no_rate_limits()):
+                for size in sizes:
+                    result = async_to_sync(self.run_room)(users[:size], options)
+                    self.stdout.write(json.dumps(result))
+
+    async def run_room(self, users, options):
+        room = await database_sync_to_async(benchmarks.create_room)(users, name=f'loadtest-{len(users)}')
+
+        started = time.perf_counter()
+        sockets = await loadtest.open_sockets(
+            websocket_urlpatterns, f'/ws/chatroom/{room.group_name}', users, options['timeout']
+        )
+        connect_seconds = time.perf_counter() - started
+
+        # throw away the online count updates of the connect storm
+        for communicator in sockets:
+            await loadtest.drain(communicator)
+
+        latencies, lost = await loadtest.measure_broadcast(
+            sockets, options['messages'], options['timeout']
+        )
+        await loadtest.close_sockets(sockets)
+
+        return {
+            'sockets_requested': len(users),
+            'sockets_connected': len(sockets),
+            'connect_seconds': round(connect_seconds, 3),
+            'connects_per_second': round(len(sockets) / connect_seconds, 1) if connect_seconds else None,
+            'messages': options['messages'],
+            'deliveries_lost': lost,
+            'broadcast_p50_ms': round(loadtest.percentile(latencies, 50) or 0, 2),
+            'broadcast_p99_ms': round(loadtest.percentile(latencies, 99) or 0, 2),
+        }
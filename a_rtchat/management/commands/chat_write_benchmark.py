@@ -0,0 +1,107 @@
+import json
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, connection
+
+from a_rtchat import benchmarks, loadtest, unread, writebehind
+from a_rtchat.models import GroupMessage
+
+
+class Command(BaseCommand):
+    help = (
+        'Saves the same chat messages one by one (the default path), from one '
+        'or several writers at once, and in write-behind batches against a '
+        'throwaway test database, and reports the inserts per second of each. '
+        'Writers of one room wait for each other on its sequence number, the '
+        'p50/p99 save latency of the default path shows how long.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=2000)
+        parser.add_argument('--members', type=int, default=50,
+                            help='members of the room, every message updates their unread counts')
+        parser.add_argument('--batch', default='10,100',
+                            help='comma separated write-behind batch sizes to test')
+        parser.add_argument('--writers', default='1,4,16',
+                            help='comma separated numbers of threads saving to the room at once')
+
+    def handle(self, *args, **options):
+        with benchmarks.throwaway_database():
+            users = benchmarks.create_users(options['members'])
+            room = benchmarks.create_room(users)
+
+            for writers in [int(count) for count in options['writers'].split(',')]:
+                seconds, latencies, retries = self.direct(room, users, options['messages'], writers)
+                self.report('direct', 1, options['messages'], seconds, writers=writers, latencies=latencies, retries=retries)
+            for batch_size in [int(size) for size in options['batch'].split(',')]:
+                seconds = self.write_behind(room, users, options['messages'], batch_size)
+                self.report('write_behind', batch_size, options['messages'], seconds)
+
+    # what the sockets of the room do for every message without write-behind,
+    # `writers` threads at once. Returns the seconds, the latency of every
+    # save and how often a save had to be retried.
+    def direct(self, room, users, count, writers):
+        barrier = threading.Barrier(writers)
+        latencies = []
+        retries = []
+
+        def save(i):
+            while True:
+                try:
+                    message = GroupMessage.objects.create(body=f'message {i}', author=users[i % len(users)], group=room)
+                    unread.message_created(message)
+                    return
+                except OperationalError:
+                    # SQLite's in-memory test database fails a writer that would wait for the lock
+                    retries.append(i)
+                    time.sleep(0.001)
+
+        def write(writer):
+            try:
+                barrier.wait()
+                for i in range(writer, count, writers):
+                    sent = time.perf_counter()
+                    save(i)
+                    latencies.append(time.perf_counter() - sent)
+            finally:
+                # threads other than this one have their own connections
+                if writers > 1:
+                    connection.close()
+
+        started = time.perf_counter()
+        if writers == 1:
+            write(0)
+        else:
+            threads = [threading.Thread(target=write, args=(writer,)) for writer in range(writers)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        return time.perf_counter() - started, latencies, len(retries)
+
+    def write_behind(self, room, users, count, batch_size):
+        started = time.perf_counter()
+        batch = []
+        for i in range(count):
+            batch.append(writebehind.prepare_message(f'message {i}', users[i % len(users)], room))
+            if len(batch) == batch_size:
+                writebehind.persist(batch)
+                batch = []
+        if batch:
+            writebehind.persist(batch)
+        return time.perf_counter() - started
+
+    def report(self, mode, batch_size, count, seconds, writers=1, latencies=(), retries=0):
+        self.stdout.write(json.dumps({
+            'mode': mode,
+            'writers': writers,
+            'batch_size': batch_size,
+            'messages': count,
+            'seconds': round(seconds, 3),
+            'inserts_per_second': round(count / seconds, 1),
+            'p50_ms': round(loadtest.percentile(latencies, 50) * 1000, 2) if latencies else None,
+            'p99_ms': round(loadtest.percentile(latencies, 99) * 1000, 2) if latencies else None,
+            'lock_retries': retries,
+        }))
@@ -0,0 +1,71 @@
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Max
+
+from a_rtchat.models import ChatGroup, ChatMember, GroupMessage
+
+
+class Command(BaseCommand):
+    help = (
+        'Sets the key of private chats created before it existed and merges '
+        'the duplicate private chats of a pair of users into the oldest one, '
+        'messages and read cursors included.'
+    )
+
+    def handle(self, *args, **options):
+        # {key: [group ids]} of the private chats that have exactly two members
+        members = {}
+        for group_id, user_id in ChatGroup.members.through.objects.filter(
+            chatgroup__is_private=True
+        ).values_list('chatgroup_id', 'user_id'):
+            members.setdefault(group_id, []).append(user_id)
+
+        rooms = {}
+        for group_id, user_ids in members.items():
+            if len(user_ids) == 2:
+                key = ':'.join(str(user_id) for user_id in sorted(user_ids))
+                rooms.setdefault(key, []).append(group_id)
+
+        keyed = dict(ChatGroup.objects.filter(dm_key__isnull=False).values_list('dm_key', 'id'))
+
+        merged, newly_keyed = 0, 0
+        with transaction.atomic():
+            for key, group_ids in rooms.items():
+                # a keyed room is kept even if one of the pair has left it
+                keeper_id = keyed.get(key, min(group_ids))
+                group_ids = set(group_ids) | {keeper_id}
+                duplicate_ids = [group_id for group_id in group_ids if group_id != keeper_id]
+                if key not in keyed:
+                    ChatGroup.objects.filter(id=keeper_id).update(dm_key=key)
+                    newly_keyed += 1
+                if not duplicate_ids:
+                    continue
+
+                user_ids = [int(user_id) for user_id in key.split(':')]
+                keeper = ChatGroup.objects.get(id=keeper_id)
+                keeper.members.add(*user_ids)
+
+                # whatever was read in any of the rooms stays read
+                for user_id in user_ids:
+                    cursor = ChatMember.objects.filter(
+                        group_id__in=group_ids, user_id=user_id
+                    ).aggregate(cursor=Max('last_read_message_id'))['cursor']
+                    ChatMember.objects.filter(group_id=keeper_id, user_id=user_id).update(last_read_message_id=cursor)
+
+                # the rooms' sequence numbers overlap, number the merged messages again in the order they were sent
+                GroupMessage.objects.filter(group_id__in=group_ids).update(seq=None)
+                GroupMessage.objects.filter(group_id__in=duplicate_ids).update(group_id=keeper_id)
+                messages = list(GroupMessage.objects.filter(group_id=keeper_id).order_by('created', 'id').only('id'))
+                for seq, message in enumerate(messages, start=1):
+                    message.seq = seq
+                GroupMessage.objects.bulk_update(messages, ['seq'])
+                ChatGroup.objects.filter(id=keeper_id).update(last_seq=len(messages))
+                ChatGroup.objects.filter(id__in=duplicate_ids).delete()
+                merged += len(duplicate_ids)
+
+        # unread counts and chat list previews of the merged rooms
+        if merged:
+            call_command('sync_chat_members', stdout=self.stdout)
+
+        self.stdout.write(f'{merged} duplicate private chats merged, {newly_keyed} private chats keyed')
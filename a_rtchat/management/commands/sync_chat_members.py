@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from a_rtchat.models import ChatGroup, ChatMember, GroupMessage
+from a_rtchat import inbox, unread
+
+
+class Command(BaseCommand):
+    help = (
+        'Creates missing ChatMember rows for existing group members, '
+        'recounts every unread counter from its read cursor and rebuilds '
+        'the chat list fields (names and last message).'
+    )
+
+    def handle(self, *args, **options):
+        existing = set(ChatMember.objects.values_list('group_id', 'user_id'))
+        missing = {}
+        for group_id, user_id in ChatGroup.members.through.objects.values_list('chatgroup_id', 'user_id'):
+            if (group_id, user_id) not in existing:
+                missing.setdefault(group_id, []).append(user_id)
+        for group_id, user_ids in missing.items():
+            unread.add_members([group_id], user_ids)
+
+        # messages of the other members newer than the read cursor, as one UPDATE
+        unread_messages = GroupMessage.objects.filter(
+            group_id=OuterRef('group_id'),
+            id__gt=Coalesce(OuterRef('last_read_message_id'), 0),
+        ).exclude(
+            author_id=OuterRef('user_id'),
+        ).order_by().values('group_id').annotate(count=Count('id')).values('count')
+        updated = ChatMember.objects.update(unread_count=Coalesce(Subquery(unread_messages), 0))
+
+        # chat list: names, then the newest message of every group, previewed
+        # the same way as on the live path
+        inbox.refresh_names(ChatGroup.objects.values_list('id', flat=True))
+        newest = GroupMessage.objects.filter(group_id=OuterRef('pk')).order_by('-created', '-id').values('id')[:1]
+        newest_ids = ChatGroup.objects.annotate(newest_id=Subquery(newest)).values('newest_id')
+        ChatMember.objects.update(**inbox.last_message_fields(None))
+        for message in GroupMessage.objects.filter(id__in=newest_ids):
+            ChatMember.objects.filter(group_id=message.group_id).update(**inbox.last_message_fields(message))
+
+        created = sum(len(user_ids) for user_ids in missing.values())
+        self.stdout.write(f'{created} chat members created, {updated} unread counters recounted')
@@ -0,0 +1,28 @@
+import threading
+from collections import defaultdict
+
+
+# Process wide counters for tuning the real-time paths.
+# Every worker keeps its own numbers, see the chat-metrics view.
+
+_lock = threading.Lock()
+_counters = defaultdict(int)
+
+
+def incr(name, amount=1):
+    with _lock:
+        _counters[name] += amount
+
+
+def get(name):
+    return _counters.get(name, 0)
+
+
+def snapshot():
+    with _lock:
+        return dict(_counters)
+
+
+def reset():
+    with _lock:
+        _counters.clear()
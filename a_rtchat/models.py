@@ -1,9 +1,21 @@
 from django.db import models
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import F
 import shortuuid # create chats dynamically using shortuuid
 import os
+import mimetypes
 from PIL import Image
+from . import images
+
+# prefetch for the members of chat groups together with their profiles
+def members_with_profiles(lookup='members'):
+    return models.Prefetch(lookup, queryset=User.objects.select_related('profile'))
+
+# key of the private chat between two users, the same whichever of them starts it
+def dm_key_for(user, other_user):
+    return ':'.join(str(user_id) for user_id in sorted([user.id, other_user.id]))
 
 # chat groups
 class ChatGroup(models.Model):
@@ -14,9 +26,10 @@ class ChatGroup(models.Model):
     # admin
     admin = models.ForeignKey(User, related_name='groupchats', blank=True,null=True, on_delete=models.SET_NULL)
 
-    user_online = models.ManyToManyField(User,related_name='online_in_groups', blank=True) # how many users online
     members = models.ManyToManyField(User,related_name='chat_groups', blank=True)
     is_private = models.BooleanField(default=False)
+    dm_key = models.CharField(max_length=64, unique=True, null=True, blank=True) # private chats only, see dm_key_for()
+    last_seq = models.PositiveBigIntegerField(default=0) # sequence number of the newest message
 
     def __str__(self):
         return self.group_name
@@ -35,6 +48,17 @@ class ChatGroup(models.Model):
         # Remove user from members and add to banned list.
         self.members.remove(user)
         self.banned_users.add(user)
+
+    # Takes the next `count` sequence numbers of the group, returns the first.
+    # The row stays locked until the caller's transaction ends, so messages
+    # of a room are committed in sequence order. That makes the writers of a
+    # room wait for each other, busy rooms take whole ranges at once through
+    # write-behind (see writebehind.persist and chat_write_benchmark).
+    def allocate_seq(self, count=1):
+        with transaction.atomic():
+            ChatGroup.objects.filter(id=self.id).update(last_seq=F('last_seq') + count)
+            last_seq = ChatGroup.objects.filter(id=self.id).values_list('last_seq', flat=True).get()
+        return last_seq - count + 1
     
 # chat messages
 class GroupMessage(models.Model):
@@ -43,7 +67,14 @@ class GroupMessage(models.Model):
     body = models.CharField(max_length=300,blank=True,null=True)
     file = models.FileField(upload_to='files/', null=True, blank=True)
     created = models.DateTimeField(auto_now_add=True)
-    is_seen = models.BooleanField(default=False)
+
+    # file metadata, filled in once at upload so rendering never opens the file
+    content_type = models.CharField(max_length=100, blank=True)
+    width = models.PositiveIntegerField(null=True, blank=True)
+    height = models.PositiveIntegerField(null=True, blank=True)
+    size = models.PositiveBigIntegerField(null=True, blank=True)
+    variants = models.JSONField(default=dict, blank=True) # resized copies of images, see images.py
+    seq = models.PositiveBigIntegerField(null=True, blank=True) # per group, increasing, see ChatGroup.allocate_seq()
 
     # get only file name
     @property
@@ -67,21 +98,88 @@ class GroupMessage(models.Model):
 
     def save(self, *args, **kwargs):
         self.full_clean()  # This will call the clean() method
-        super().save(*args, **kwargs)
+        if self.seq is not None:
+            super().save(*args, **kwargs)
+            return
+
+        # numbered and saved in one transaction
+        with transaction.atomic():
+            self.seq = self.group.allocate_seq()
+            super().save(*args, **kwargs)
     
     class Meta:
-        ordering = ['-created']
+        ordering = ['-created', '-id']
+        indexes = [
+            models.Index(fields=['group', 'id'], name='groupmessage_group_id_idx'), # range scans above a read cursor
+            models.Index(fields=['group', 'created', 'id'], name='groupmessage_history_idx'), # history pages
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['group', 'seq'], name='unique_message_seq'), # replay after a reconnect
+        ]
 
 
     # Checks if the uploaded file is an image
     @property
     def is_image(self):
+        return self.content_type.startswith('image/')
+
+    @property
+    def webp_srcset(self):
+        return images.srcset(self.file.storage, self.variants, 'webp')
+
+    @property
+    def jpeg_srcset(self):
+        return images.srcset(self.file.storage, self.variants, 'jpeg')
+
+    # Reads content type, dimensions and size of the file, call before saving
+    # an upload (the file is still local then) or from the backfill command
+    def read_file_metadata(self):
+        self.size = self.file.size
         try:
+            self.file.seek(0)
             image = Image.open(self.file) # open image
+            self.width, self.height = image.size
+            self.content_type = Image.MIME.get(image.format, '')
             image.verify()  # verify the image
-            return True
-        
+
         # if the file is not an image
-        except:
-            return False
-        
+        except Exception:
+            self.width = self.height = None
+            self.content_type = ''
+        finally:
+            self.file.seek(0)
+
+        if not self.content_type:
+            guessed = mimetypes.guess_type(self.file.name)[0]
+            # an image extension on a file that is not one is not trusted
+            if not guessed or guessed.startswith('image/'):
+                guessed = 'application/octet-stream'
+            self.content_type = guessed
+
+
+# per member state of a chat group, one row per (user, group)
+class ChatMember(models.Model):
+    group = models.ForeignKey(ChatGroup, related_name='member_states', on_delete=models.CASCADE)
+    user = models.ForeignKey(User, related_name='chat_states', on_delete=models.CASCADE)
+    last_read_message_id = models.BigIntegerField(null=True, blank=True) # read cursor, id of the newest message the user has read
+    unread_count = models.PositiveIntegerField(default=0) # kept up to date incrementally
+
+    # chat list ("inbox") of the user, kept up to date by inbox.py
+    display_name = models.CharField(max_length=128, blank=True) # group chat name, or the other user's name
+    other_user = models.ForeignKey(User, related_name='+', null=True, blank=True, on_delete=models.SET_NULL) # private chats
+    last_message_preview = models.CharField(max_length=100, blank=True)
+    last_message_at = models.DateTimeField(null=True, blank=True)
+    online = False # someone else is in the chat room, not stored, see inbox.mark_online()
+
+    def __str__(self):
+        return f"{self.user.username} in {self.group.group_name} : {self.unread_count} unread"
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'group'], name='unique_chat_member'),
+        ]
+        indexes = [
+            models.Index(fields=['group', 'last_read_message_id'], name='chatmember_read_cursor_idx'), # who has read a message
+            models.Index(fields=['user', '-last_message_at'], name='chatmember_inbox_idx'), # chat list of a user
+        ]
+
@@ -0,0 +1,167 @@
+import asyncio
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db.models import prefetch_related_objects
+from django.template.loader import render_to_string
+from . import protocol, unread
+
+
+def notification_group(user_id):
+    return f'notifications_{user_id}'
+
+
+# Members of the message's chat group that should get a notification update
+def members_to_notify(message):
+    return list(message.group.members.exclude(id=message.author_id).values_list('id', flat=True))
+
+
+# Renders the whole notifications dropdown.
+# Returns the html and the unread count per group that it shows.
+def notifications_html(user):
+    unread_states = list(unread.states_for(user))
+    prefetch_related_objects(unread_states, unread.members_prefetch())
+
+    context = {
+        'unread_states': unread_states,
+        'user': user,
+    }
+    html = render_to_string('a_rtchat/partials/notifications.html', context)
+    return html, {state.group_id: state.unread_count for state in unread_states}
+
+
+# Renders only the dropdown entries that changed since `previous_counts`.
+# Returns the html (None if nothing changed) and the new unread counts.
+def notifications_delta_html(user, previous_counts):
+    unread_states = list(unread.states_for(user))
+    unread_counts = {state.group_id: state.unread_count for state in unread_states}
+
+    changed_states = [
+        state for state in unread_states
+        if previous_counts.get(state.group_id) != state.unread_count
+    ]
+    read_ids = [group_id for group_id in previous_counts if group_id not in unread_counts]
+    if not changed_states and not read_ids:
+        return None, unread_counts
+
+    # only the changed entries need member names
+    prefetch_related_objects(changed_states, unread.members_prefetch())
+
+    context = {
+        'changed_states': changed_states,
+        'read_ids': read_ids,
+        'known_ids': set(previous_counts),
+        'unread_states': unread_states,
+        'user': user,
+    }
+    html = render_to_string('a_rtchat/partials/notifications_delta.html', context)
+    return html, unread_counts
+
+
+# Same as notifications_html() as data for the protocol frames, the chat
+# names come from the chat list rows so no members are loaded
+def unread_data(user):
+    unread_states = list(unread.states_for(user))
+    chats = [protocol.unread_data(state) for state in unread_states]
+    return chats, {state.group_id: state.unread_count for state in unread_states}
+
+
+# Same as notifications_delta_html(), returns None if nothing changed
+def unread_delta_data(user, previous_counts):
+    unread_states = list(unread.states_for(user))
+    unread_counts = {state.group_id: state.unread_count for state in unread_states}
+
+    changed = [
+        protocol.unread_data(state) for state in unread_states
+        if previous_counts.get(state.group_id) != state.unread_count
+    ]
+    read_ids = [group_id for group_id in previous_counts if group_id not in unread_counts]
+    if not changed and not read_ids:
+        return None, unread_counts
+    return {'changed': changed, 'read': read_ids}, unread_counts
+
+
+class NotificationDispatcher:
+    """
+    Sends notification triggers to the per-user notification groups.
+
+    Called once per message on the sending side. A user that was already
+    notified within the last `window` seconds is not sent to again right
+    away, instead all of those users get one trigger when the window ends.
+    """
+
+    def __init__(self, window=None):
+        self._window = window
+        self.loop = None
+        self.last_sent = {}
+        self.pruned = 0
+        self.pending = set()
+        self.timer = None
+
+    @property
+    def window(self):
+        if self._window is None:
+            return settings.CHAT_NOTIFICATION_WINDOW
+        return self._window
+
+    async def notify(self, user_ids):
+        loop = asyncio.get_running_loop()
+
+        # timers from another (closed) event loop never fire, start over
+        if self.loop is not loop:
+            self.loop = loop
+            self.last_sent = {}
+            self.pruned = loop.time()
+            self.pending = set()
+            self.timer = None
+
+        now = loop.time()
+        self.prune(now)
+        send_now = []
+        for user_id in user_ids:
+            if now - self.last_sent.get(user_id, -self.window) >= self.window:
+                self.last_sent[user_id] = now
+                send_now.append(user_id)
+            else:
+                self.pending.add(user_id)
+
+        if self.pending and self.timer is None:
+            self.timer = loop.call_later(self.window, lambda: asyncio.ensure_future(self.flush()))
+
+        await self.send(send_now)
+
+    async def flush(self):
+        self.timer = None
+        user_ids, self.pending = self.pending, set()
+
+        now = self.loop.time()
+        self.prune(now)
+        for user_id in user_ids:
+            self.last_sent[user_id] = now
+        await self.send(user_ids)
+
+    # Forgets users that have been quiet for a whole window, they are sent to
+    # right away anyway. Runs at most once per window, so only the users of
+    # the last two windows are kept.
+    def prune(self, now):
+        if now - self.pruned < self.window:
+            return
+        self.pruned = now
+        self.last_sent = {
+            user_id: sent for user_id, sent in self.last_sent.items()
+            if now - sent < self.window
+        }
+
+    async def send(self, user_ids):
+        if not user_ids:
+            return
+        channel_layer = get_channel_layer()
+        event = {'type': 'notification_handler'}
+
+        # one pipelined batch instead of awaiting every group_send in turn
+        await asyncio.gather(*[
+            channel_layer.group_send(notification_group(user_id), event)
+            for user_id in user_ids
+        ])
+
+
+dispatcher = NotificationDispatcher()
@@ -0,0 +1,246 @@
+"""
+Who is online in which room.
+
+Every websocket connection registers itself in a room and keeps its
+entry alive with heartbeats. Entries that are not refreshed within `ttl`
+seconds expire, so a crashed worker cannot leave users online forever.
+A user is online in a room while at least one of their connections is.
+
+MemoryPresence keeps everything in the process (development, tests),
+RedisPresence shares the state between workers (production).
+"""
+
+import asyncio
+import time
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+
+class BasePresence:
+
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+
+    # Registers a connection, returns True if the user just came online
+    async def join(self, room, user_id, connection):
+        raise NotImplementedError
+
+    # Removes a connection, returns True if the user just went offline
+    async def leave(self, room, user_id, connection):
+        raise NotImplementedError
+
+    # Keeps a connection alive, same return value as join()
+    async def heartbeat(self, room, user_id, connection):
+        return await self.join(room, user_id, connection)
+
+    async def is_online(self, room, user_id):
+        raise NotImplementedError
+
+    async def count(self, room):
+        raise NotImplementedError
+
+    async def online_ids(self, room):
+        raise NotImplementedError
+
+    # The users of `user_ids` that are online in the room
+    async def online_among(self, room, user_ids):
+        return {user_id for user_id in user_ids if await self.is_online(room, user_id)}
+
+    # {room: set of online user ids} for several rooms at once
+    async def online_map(self, rooms):
+        return {room: await self.online_ids(room) for room in rooms}
+
+    # Sends heartbeats for a connection until the task is cancelled
+    def keep_alive(self, room, user_id, connection):
+        async def beat():
+            while True:
+                await asyncio.sleep(self.ttl / 3)
+                await self.heartbeat(room, user_id, connection)
+        return asyncio.ensure_future(beat())
+
+
+class MemoryPresence(BasePresence):
+
+    def __init__(self, ttl=60):
+        super().__init__(ttl)
+        # room -> user id -> connection -> expiry time
+        self.rooms = {}
+        # room -> earliest expiry time in the room
+        self.next_expiry = {}
+
+    def users(self, room):
+        users = self.rooms.setdefault(room, {})
+        now = time.monotonic()
+        if self.next_expiry.get(room, now + 1) > now:
+            return users
+
+        # drop expired connections and users without any connection left
+        for user_id in list(users):
+            connections = users[user_id]
+            for connection, expires in list(connections.items()):
+                if expires <= now:
+                    del connections[connection]
+            if not connections:
+                del users[user_id]
+        self.next_expiry[room] = min(
+            (expires for connections in users.values() for expires in connections.values()),
+            default=now + self.ttl,
+        )
+        return users
+
+    async def join(self, room, user_id, connection):
+        users = self.users(room)
+        came_online = user_id not in users
+        expires = time.monotonic() + self.ttl
+        users.setdefault(user_id, {})[connection] = expires
+        self.next_expiry[room] = min(self.next_expiry.get(room, expires), expires)
+        return came_online
+
+    async def leave(self, room, user_id, connection):
+        users = self.users(room)
+        connections = users.get(user_id)
+        if not connections or connection not in connections:
+            return False
+        del connections[connection]
+        if connections:
+            return False
+        del users[user_id]
+        return True
+
+    async def is_online(self, room, user_id):
+        return user_id in self.users(room)
+
+    async def count(self, room):
+        return len(self.users(room))
+
+    async def online_ids(self, room):
+        return set(self.users(room))
+
+    async def online_among(self, room, user_ids):
+        return set(self.users(room)).intersection(user_ids)
+
+
+# Removes expired connections of a room, shared by every script below.
+# KEYS[1] sorted set of "user_id:connection" scored by expiry time,
+# KEYS[2] hash of user_id -> number of live connections
+PRUNE = """
+local now = tonumber(ARGV[1])
+local expired = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', now)
+for _, member in ipairs(expired) do
+    local user_id = string.match(member, '^([^:]+):')
+    if redis.call('HINCRBY', KEYS[2], user_id, -1) <= 0 then
+        redis.call('HDEL', KEYS[2], user_id)
+    end
+end
+if #expired > 0 then
+    redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+end
+"""
+
+JOIN = PRUNE + """
+local added = redis.call('ZADD', KEYS[1], ARGV[2], ARGV[3])
+redis.call('EXPIRE', KEYS[1], ARGV[5])
+redis.call('EXPIRE', KEYS[2], ARGV[5])
+if added == 1 and redis.call('HINCRBY', KEYS[2], ARGV[4], 1) == 1 then
+    return 1
+end
+return 0
+"""
+
+LEAVE = PRUNE + """
+if redis.call('ZREM', KEYS[1], ARGV[3]) == 1 then
+    if redis.call('HINCRBY', KEYS[2], ARGV[4], -1) <= 0 then
+        redis.call('HDEL', KEYS[2], ARGV[4])
+        return 1
+    end
+end
+return 0
+"""
+
+USERS = PRUNE + """
+return redis.call('HKEYS', KEYS[2])
+"""
+
+IS_ONLINE = PRUNE + """
+return redis.call('HEXISTS', KEYS[2], ARGV[2])
+"""
+
+ONLINE_AMONG = PRUNE + """
+return redis.call('HMGET', KEYS[2], unpack(ARGV, 2))
+"""
+
+COUNT = PRUNE + """
+return redis.call('HLEN', KEYS[2])
+"""
+
+
+class RedisPresence(BasePresence):
+    """
+    Membership and count are HEXISTS / HLEN on a per room hash, so they do
+    not depend on the size of the room. Expired connections are pruned by
+    every script before it runs.
+    """
+
+    def __init__(self, url='redis://localhost:6379', ttl=60, prefix='presence', client=None):
+        super().__init__(ttl)
+        self.url = url
+        self.prefix = prefix
+        self.client = client
+        self.scripts = {}
+
+    def get_client(self):
+        if self.client is None:
+            import redis.asyncio as redis
+            self.client = redis.from_url(self.url, decode_responses=True)
+        return self.client
+
+    def keys(self, room):
+        return [f'{self.prefix}:{room}:connections', f'{self.prefix}:{room}:users']
+
+    async def run(self, name, source, room, *args):
+        if name not in self.scripts:
+            self.scripts[name] = self.get_client().register_script(source)
+        return await self.scripts[name](keys=self.keys(room), args=[time.time(), *args])
+
+    async def join(self, room, user_id, connection):
+        expires = time.time() + self.ttl
+        member = f'{user_id}:{connection}'
+        return bool(await self.run('join', JOIN, room, expires, member, user_id, int(self.ttl * 2)))
+
+    async def leave(self, room, user_id, connection):
+        member = f'{user_id}:{connection}'
+        return bool(await self.run('leave', LEAVE, room, 0, member, user_id))
+
+    async def is_online(self, room, user_id):
+        return bool(await self.run('is_online', IS_ONLINE, room, user_id))
+
+    async def count(self, room):
+        return await self.run('count', COUNT, room)
+
+    async def online_ids(self, room):
+        return {int(user_id) for user_id in await self.run('users', USERS, room)}
+
+    async def online_among(self, room, user_ids):
+        user_ids = list(user_ids)
+        if not user_ids:
+            return set()
+        counts = await self.run('online_among', ONLINE_AMONG, room, *user_ids)
+        return {user_id for user_id, count in zip(user_ids, counts) if count}
+
+    async def online_map(self, rooms):
+        rooms = list(rooms)
+        results = await asyncio.gather(*[self.online_ids(room) for room in rooms])
+        return dict(zip(rooms, results))
+
+
+_presence = None
+
+# Presence backend configured in settings.CHAT_PRESENCE
+def get_presence():
+    global _presence
+    if _presence is None:
+        config = getattr(settings, 'CHAT_PRESENCE', {})
+        backend = import_string(config.get('BACKEND', 'a_rtchat.presence.MemoryPresence'))
+        _presence = backend(**config.get('CONFIG', {}))
+    return _presence
@@ -0,0 +1,101 @@
+"""
+Compact event protocol of the chat sockets.
+
+By default every socket gets rendered html partials that htmx swaps in.
+A socket opens with ?protocol=json (text frames) or ?protocol=msgpack
+(binary frames) to get small data frames instead, which a client renders
+itself (static/js/chat_protocol.js for json). Every frame is an object with
+the protocol version `v` and a `type`:
+
+    message.new       a chat message, with `mine` for the viewer's own
+    presence.delta    users that came online / went offline in the room
+    presence.contacts number of the user's contacts that are online
+    presence.room     whether someone else is in a room of the chat list
+    chats             the chat list of the user
+    unread            unread count per chat
+    unread.delta      changed and fully read chats since the last frame
+    ban               the user was banned from / unbanned in the room
+    rate_limited      a message was dropped, see ratelimit.py
+    reload            too many messages were missed to replay, reload the page
+    persisted         write-behind messages up to `last_seq` are saved
+    batch             `frames` that were sent together, without their own `v`
+
+A change to the fields of a type bumps VERSION.
+"""
+
+import json
+from urllib.parse import parse_qs
+
+VERSION = 2
+FORMATS = ('html', 'json', 'msgpack')
+
+
+# html, json or msgpack as asked for in the socket's query string
+def socket_format(scope):
+    query = parse_qs(scope.get('query_string', b'').decode())
+    requested = query.get('protocol', ['html'])[0]
+    return requested if requested in FORMATS else 'html'
+
+
+# send() arguments of a frame in the socket's format
+def encode(format, type, **fields):
+    frame = dict(fields, v=VERSION, type=type)
+    if format == 'msgpack':
+        import msgpack
+        return {'bytes_data': msgpack.packb(frame, use_bin_type=True)}
+    return {'text_data': json.dumps(frame, separators=(',', ':'))}
+
+
+# A frame from the client, msgpack clients send binary frames
+def decode(text_data=None, bytes_data=None):
+    if bytes_data is not None:
+        import msgpack
+        return msgpack.unpackb(bytes_data, raw=False)
+    return json.loads(text_data)
+
+
+# What a client needs to render a message. The message may not be saved yet
+# (see writebehind.py), `message_id` is then its provisional id.
+def message_data(message, message_id):
+    profile = message.author.profile
+    data = {
+        'id': message_id,
+        'seq': message.seq,
+        'author': {
+            'id': message.author_id,
+            'username': message.author.username,
+            'name': profile.name,
+            'avatar': profile.avatar,
+        },
+        'body': message.body,
+        'file': None,
+        'created': message.created.isoformat() if message.created else None,
+    }
+    if message.file:
+        data['file'] = {
+            'url': message.file.url,
+            'name': message.filename,
+            'content_type': message.content_type,
+            'width': message.width,
+            'height': message.height,
+        }
+    return data
+
+
+def chat_data(chat):
+    return {
+        'room': chat.group.group_name,
+        'name': chat.display_name,
+        'unread': chat.unread_count,
+        'preview': chat.last_message_preview,
+        'online': chat.online,
+    }
+
+
+def unread_data(state):
+    return {
+        'id': state.group_id,
+        'room': state.group.group_name,
+        'name': state.display_name,
+        'unread': state.unread_count,
+    }
@@ -0,0 +1,157 @@
+"""
+Token bucket rate limiting for chat messages.
+
+Every bucket holds up to `burst` tokens and refills at `rate` tokens per
+second, a message takes one token. A message has to pass the buckets of
+its connection, its user and its room, checked in that order so that a
+single noisy client runs dry before it can drain the room's bucket.
+
+MemoryRateLimiter keeps the buckets in the process (development, tests),
+RedisRateLimiter shares them between workers (production).
+"""
+
+import time
+from collections import namedtuple
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from . import metrics
+
+Limited = namedtuple('Limited', ['scope', 'retry_after'])
+
+SCOPES = ('connection', 'user', 'room')
+
+
+class BaseRateLimiter:
+
+    # Takes a token from each (key, rate, burst) bucket in turn and stops at
+    # the first empty one. Returns None if every bucket had a token, else
+    # (index of the empty bucket, seconds until it has one again)
+    async def consume(self, buckets):
+        raise NotImplementedError
+
+
+class MemoryRateLimiter(BaseRateLimiter):
+
+    # full buckets are dropped every this many calls
+    prune_every = 1000
+
+    def __init__(self):
+        # key -> (tokens, last update time, time the bucket is full again)
+        self.buckets = {}
+        self.calls = 0
+
+    def take(self, key, rate, burst, now):
+        tokens, updated, full_at = self.buckets.get(key, (burst, now, now))
+        tokens = min(burst, tokens + (now - updated) * rate)
+        retry_after = None
+        if tokens < 1:
+            retry_after = (1 - tokens) / rate
+        else:
+            tokens -= 1
+        self.buckets[key] = (tokens, now, now + (burst - tokens) / rate)
+        return retry_after
+
+    # a full bucket is the same as a missing one
+    def prune(self, now):
+        self.buckets = {key: bucket for key, bucket in self.buckets.items() if bucket[2] > now}
+
+    async def consume(self, buckets):
+        now = time.monotonic()
+        self.calls += 1
+        if self.calls % self.prune_every == 0:
+            self.prune(now)
+
+        for index, (key, rate, burst) in enumerate(buckets):
+            retry_after = self.take(key, rate, burst, now)
+            if retry_after is not None:
+                return index, retry_after
+        return None
+
+
+# KEYS are the buckets, ARGV holds rate and burst for each of them.
+# Returns the 1-based index of the first empty bucket and the seconds until
+# it refills as a string (Lua numbers are cut to integers on the way out),
+# or nothing if every bucket had a token.
+CONSUME = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[i * 2 - 1])
+    local burst = tonumber(ARGV[i * 2])
+    local state = redis.call('HMGET', key, 'tokens', 'updated')
+    local tokens = tonumber(state[1]) or burst
+    local updated = tonumber(state[2]) or now
+    tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+    local empty = tokens < 1
+    if not empty then
+        tokens = tokens - 1
+    end
+    redis.call('HSET', key, 'tokens', tostring(tokens), 'updated', tostring(now))
+    redis.call('EXPIRE', key, math.ceil(burst / rate) + 1)
+    if empty then
+        return {i, tostring((1 - tokens) / rate)}
+    end
+end
+return false
+"""
+
+
+class RedisRateLimiter(BaseRateLimiter):
+    """
+    All buckets of a message are checked by one script, one round trip
+    per message no matter how many workers share the limits.
+    """
+
+    def __init__(self, url='redis://localhost:6379', prefix='ratelimit', client=None):
+        self.url = url
+        self.prefix = prefix
+        self.client = client
+        self.script = None
+
+    def get_client(self):
+        if self.client is None:
+            import redis.asyncio as redis
+            self.client = redis.from_url(self.url, decode_responses=True)
+        return self.client
+
+    async def consume(self, buckets):
+        if self.script is None:
+            self.script = self.get_client().register_script(CONSUME)
+        keys = [f'{self.prefix}:{key}' for key, rate, burst in buckets]
+        args = [value for key, rate, burst in buckets for value in (rate, burst)]
+        result = await self.script(keys=keys, args=args)
+        if not result:
+            return None
+        return int(result[0]) - 1, float(result[1])
+
+
+_rate_limiter = None
+
+# Rate limiter backend configured in settings.CHAT_RATE_LIMITER
+def get_rate_limiter():
+    global _rate_limiter
+    if _rate_limiter is None:
+        config = getattr(settings, 'CHAT_RATE_LIMITER', {})
+        backend = import_string(config.get('BACKEND', 'a_rtchat.ratelimit.MemoryRateLimiter'))
+        _rate_limiter = backend(**config.get('CONFIG', {}))
+    return _rate_limiter
+
+
+# Checks a chat message against the limits of its connection, user and room.
+# Returns None if it may be sent, else Limited(scope, retry_after)
+async def check(connection, user_id, room):
+    keys = {'connection': connection, 'user': user_id, 'room': room}
+    buckets = [
+        (f'{scope}:{keys[scope]}', *settings.CHAT_RATE_LIMITS[scope])
+        for scope in SCOPES
+    ]
+    result = await get_rate_limiter().consume(buckets)
+    if result is None:
+        metrics.incr('ratelimit.allowed')
+        return None
+
+    index, retry_after = result
+    metrics.incr(f'ratelimit.limited.{SCOPES[index]}')
+    return Limited(SCOPES[index], retry_after)
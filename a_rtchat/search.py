@@ -0,0 +1,114 @@
+"""
+Full-text search over chat messages.
+
+PostgreSQL matches against to_tsvector('simple', body), backed by a GIN
+index on that same expression. SQLite keeps an FTS5 table over the message
+bodies (external content, so only the index is stored twice). Triggers keep
+it in sync with every insert, update and delete, bulk_create included.
+Both are created by install() after migrate. Other databases fall back to
+a plain icontains scan.
+"""
+
+from django.conf import settings
+from django.db import connection, connections
+from django.db.models import BooleanField
+from django.db.models.expressions import RawSQL
+
+from . import history
+from .models import GroupMessage, members_with_profiles
+
+TABLE = GroupMessage._meta.db_table
+FTS_TABLE = f'{TABLE}_fts'
+
+POSTGRES_INDEX = f"""
+CREATE INDEX IF NOT EXISTS groupmessage_body_search_idx ON {TABLE}
+USING GIN (to_tsvector('simple', COALESCE(body, '')))
+"""
+
+SQLITE_FTS = [
+    f"CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5(body, content='{TABLE}', content_rowid='id')",
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_insert AFTER INSERT ON {TABLE} BEGIN
+        INSERT INTO {FTS_TABLE}(rowid, body) VALUES (new.id, new.body);
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_delete AFTER DELETE ON {TABLE} BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, body) VALUES ('delete', old.id, old.body);
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_update AFTER UPDATE OF body ON {TABLE} BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, body) VALUES ('delete', old.id, old.body);
+        INSERT INTO {FTS_TABLE}(rowid, body) VALUES (new.id, new.body);
+    END
+    """,
+    # index the messages that were there before the table
+    f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')",
+]
+
+
+# sqlite databases known to have the FTS table, by name
+_fts_databases = set()
+
+
+def sqlite_fts_installed(connection):
+    name = connection.settings_dict['NAME']
+    if name not in _fts_databases:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = %s", [FTS_TABLE])
+            if cursor.fetchone() is None:
+                return False
+        _fts_databases.add(name)
+    return True
+
+
+# Creates the search index of a database, safe to run again
+def install(using='default'):
+    connection = connections[using]
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute(POSTGRES_INDEX)
+    elif connection.vendor == 'sqlite' and not sqlite_fts_installed(connection):
+        with connection.cursor() as cursor:
+            for statement in SQLITE_FTS:
+                cursor.execute(statement)
+
+
+# Every word has to match, FTS5 operators typed by the user are taken literally
+def fts_query(text):
+    return ' '.join('"{}"'.format(word.replace('"', '""')) for word in text.split())
+
+
+# Messages matching `text` in `messages`, which is filtered not ordered
+def matching(messages, text):
+    if not text.split():
+        return messages.none()
+
+    if connection.vendor == 'postgresql':
+        # the same expression as the index, so the planner can use it
+        matched = RawSQL(
+            f"to_tsvector('simple', COALESCE({TABLE}.body, '')) @@ websearch_to_tsquery('simple', %s)",
+            [text], output_field=BooleanField(),
+        )
+        return messages.alias(matched=matched).filter(matched=True)
+
+    if connection.vendor == 'sqlite' and sqlite_fts_installed(connection):
+        return messages.filter(id__in=RawSQL(
+            f'SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s', [fts_query(text)]
+        ))
+
+    return messages.filter(body__icontains=text)
+
+
+# One page of messages matching `text` in the rooms of `user`, newest first,
+# and the cursor of the next page (see history.py)
+def search(user, text, before=None, size=None):
+    if size is None:
+        size = settings.CHAT_SEARCH_PAGE_SIZE
+
+    messages = GroupMessage.objects.filter(group__in=user.chat_groups.all())
+    messages = matching(messages, text).select_related('author__profile', 'group').prefetch_related(
+        members_with_profiles('group__members')  # names of private chats
+    ).order_by('-created', '-id')
+    return history.paginate(messages, before, size)
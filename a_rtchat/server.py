@@ -0,0 +1,78 @@
+"""
+Daphne with permessage-deflate on the chat sockets.
+
+Daphne never negotiates WebSocket compression on its own. This server
+accepts a client's permessage-deflate offer for the consumers that have
+`compression = True` (see consumers.py) and adds the raw and compressed
+bytes of every closed socket to the metrics. Start it in place of daphne:
+
+    python -m a_rtchat.server a_core.asgi:application [daphne options]
+"""
+
+import sys
+
+from autobahn.websocket.compress import PerMessageDeflateOffer, PerMessageDeflateOfferAccept
+from daphne.cli import CommandLineInterface
+from daphne.server import Server
+from daphne.ws_protocol import WebSocketProtocol
+from django.urls import Resolver404
+from twisted.internet import reactor
+
+from . import metrics
+
+
+# The consumer class that serves a socket path, None if no route matches
+def consumer_class(path):
+    from .routing import websocket_urlpatterns
+
+    for pattern in websocket_urlpatterns:
+        try:
+            match = pattern.resolve(path.lstrip('/'))
+        except Resolver404:
+            continue
+        if match:
+            return getattr(match.func, 'consumer_class', None)
+    return None
+
+
+def accept_deflate(offers):
+    for offer in offers:
+        if isinstance(offer, PerMessageDeflateOffer):
+            return PerMessageDeflateOfferAccept(offer)
+    return None
+
+
+class CompressingWebSocketProtocol(WebSocketProtocol):
+
+    # extensions are negotiated once the application accepted the socket,
+    # which is after this
+    def onConnect(self, request):
+        if getattr(consumer_class(request.path), 'compression', False):
+            self.perMessageCompressionAccept = accept_deflate
+        return super().onConnect(request)
+
+    def onClose(self, wasClean, code, reason):
+        stats = self.trafficStats
+        if stats is not None:
+            metrics.incr('socket.bytes_raw', stats.outgoingOctetsAppLevel)
+            metrics.incr('socket.bytes_wire', stats.outgoingOctetsWebSocketLevel)
+        super().onClose(wasClean, code, reason)
+
+
+class CompressingServer(Server):
+
+    def run(self):
+        # run() creates the websocket factory, swap its protocol before any connection
+        reactor.callWhenRunning(self.use_compressing_protocol)
+        super().run()
+
+    def use_compressing_protocol(self):
+        self.ws_factory.protocol = CompressingWebSocketProtocol
+
+
+class CompressingCommandLineInterface(CommandLineInterface):
+    server_class = CompressingServer
+
+
+if __name__ == '__main__':
+    CompressingCommandLineInterface().run(sys.argv[1:])
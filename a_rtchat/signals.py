@@ -0,0 +1,71 @@
+from django.dispatch import receiver
+from django.contrib.auth.models import User
+from django.db.models.signals import m2m_changed, post_migrate, post_save
+from a_users.models import Profile
+from .models import ChatGroup
+from . import access, inbox, search, unread
+
+
+# (group ids, user ids) touched by a change of the members or banned users,
+# for group.members.add(user) as well as user.chat_groups.add(group)
+def changed_pairs(sender, instance, action, reverse, pk_set):
+    if action == 'pre_clear':
+        pk_set = set(
+            sender.objects.filter(**{'user' if reverse else 'chatgroup': instance})
+            .values_list('chatgroup_id' if reverse else 'user_id', flat=True)
+        )
+    if reverse:
+        return pk_set, [instance.pk]
+    return [instance.pk], pk_set
+
+
+# keep one ChatMember row per member of a chat group
+@receiver(m2m_changed, sender=ChatGroup.members.through)
+def members_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+
+    group_ids, user_ids = changed_pairs(sender, instance, action, reverse, pk_set)
+    access.invalidate(group_ids, user_ids)
+    if action == 'post_add':
+        unread.add_members(group_ids, user_ids)
+        inbox.refresh_names(group_ids, user_ids)
+    else:
+        unread.remove_members(group_ids, user_ids)
+        if action == 'post_remove':
+            inbox.refresh_names(group_ids, user_ids)
+
+
+# bans and unbans change who may open the room
+@receiver(m2m_changed, sender=ChatGroup.banned_users.through)
+def banned_users_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action in ('post_add', 'post_remove', 'pre_clear'):
+        access.invalidate(*changed_pairs(sender, instance, action, reverse, pk_set))
+
+
+# chat list names follow renamed group chats and users
+@receiver(post_save, sender=ChatGroup)
+def group_saved(sender, instance, created, **kwargs):
+    if not created:
+        inbox.refresh_names([instance.id])
+
+
+@receiver(post_save, sender=Profile)
+def profile_saved(sender, instance, **kwargs):
+    inbox.user_renamed(instance.user)
+
+
+@receiver(post_save, sender=User)
+def user_saved(sender, instance, created, update_fields=None, **kwargs):
+    # logins only touch last_login
+    if created or update_fields == frozenset(['last_login']):
+        return
+    if hasattr(instance, 'profile'):
+        inbox.user_renamed(instance)
+
+
+# the full-text index lives outside the models, see search.py
+@receiver(post_migrate)
+def install_search_index(sender, using, **kwargs):
+    if sender.name == 'a_rtchat':
+        search.install(using)
@@ -0,0 +1,71 @@
+# Jobs for the background worker pool, see workers.py
+
+import os
+
+from channels.layers import get_channel_layer
+from django.core.files import File
+from django.db import transaction
+from django.db.models import F
+
+from a_users.models import Profile
+from . import images, notifications, unread, workers
+from .broadcast import message_event
+from .models import GroupMessage
+from .presence import get_presence
+
+
+# Writes a spooled upload to storage, then creates and broadcasts its message.
+# Nothing is sent to the room before both the file and the row are committed.
+def store_upload(path, name, author_id, group_id, metadata):
+    message = GroupMessage(author_id=author_id, group_id=group_id, **metadata)
+    try:
+        with open(path, 'rb') as file:
+            message.file.save(name, File(file), save=False)
+
+        with transaction.atomic():
+            message.save()
+            unread.message_created(message)
+    finally:
+        # a failed job does not leave its upload in the spool
+        if os.path.exists(path):
+            os.remove(path)
+
+    # presence, channel layer and dispatcher are used from the server's loop,
+    # only the rendering happens in this thread
+    chatroom_name = message.group.group_name
+    author_online = workers.on_loop(get_presence().is_online, chatroom_name, author_id)
+    event = message_event(message.id, author_online=author_online)
+    workers.on_loop(announce, chatroom_name, event, notifications.members_to_notify(message))
+
+    if message.is_image:
+        build_message_variants(message.id)
+
+
+# Broadcasts a saved message and notifies the other members once
+async def announce(chatroom_name, event, member_ids):
+    await get_channel_layer().group_send(chatroom_name, event)
+    await notifications.dispatcher.notify(member_ids)
+
+
+# Resized variants of an image sent in a chat
+def build_message_variants(message_id):
+    message = GroupMessage.objects.filter(id=message_id).first()
+    if message is None or not message.is_image:
+        return
+    variants = images.build_variants(message.file, images.MESSAGE_WIDTHS)
+    GroupMessage.objects.filter(id=message_id).update(variants=variants)
+
+
+# Resized variants of an avatar, skipped if the avatar changed in the meantime.
+# The variants of the previous avatar are deleted once the new ones are in place.
+def build_avatar_variants(profile_id, image_name, old_variants=None):
+    try:
+        profile = Profile.objects.filter(id=profile_id, image=image_name).first() if image_name else None
+        if profile is None:
+            return
+        variants = images.build_variants(profile.image, images.AVATAR_WIDTHS)
+        if not Profile.objects.filter(id=profile_id, image=image_name).update(image_variants=variants, version=F('version') + 1):
+            images.delete_variants(profile.image.storage, variants)
+    finally:
+        if old_variants:
+            images.delete_variants(Profile._meta.get_field('image').storage, old_variants)
@@ -1,3 +1,1500 @@
-from django.test import TestCase
+import asyncio
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from asgiref.testing import ApplicationCommunicator
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import OperationalError, connection
+from django.test import TestCase, TransactionTestCase
+from django.urls import reverse
+from django.test.utils import CaptureQueriesContext
+from PIL import Image
+
+from . import loadtest
+from .consumers import OnlineStatusConsumer
+from .broadcast import OnlineCountBroadcaster, html_room, message_event, online_count_event, online_status_html
+from . import access, benchmarks, history, inbox, metrics, protocol, search
+from .layers import HashRing, ShardedRedisChannelLayer, ShardedRedisPubSubLoopLayer
+from .notifications import NotificationDispatcher, notification_group, notifications_delta_html, notifications_html
+from .presence import MemoryPresence, get_presence
+from .ratelimit import MemoryRateLimiter
+from a_users.models import Profile
+from .models import ChatGroup, ChatMember, GroupMessage, dm_key_for
+from . import tasks, unread, workers, writebehind
+from .routing import websocket_urlpatterns
+from .uploads import UploadSizeLimitMiddleware
+
+
+class ChatRoomConsumerTests(TestCase):
+
+    def setUp(self):
+        self.alice = User.objects.create(username='alice')
+        self.bob = User.objects.create(username='bob')
+        self.chat_group = ChatGroup.objects.create(group_name='room', groupchat_name='Room')
+        self.chat_group.members.add(self.alice, self.bob)
+
+    def test_message_is_saved_and_broadcast(self):
+        async def run():
+            sockets = await loadtest.open_sockets(
+                websocket_urlpatterns, '/ws/chatroom/room', [self.alice, self.bob]
+            )
+            self.assertEqual(len(sockets), 2)
+            for communicator in sockets:
+                await loadtest.drain(communicator)
+
+            latencies, lost = await loadtest.measure_broadcast(sockets, 1)
+            await loadtest.close_sockets(sockets)
+            return latencies, lost
+
+        latencies, lost = async_to_sync(run)()
+        self.assertEqual(lost, 0)
+        self.assertEqual(len(latencies), 2)
+        self.assertEqual(GroupMessage.objects.filter(group=self.chat_group).count(), 1)
+
+    def test_unknown_room_is_rejected(self):
+        async def run():
+            return await loadtest.open_sockets(
+                websocket_urlpatterns, '/ws/chatroom/missing', [self.alice]
+            )
+
+        self.assertEqual(async_to_sync(run)(), [])
+
+
+class MessageEventTests(TestCase):
+
+    def setUp(self):
+        self.alice = User.objects.create(username='alice')
+        self.bob = User.objects.create(username='bob')
+        self.chat_group = ChatGroup.objects.create(group_name='room', groupchat_name='Room')
+        self.chat_group.members.add(self.alice, self.bob)
+
+    def test_event_carries_both_variants(self):
+        message = GroupMessage.objects.create(body='hello', author=self.alice, group=self.chat_group)
+        event = message_event(message.id)
+
+        self.assertEqual(event['author_id'], self.alice.id)
+        self.assertIn('justify-end', event['html_mine'])
+        self.assertNotIn('justify-end', event['html_theirs'])
+
+    def test_handlers_do_not_query(self):
+        message = GroupMessage.objects.create(body='hello', author=self.alice, group=self.chat_group)
+        event = message_event(message.id)
+
+        async def run():
+            sockets = await loadtest.open_sockets(
+                websocket_urlpatterns, '/ws/chatroom/room', [self.alice, self.bob]
+            )
+            for communicator in sockets:
+                await loadtest.drain(communicator)
+            queries_before = len(queries)
+            await get_channel_layer().group_send('room', event)
+            frames = [await loadtest.next_frame(s, 1) for s in sockets]
+            self.assertEqual(len(queries), queries_before)
+            await loadtest.close_sockets(sockets)
+            return [frame['text'] for frame in frames]
+
+        with CaptureQueriesContext(connection) as queries:
+            mine, theirs = async_to_sync(run)()
+        self.assertEqual(mine, event['html_mine'])
+        self.assertEqual(theirs, event['html_theirs'])
+
+
+class NotificationDispatcherTests(TestCase):
+
+    def test_repeated_triggers_are_coalesced(self):
+        dispatcher = NotificationDispatcher(window=0.05)
+
+        async def run():
+            channel_layer = get_channel_layer()
+            channel_name = await channel_layer.new_channel()
+            await channel_layer.group_add(notification_group(7), channel_name)
+
+            # first trigger goes out at once, the next three are folded into one
+            for _ in range(4):
+                await dispatcher.notify([7])
+            received = [await channel_layer.receive(channel_name)]
+            await asyncio.sleep(0.1)
+            while True:
+                try:
+                    received.append(await asyncio.wait_for(channel_layer.receive(channel_name), 0.05))
+                except asyncio.TimeoutError:
+                    return received
+
+        self.assertEqual(len(async_to_sync(run)()), 2)
+
+    def test_users_notified_once_are_forgotten(self):
+        dispatcher = NotificationDispatcher(window=0.02)
+
+        async def run():
+            # every user is notified once and always goes out right away
+            for batch in range(10):
+                await dispatcher.notify(range(batch * 20, batch * 20 + 20))
+                await asyncio.sleep(0.03)
+            return len(dispatcher.last_sent)
+
+        self.assertLessEqual(async_to_sync(run)(), 40)
+
+
+class UnreadStateTests(TestCase):
+
+    def setUp(self):
+        self.alice = User.objects.create(username='alice')
+        self.bob = User.objects.create(username='bob')
+        self.chat_group = ChatGroup.objects.create(group_name='room', groupchat_name='Room')
+        self.chat_group.members.add(self.alice, self.bob)
+
+    def state(self, user):
+        return ChatMember.objects.get(user=user, group=self.chat_group)
+
+    def test_members_get_a_state_row(self):
+        self.assertEqual(ChatMember.objects.filter(group=self.chat_group).count(), 2)
+        self.chat_group.members.remove(self.bob)
+        self.assertFalse(ChatMember.objects.filter(user=self.bob).exists())
+
+    def test_new_members_see_the_newest_message_in_their_chat_list(self):
+        message = GroupMessage.objects.create(body='hello', author=self.alice, group=self.chat_group)
+        carol = User.objects.create(username='carol')
+        self.chat_group.members.add(carol)
+
+        state = self.state(carol)
+        self.assertEqual(state.last_read_message_id, message.id)
+        self.assertEqual((state.last_message_preview, state.last_message_at), ('hello', message.created))
+
+    def test_counts_are_updated_incrementally(self):
+        for body in ('one', 'two'):
+            message = GroupMessage.objects.create(body=body, author=self.alice, group=self.chat_group)
+            with self.assertNumQueries(2):
+                unread.message_created(message)
+
+        self.assertEqual(self.state(self.bob).unread_count, 2)
+        self.assertEqual(self.state(self.alice).unread_count, 0)
+        self.assertEqual(self.state(self.alice).last_read_message_id, message.id)
+
+        self.assertTrue(unread.mark_read(self.bob, self.chat_group))
+        self.assertEqual(self.state(self.bob).unread_count, 0)
+        self.assertFalse(unread.mark_read(self.bob, self.chat_group))
+
+    def test_mark_read_up_to_moves_cursor_forward_only(self):
+        messages = []
+        for body in ('one', 'two', 'three'):
+            message = GroupMessage.objects.create(body=body, author=self.alice, group=self.chat_group)
+            unread.message_created(message)
+            messages.append(message)
+
+        with self.assertNumQueries(1):
+            self.assertTrue(unread.mark_read_up_to(self.bob, self.chat_group.id, messages[1].id))
+        self.assertEqual(self.state(self.bob).unread_count, 1)
+        self.assertEqual(list(unread.readers(messages[1])), [self.bob])
+        self.assertEqual(list(unread.readers(messages[2])), [])
+
+        self.assertFalse(unread.mark_read_up_to(self.bob, self.chat_group.id, messages[0].id))
+        self.assertEqual(self.state(self.bob).last_read_message_id, messages[1].id)
+
+    def test_mark_read_endpoint(self):
+        message = GroupMessage.objects.create(body='one', author=self.alice, group=self.chat_group)
+        unread.message_created(message)
+        self.client.force_login(self.bob)
+
+        url = reverse('mark-read', args=[self.chat_group.group_name, message.id])
+        self.assertEqual(self.client.get(url).status_code, 405)
+        self.assertEqual(self.client.post(url).status_code, 204)
+        self.assertEqual(self.state(self.bob).unread_count, 0)
+
+    def test_sync_command_recounts_from_cursor(self):
+        GroupMessage.objects.create(body='one', author=self.alice, group=self.chat_group)
+        GroupMessage.objects.create(body='two', author=self.bob, group=self.chat_group)
+        call_command('sync_chat_members', stdout=open(os.devnull, 'w'))
+
+        self.assertEqual(self.state(self.bob).unread_count, 1)
+        self.assertEqual(self.state(self.alice).unread_count, 1)
+
+    def test_notification_socket_pushes_deltas(self):
+        async def run():
+            sockets = await loadtest.open_sockets(
+                websocket_urlpatterns, '/ws/notifications/', [self.bob]
+            )
+            initial = await loadtest.next_frame(sockets[0], 1)
+
+            await database_sync_to_async(self.send_message)()
+            await get_channel_layer().group_send(
+                notification_group(self.bob.id), {'type': 'notification_handler'}
+            )
+            delta = await loadtest.next_frame(sockets[0], 1)
+            await loadtest.close_sockets(sockets)
+            return initial['text'], delta['text']
+
+        initial, delta = async_to_sync(run)()
+        self.assertIn('No new notifications.', initial)
+        self.assertIn(f'notis-{self.chat_group.id}', delta)
+        self.assertNotIn('id="notis-list"', delta)
+
+    def send_message(self):
+        message = GroupMessage.objects.create(body='hi', author=self.alice, group=self.chat_group)
+        unread.message_created(message)
+
+
+class PresenceTests(TestCase):
+
+    def test_user_is_online_while_any_connection_is(self):
+        presence = MemoryPresence()
+
+        async def run():
+            self.assertTrue(await presence.join('room', 1, 'tab-1'))
+            self.assertFalse(await presence.join('room', 1, 'tab-2'))
+            self.assertTrue(await presence.join('room', 2, 'tab-1'))
+            self.assertEqual(await presence.count('room'), 2)
+
+            self.assertFalse(await presence.leave('room', 1, 'tab-1'))
+            self.assertTrue(await presence.is_online('room', 1))
+            self.assertTrue(await presence.leave('room', 1, 'tab-2'))
+            self.assertEqual(await presence.online_ids('room'), {2})
+
+        async_to_sync(run)()
+
+    def test_connections_expire_without_heartbeat(self):
+        presence = MemoryPresence(ttl=0.05)
+
+        async def run():
+            await presence.join('room', 1, 'crashed')
+            await presence.join('room', 2, 'alive')
+            for _ in range(4):
+                await asyncio.sleep(0.02)
+                await presence.heartbeat('room', 2, 'alive')
+            return await presence.online_ids('room')
+
+        self.assertEqual(async_to_sync(run)(), {2})
+
+    def test_chat_sockets_update_presence(self):
+        alice = User.objects.create(username='alice')
+        ChatGroup.objects.create(group_name='room', groupchat_name='Room').members.add(alice)
+
+        async def run():
+            sockets = await loadtest.open_sockets(websocket_urlpatterns, '/ws/chatroom/room', [alice])
+            online = await get_presence().online_ids('room')
+            await loadtest.close_sockets(sockets)
+            return online, await get_presence().online_ids('room')
+
+        self.assertEqual(async_to_sync(run)(), ({alice.id}, set()))
+
+
+class OnlineCountBroadcasterTests(TestCase):
+
+    def test_presence_changes_are_coalesced_per_room(self):
+        alice = User.objects.create(username='alice')
+        chat_group = ChatGroup.objects.create(group_name='room', groupchat_name='Room')
+        chat_group.members.add(alice)
+        broadcaster = OnlineCountBroadcaster(window=0.05)
+        metrics.reset()
+
+        async def run():
+            channel_layer = get_channel_layer()
+            channel_name = await channel_layer.new_channel()
+            await channel_layer.group_add('room', channel_name)
+
+            await get_presence().join('room', alice.id, 'tab')
+            await get_presence().join(html_room('room'), alice.id, 'tab')
+            for _ in range(5):
+                await broadcaster.changed('room')
+            event = await asyncio.wait_for(channel_layer.receive(channel_name), 1)
+            await get_presence().leave(html_room('room'), alice.id, 'tab')
+            await get_presence().leave('room', alice.id, 'tab')
+            try:
+                await asyncio.wait_for(channel_layer.receive(channel_name), 0.1)
+                return event, True
+            except asyncio.TimeoutError:
+                return event, False
+
+        event, received_twice = async_to_sync(run)()
+        self.assertFalse(received_twice)
+        self.assertEqual(event['type'], 'online_count_handler')
+        self.assertIn('green-dot', event['html'])
+        self.assertEqual(metrics.get('presence.updates_suppressed'), 4)
+        self.assertEqual(metrics.get('presence.updates_sent'), 1)
+
+    def test_metrics_view_is_staff_only(self):
+        user = User.objects.create(username='alice')
+        self.client.force_login(user)
+        self.assertEqual(self.client.get(reverse('chat-metrics')).status_code, 404)
+        user.is_staff = True
+        user.save()
+        self.assertEqual(self.client.get(reverse('chat-metrics')).status_code, 200)
+
+
+class HistoryTests(TestCase):
+
+    def setUp(self):
+        self.alice = User.objects.create(username='alice')
+        self.chat_group = ChatGroup.objects.create(group_name='room', groupchat_name='Room')
+        self.chat_group.members.add(self.alice)
+        for i in range(7):
+            GroupMessage.objects.create(body=f'message {i}', author=self.alice, group=self.chat_group)
+
+        # messages sharing a timestamp must still page by id
+        GroupMessage.objects.filter(body__in=['message 2', 'message 3', 'message 4']).update(
+            created=GroupMessage.objects.get(body='message 3').created
+        )
+
+    def test_pages_walk_the_whole_history_once(self):
+        seen = []
+        before = None
+        while True:
+            page, cursor = history.get_page(self.chat_group, before=before, size=3)
+            seen += [message.body for message in page]
+            if cursor is None:
+                break
+            before = history.decode_cursor(cursor)
+        self.assertEqual(seen, [f'message {i}' for i in reversed(range(7))])
+
+    def test_history_endpoint(self):
+        self.client.force_login(self.alice)
+        _, cursor = history.get_page(self.chat_group, size=2)
+
+        with self.settings(CHAT_HISTORY_PAGE_SIZE=2):
+            response = self.client.get(reverse('chat-history', args=['room']), {'before': cursor})
+        self.assertContains(response, 'message 4')
+        self.assertContains(response, 'message 3')
+        self.assertNotContains(response, 'message 5')
+        self.assertContains(response, 'chat_history_loader')
+
+        response = self.client.get(reverse('chat-history', args=['room']), {'before': 'nonsense'})
+        self.assertEqual(response.status_code, 404)
+
+
+class QueryBudgetTests(TestCase):
+    """
+    Render paths must not issue more queries as a room grows. Each one is
+    checked against a fixed budget for rooms of 1, 100 and 1000 members
+    and messages, with nothing cached yet.
+    """
+
+    sizes = [1, 100, 1000]
+
+    def setUp(self):
+        self.rooms = [self.make_room(size) for size in self.sizes]
+
+    def make_room(self, size):
+        # bulk_create skips the post_save signal that creates profiles
+        users = User.objects.bulk_create([User(username=f'user-{size}-{i}') for i in range(size + 1)])
+        Profile.objects.bulk_create([Profile(user=user) for user in users])
+        admin, members = users[0], users[:size]
+
+        chat_group = ChatGroup.objects.create(group_name=f'room-{size}', groupchat_name=f'Room {size}', admin=admin)
+        chat_group.members.add(*members)
+        private_chat = ChatGroup.objects.create(group_name=f'private-{size}', is_private=True)
+        private_chat.members.add(admin, users[size])
+
+        for group in [chat_group, private_chat]:
+            GroupMessage.objects.bulk_create([
+                GroupMessage(body=f'message {i}', author=members[i % size], group=group)
+                for i in range(size)
+            ])
+            # everything unread for the admin
+            ChatMember.objects.filter(group=group, user=admin).update(unread_count=size)
+
+        return chat_group, private_chat
+
+    def assertQueryBudget(self, budget, func):
+        for size, (chat_group, private_chat) in zip(self.sizes, self.rooms):
+            with self.subTest(size=size):
+                self.client.force_login(chat_group.admin)
+                latest = chat_group.chat_messages.first()
+                cache.clear()
+                with self.assertNumQueries(budget):
+                    func(chat_group, private_chat, latest)
+
+    def get(self, name, chatroom_name, **params):
+        response = self.client.get(reverse(name, args=[chatroom_name]), params)
+        self.assertEqual(response.status_code, 200)
+
+    def test_chat_view(self):
+        self.assertQueryBudget(10, lambda chat_group, private_chat, latest: self.get(
+            'chatroom', chat_group.group_name
+        ))
+
+    def test_private_chat_view(self):
+        self.assertQueryBudget(9, lambda chat_group, private_chat, latest: self.get(
+            'chatroom', private_chat.group_name
+        ))
+
+    def test_chat_history(self):
+        self.assertQueryBudget(5, lambda chat_group, private_chat, latest: self.get(
+            'chat-history', chat_group.group_name, before=history.encode_cursor(latest)
+        ))
+
+    def test_chatroom_edit_view(self):
+        self.assertQueryBudget(7, lambda chat_group, private_chat, latest: self.get(
+            'edit-chatroom', chat_group.group_name
+        ))
+
+    def test_message_event(self):
+        self.assertQueryBudget(1, lambda chat_group, private_chat, latest: message_event(latest.id))
+
+    def test_online_count_event(self):
+        self.assertQueryBudget(4, lambda chat_group, private_chat, latest: online_count_event(
+            chat_group.group_name, {chat_group.admin_id}
+        ))
+
+    def test_online_status(self):
+        def render(chat_group, private_chat, latest):
+            chats = inbox.for_user(chat_group.admin)
+            inbox.contact_ids(chat_group.admin_id)
+            online_status_html(chat_group.admin, chats, 0, False)
+
+        self.assertQueryBudget(2, render)
+
+    def test_notifications(self):
+        self.assertQueryBudget(2, lambda chat_group, private_chat, latest: notifications_html(chat_group.admin))
+        self.assertQueryBudget(2, lambda chat_group, private_chat, latest: notifications_delta_html(chat_group.admin, {}))
+
+
+class FileMetadataTests(TestCase):
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        self.alice = User.objects.create(username='alice')
+        self.chat_group = ChatGroup.objects.create(group_name='room', groupchat_name='Room')
+        self.chat_group.members.add(self.alice)
+
+    def png(self, name='photo.png'):
+        data = io.BytesIO()
+        Image.new('RGB', (30, 20)).save(data, 'PNG')
+        return SimpleUploadedFile(name, data.getvalue(), content_type='image/png')
+
+    def test_upload_stores_metadata(self):
+        self.client.force_login(self.alice)
+        with self.settings(MEDIA_ROOT=self.media_root, CHAT_WORKERS_EAGER=True):
+            png = self.png()
+            for upload in [png, SimpleUploadedFile('notes.txt', b'not an image')]:
+                self.client.post(
+                    reverse('chat-file-upload', args=['room']), {'file': upload}, HTTP_HX_REQUEST='true'
+                )
+
+        image, text = GroupMessage.objects.order_by('id')
+        self.assertEqual((image.content_type, image.width, image.height), ('image/png', 30, 20))
+        self.assertEqual(image.size, png.size)
+        self.assertEqual((text.content_type, text.width, text.size), ('text/plain', None, 12))
+
+        # rendering only looks at the stored fields
+        with mock.patch('a_rtchat.models.Image.open') as image_open:
+            event = message_event(image.id)
+        image_open.assert_not_called()
+        self.assertIn('<img', event['html_theirs'])
+
+    def test_backfill_command(self):
+        with self.settings(MEDIA_ROOT=self.media_root):
+            message = GroupMessage.objects.create(file=self.png(), author=self.alice, group=self.chat_group)
+            gone = GroupMessage.objects.create(file=self.png('gone.png'), author=self.alice, group=self.chat_group)
+            gone.file.storage.delete(gone.file.name)
+            self.assertFalse(message.is_image)
+
+            out = io.StringIO()
+            call_command('backfill_file_metadata', stdout=out)
+
+        message.refresh_from_db()
+        self.assertTrue(message.is_image)
+        self.assertEqual((message.width, message.height), (30, 20))
+        self.assertIn('1 file messages updated, 1 files missing', out.getvalue())
+
+
+class ImageVariantTests(TestCase):
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        self.alice = User.objects.create(username='alice')
+        self.chat_group = ChatGroup.objects.create(group_name='room', groupchat_name='Room')
+        self.chat_group.members.add(self.alice)
+        self.client.force_login(self.alice)
+
+    def png(self, size):
+        data = io.BytesIO()
+        Image.new('RGB', size).save(data, 'PNG')
+        return SimpleUploadedFile('photo.png', data.getvalue(), content_type='image/png')
+
+    def test_chat_image_variants(self):
+        with self.settings(MEDIA_ROOT=self.media_root, CHAT_WORKERS_EAGER=True):
+            with self.captureOnCommitCallbacks(execute=True):
+                self.client.post(
+                    reverse('chat-file-upload', args=['room']), {'file': self.png((700, 350))}, HTTP_HX_REQUEST='true'
+                )
+
+            message = GroupMessage.objects.get()
+            # never upscaled past the original width
+            self.assertEqual([width for width, name in message.variants['webp']], [320, 640])
+            for format in ['webp', 'jpeg']:
+                for width, name in message.variants[format]:
+                    with Image.open(os.path.join(self.media_root, name)) as variant:
+                        self.assertEqual((variant.width, variant.format.lower()), (width, format))
+
+            html = message_event(message.id)['html_theirs']
+        self.assertIn('type="image/webp"', html)
+        self.assertIn('_640w.jpeg 640w', html)
+
+    def test_avatar_variants(self):
+        with self.settings(MEDIA_ROOT=self.media_root, CHAT_WORKERS_EAGER=True):
+            with self.captureOnCommitCallbacks(execute=True):
+                self.client.post(reverse('profile-edit'), {'image': self.png((100, 100)), 'displayname': 'Alice'})
+            profile = Profile.objects.get(user=self.alice)
+            self.assertEqual([width for width, name in profile.image_variants['jpeg']], [64])
+            first_variant = profile.image_variants['jpeg'][0][1]
+
+            # a new avatar replaces the old variants, once it is committed and built
+            with self.captureOnCommitCallbacks() as callbacks:
+                self.client.post(reverse('profile-edit'), {'image': self.png((500, 500)), 'displayname': 'Alice'})
+            self.assertTrue(os.path.exists(os.path.join(self.media_root, first_variant)))
+            for callback in callbacks:
+                callback()
+            profile.refresh_from_db()
+            self.assertEqual([width for width, name in profile.image_variants['webp']], [64, 160, 320])
+            self.assertFalse(os.path.exists(os.path.join(self.media_root, first_variant)))
+
+            response = self.client.get(reverse('profile'))
+        self.assertContains(response, '_160w.webp 160w')
+
+
+class UploadTests(TestCase):
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.spool_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        self.addCleanup(shutil.rmtree, self.spool_dir)
+        self.alice = User.objects.create(username='alice')
+        self.chat_group = ChatGroup.objects.create(group_name='room', groupchat_name='Room')
+        self.chat_group.members.add(self.alice)
+        self.client.force_login(self.alice)
+
+    def upload(self, upload, **settings):
+        settings = dict(MEDIA_ROOT=self.media_root, CHAT_UPLOAD_SPOOL_DIR=self.spool_dir, CHAT_WORKERS_EAGER=True, **settings)
+        with self.settings(**settings):
+            return self.client.post(reverse('chat-file-upload', args=['room']), {'file': upload}, HTTP_HX_REQUEST='true')
+
+    def test_message_is_broadcast_after_the_file_is_stored(self):
+        async def listen():
+            channel_layer = get_channel_layer()
+            channel = await channel_layer.new_channel()
+            await channel_layer.group_add('room', channel)
+            response = await database_sync_to_async(self.upload)(SimpleUploadedFile('notes.txt', b'hello'))
+            event = await asyncio.wait_for(channel_layer.receive(channel), 1)
+            return response, event
+
+        response, event = async_to_sync(listen)()
+        self.assertEqual(response.status_code, 202)
+        message = GroupMessage.objects.get()
+        self.assertEqual(event['message_id'], message.id)
+        with self.settings(MEDIA_ROOT=self.media_root):
+            self.assertEqual(message.file.read(), b'hello')
+        self.assertEqual(os.listdir(self.spool_dir), [])
+
+    def test_failed_job_removes_the_spooled_file(self):
+        path = os.path.join(self.spool_dir, 'upload')
+        with open(path, 'wb') as file:
+            file.write(b'hello')
+        with self.settings(MEDIA_ROOT=self.media_root):
+            with self.assertRaises(ValidationError):
+                tasks.store_upload(path, 'notes.txt', self.alice.id, 0, {})
+        self.assertFalse(os.path.exists(path))
+
+    def test_jobs_hand_async_work_to_the_server_loop(self):
+        async def running_loop():
+            return asyncio.get_running_loop()
+
+        async def serve():
+            # the ASGI application remembers the loop it is served on
+            await workers.track_loop(mock.AsyncMock())({}, None, None)
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(None, workers.on_loop, running_loop) is loop
+
+        with mock.patch.object(workers, '_loop', None):
+            self.assertTrue(async_to_sync(serve)())
+
+    def test_limits(self):
+        response = self.upload(SimpleUploadedFile('notes.txt', b'x' * 100), CHAT_UPLOAD_MAX_SIZE=10)
+        self.assertEqual(response.status_code, 413)
+
+        response = self.upload(SimpleUploadedFile('setup.exe', b'MZ', content_type='application/x-msdownload'))
+        self.assertEqual(response.status_code, 415)
+
+        # announced as an image but it is not one
+        response = self.upload(SimpleUploadedFile('photo.png', b'not an image', content_type='image/png'))
+        self.assertEqual(response.status_code, 415)
+
+        self.assertFalse(GroupMessage.objects.exists())
+        self.assertEqual(os.listdir(self.spool_dir), [])
+
+    def test_large_body_is_rejected_before_it_is_read(self):
+        called = []
+
+        async def app(scope, receive, send):
+            called.append(scope)
+
+        async def run():
+            communicator = ApplicationCommunicator(UploadSizeLimitMiddleware(app), {
+                'type': 'http', 'method': 'POST', 'path': '/chat/fileupload/room',
+                'headers': [(b'content-type', b'multipart/form-data; boundary=x'), (b'content-length', b'1000000')],
+            })
+            await communicator.send_input({'type': 'http.request', 'body': b'', 'more_body': True})
+            start = await communicator.receive_output(1)
+            await communicator.receive_output(1)
+            return start
+
+        with self.settings(CHAT_UPLOAD_MAX_SIZE=1000):
+            start = async_to_sync(run)()
+        self.assertEqual(start['status'], 413)
+        self.assertEqual(called, [])
+
+    def test_other_forms_are_not_limited(self):
+        called = []
+
+        async def app(scope, receive, send):
+            called.append(scope['path'])
+
+        async def run():
+            communicator = ApplicationCommunicator(UploadSizeLimitMiddleware(app), {
+                'type': 'http', 'method': 'POST', 'path': reverse('profile-edit'),
+                'headers': [(b'content-type', b'multipart/form-data; boundary=x'), (b'content-length', b'1000000')],
+            })
+            await communicator.send_input({'type': 'http.request', 'body': b''})
+            await communicator.wait(1)
+
+        with self.settings(CHAT_UPLOAD_MAX_SIZE=1000):
+            async_to_sync(run)()
+        self.assertEqual(called, [reverse('profile-edit')])
+
+
+class RateLimitTests(TestCase):
+
+    def test_token_bucket(self):
+        limiter = MemoryRateLimiter()
+        buckets = [('connection:a', 1, 3), ('room:r', 100, 100)]
+
+        async def run(now):
+            with mock.patch('a_rtchat.ratelimit.time.monotonic', return_value=now):
+                return await limiter.consume(buckets)
+
+        for _ in range(3):
+            self.assertIsNone(async_to_sync(run)(0))
+        self.assertEqual(async_to_sync(run)(0), (0, 1))
+        # the empty connection bucket stopped the check before the room bucket
+        self.assertEqual(limiter.buckets['room:r'][0], 97)
+
+        # refills at one token per second, never above the burst
+        self.assertIsNone(async_to_sync(run)(1))
+        self.assertEqual(async_to_sync(run)(1.5), (0, 0.5))
+        for _ in range(3):
+            self.assertIsNone(async_to_sync(run)(100))
+        self.assertIsNotNone(async_to_sync(run)(100))
+
+    def test_over_limit_messages_get_an_error_frame(self):
+        alice = User.objects.create(username='alice')
+        chat_group = ChatGroup.objects.create(group_name='room', groupchat_name='Room')
+        chat_group.members.add(alice)
+        metrics.reset()
+
+        async def run():
+            [communicator] = await loadtest.open_sockets(websocket_urlpatterns, '/ws/chatroom/room', [alice])
+            await loadtest.drain(communicator)
+            frames = []
+            for i in range(3):
+                await communicator.send_to(text_data=json.dumps({'body': f'message {i}'}))
+                frames.append(await loadtest.next_frame(communicator, 1))
+            await loadtest.close_sockets([communicator])
+            return frames
+
+        with self.settings(CHAT_RATE_LIMITS={'connection': (0.001, 2), 'user': (100, 100), 'room': (100, 100)}):
+            frames = async_to_sync(run)()
+
+        error = json.loads(frames[2]['text'])
+        self.assertEqual((error['action'], error['scope']), ('rate_limited', 'connection'))
+        self.assertGreater(error['retry_after'], 0)
+        self.assertEqual(GroupMessage.objects.count(), 2)
+        self.assertEqual(metrics.get('ratelimit.allowed'), 2)
+        self.assertEqual(metrics.get('ratelimit.limited.connection'), 1)
+
+
+class WriteBehindTests(TestCase):
+
+    def setUp(self):
+        self.alice = User.objects.create(username='alice')
+        self.bob = User.objects.create(username='bob')
+        self.carol = User.objects.create(username='carol')
+        self.chat_group = ChatGroup.objects.create(group_name='room', groupchat_name='Room')
+        self.chat_group.members.add(self.alice, self.bob, self.carol)
+
+    def state(self, user):
+        return ChatMember.objects.get(group=self.chat_group, user=user)
+
+    def test_batch_updates_unread_state(self):
+        authors = [self.alice, self.bob, self.alice, self.bob]
+        # nothing is written before the batch is saved, not even the sequence numbers
+        with self.assertNumQueries(0):
+            batch = [writebehind.prepare_message(f'message {i}', author, self.chat_group) for i, author in enumerate(authors)]
+        persisted = writebehind.persist(batch)
+
+        self.assertEqual(persisted, {'room': (batch[-1].id, 4, sorted([self.alice.id, self.carol.id]))})
+        self.assertEqual([message.seq for message in batch], [1, 2, 3, 4])
+        self.assertEqual(self.state(self.carol).unread_count, 4)
+        self.assertEqual((self.state(self.alice).last_read_message_id, self.state(self.alice).unread_count), (batch[2].id, 1))
+        self.assertEqual((self.state(self.bob).last_read_message_id, self.state(self.bob).unread_count), (batch[3].id, 0))
+
+    def test_messages_are_broadcast_before_they_are_saved(self):
+        writer = writebehind.MessageWriter(interval=60, batch_size=100)
+
+        async def run():
+            sockets = await loadtest.open_sockets(websocket_urlpatterns, '/ws/chatroom/room', [self.alice, self.bob])
+            for communicator in sockets:
+                await loadtest.drain(communicator)
+
+            with mock.patch.object(writebehind, 'writer', writer):
+                for i in range(3):
+                    await sockets[0].send_to(text_data=json.dumps({'body': f'message {i}'}))
+                    await loadtest.next_frame(sockets[1], 1)
+                saved_before_flush = await database_sync_to_async(GroupMessage.objects.count)()
+                await writer.flush()
+
+            # the client learns the sequence number its messages got
+            persisted = json.loads((await loadtest.next_frame(sockets[1], 1))['text'])
+            await loadtest.drain(sockets[1])
+            await loadtest.close_sockets(sockets)
+            return saved_before_flush, persisted
+
+        with self.settings(CHAT_WRITE_BEHIND=True):
+            saved_before_flush, persisted = async_to_sync(run)()
+
+        self.assertEqual(saved_before_flush, 0)
+        self.assertEqual(persisted, {'action': 'persisted', 'last_seq': 3})
+        self.assertEqual(GroupMessage.objects.count(), 3)
+        # bob's socket saw the real id of the newest message and marked it read on disconnect
+        self.assertEqual(self.state(self.bob).last_read_message_id, GroupMessage.objects.first().id)
+        self.assertEqual(self.state(self.bob).unread_count, 0)
+
+    def test_failed_batch_stays_queued(self):
+        writer = writebehind.MessageWriter(interval=60, batch_size=100)
+        writer.pending.append(writebehind.prepare_message('first', self.alice, self.chat_group))
+        second = writebehind.prepare_message('second', self.alice, self.chat_group)
+        metrics.reset()
+
+        async def run():
+            with mock.patch.object(writebehind.unread, 'messages_created', side_effect=RuntimeError('database down')):
+                with self.assertLogs('a_rtchat.writebehind', 'ERROR'):
+                    await writer.flush()
+            await writer.add(second)
+            await writer.flush()
+
+        async_to_sync(run)()
+        self.assertEqual(metrics.get('writebehind.failures'), 1)
+        self.assertEqual(list(GroupMessage.objects.order_by('id').values_list('body', flat=True)), ['first', 'second'])
+        self.assertEqual(writer.pending, [])
+
+    def test_close_saves_what_is_queued(self):
+        writer = writebehind.MessageWriter(interval=60, batch_size=100)
+        writer.pending.append(writebehind.prepare_message('last words', self.alice, self.chat_group))
+        writer.close()
+        self.assertEqual(GroupMessage.objects.get().body, 'last words')
+        self.assertEqual(self.state(self.bob).unread_count, 1)
+
+
+class SearchTests(TestCase):
+
+    def setUp(self):
+        self.alice = User.objects.create(username='alice')
+        self.bob = User.objects.create(username='bob')
+        self.room = ChatGroup.objects.create(group_name='room', groupchat_name='Room')
+        self.room.members.add(self.alice, self.bob)
+        self.other_room = ChatGroup.objects.create(group_name='other', groupchat_name='Other')
+        self.other_room.members.add(self.bob)
+
+    def say(self, body, group=None, author=None):
+        return GroupMessage.objects.create(body=body, author=author or self.bob, group=group or self.room)
+
+    def found(self, text, **kwargs):
+        return [message.body for message in search.search(self.alice, text, **kwargs)[0]]
+
+    def test_only_rooms_of_the_user_are_searched(self):
+        self.say('deploy the search index')
+        self.say('deploy on friday', group=self.other_room)
+        self.say('something else')
+        self.assertEqual(self.found('deploy'), ['deploy the search index'])
+        self.assertEqual(self.found('DEPLOY index'), ['deploy the search index'])
+        self.assertEqual(self.found('deploy friday'), [])
+        self.assertEqual(self.found('   '), [])
+
+    def test_index_follows_writes_and_deletes(self):
+        message = self.say('old words')
+        message.body = 'new words'
+        message.save()
+        self.assertEqual(self.found('old'), [])
+        self.assertEqual(self.found('new'), ['new words'])
+
+        # bulk inserts of the write-behind mode are indexed too
+        writebehind.persist([writebehind.prepare_message('batched words', self.bob, self.room)])
+        self.assertEqual(self.found('words'), ['batched words', 'new words'])
+
+        message.delete()
+        self.assertEqual(self.found('words'), ['batched words'])
+
+    def test_search_operators_are_taken_literally(self):
+        self.say('a "quoted" OR NOT thing')
+        self.assertEqual(self.found('"quoted" OR'), ['a "quoted" OR NOT thing'])
+        self.assertEqual(self.found('NEAR( *'), [])
+
+    def test_endpoint_pages_through_results(self):
+        for i in range(5):
+            self.say(f'match {i}')
+        self.client.force_login(self.alice)
+
+        with self.settings(CHAT_SEARCH_PAGE_SIZE=3):
+            response = self.client.get(reverse('chat-search'), {'q': 'match'})
+            self.assertContains(response, 'match 4')
+            self.assertNotContains(response, 'match 1')
+            cursor = search.search(self.alice, 'match', size=3)[1]
+            response = self.client.get(reverse('chat-search'), {'q': 'match', 'before': cursor})
+        self.assertContains(response, 'match 1')
+        self.assertContains(response, 'match 0')
+        self.assertNotContains(response, 'Loading more')
+
+        response = self.client.get(reverse('chat-search'), {'q': 'match', 'before': 'nonsense'})
+        self.assertEqual(response.status_code, 404)
+
+
+class InboxTests(TestCase):
+
+    def setUp(self):
+        self.alice = User.objects.create(username='alice')
+        self.bob = User.objects.create(username='bob')
+        self.room = ChatGroup.objects.create(group_name='room', groupchat_name='Room')
+        self.room.members.add(self.alice, self.bob)
+        self.private_chat = ChatGroup.objects.create(group_name='private', is_private=True)
+        self.private_chat.members.add(self.alice, self.bob)
+
+    def chats(self, user):
+        return {chat.group.group_name: chat for chat in inbox.for_user(user)}
+
+    def test_rows_follow_messages_and_renames(self):
+        GroupMessage.objects.create(body='hello room', author=self.bob, group=self.room)
+        message = GroupMessage.objects.create(body='hello alice', author=self.bob, group=self.private_chat)
+        unread.message_created(message)
+
+        chats = self.chats(self.alice)
+        self.assertEqual(list(chats), ['private', 'room'])
+        self.assertEqual((chats['private'].display_name, chats['private'].other_user), ('bob', self.bob))
+        self.assertEqual((chats['private'].last_message_preview, chats['private'].unread_count), ('hello alice', 1))
+        self.assertEqual(chats['room'].display_name, 'Room')
+
+        self.bob.profile.displayname = 'Bobby'
+        self.bob.profile.save()
+        self.room.groupchat_name = 'Renamed'
+        self.room.save()
+        chats = self.chats(self.alice)
+        self.assertEqual((chats['private'].display_name, chats['room'].display_name), ('Bobby', 'Renamed'))
+        self.assertEqual(self.chats(self.bob)['private'].display_name, 'alice')
+
+    def test_sync_command_previews_like_the_live_path(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        with self.settings(MEDIA_ROOT=media_root):
+            GroupMessage.objects.create(body='x' * 300, author=self.bob, group=self.room)
+            GroupMessage.objects.create(file=SimpleUploadedFile('notes.txt', b'hi'), author=self.bob, group=self.private_chat)
+        ChatMember.objects.update(last_message_preview='', last_message_at=None)
+
+        call_command('sync_chat_members', stdout=io.StringIO())
+
+        chats = self.chats(self.alice)
+        self.assertEqual(chats['room'].last_message_preview, 'x' * 100)
+        self.assertEqual(chats['private'].last_message_preview, '\N{PAPERCLIP} notes.txt')
+        self.assertIsNotNone(chats['private'].last_message_at)
+
+    def test_online_flag_means_someone_else_is_in_the_room(self):
+        presence = MemoryPresence()
+
+        async def online(user):
+            chats = await database_sync_to_async(inbox.for_user)(user)
+            with mock.patch.object(inbox, 'get_presence', return_value=presence):
+                return {chat.group.group_name: chat.online for chat in await inbox.mark_online(chats, user.id)}['room']
+
+        async def run():
+            states = []
+            await presence.join('room', self.alice.id, 'alice-1')
+            states.append((await online(self.alice), await online(self.bob)))
+            await presence.join('room', self.bob.id, 'bob-1')
+            states.append((await online(self.alice), await online(self.bob)))
+            await presence.leave('room', self.alice.id, 'alice-1')
+            await presence.leave('room', self.bob.id, 'bob-1')
+            states.append((await online(self.alice), await online(self.bob)))
+            return states
+
+        self.assertEqual(async_to_sync(run)(), [(False, True), (True, True), (False, False)])
+
+    def test_sidebar_renders_from_the_inbox(self):
+        async def run():
+            room = await loadtest.open_sockets(websocket_urlpatterns, '/ws/chatroom/room', [self.bob])
+            await OnlineCountBroadcaster(window=0).flush('room')
+            [status] = await loadtest.open_sockets(websocket_urlpatterns, '/ws/online-status/', [self.alice])
+            html = (await loadtest.next_frame(status, 1))['text']
+            await loadtest.close_sockets(room + [status])
+            return html
+
+        html = async_to_sync(run)()
+        self.assertIn('Room', html)
+        self.assertIn('green-dot', html.split('Room')[0].rsplit('<li', 1)[1])
+
+
+class PresenceDeltaTests(TestCase):
+
+    def setUp(self):
+        self.alice = User.objects.create(username='alice')
+        self.bob = User.objects.create(username='bob')
+        self.carol = User.objects.create(username='carol')
+        self.room = ChatGroup.objects.create(group_name='room', groupchat_name='Room')
+        self.room.members.add(self.alice, self.bob)
+
+    def test_only_contacts_are_told(self):
+        metrics.reset()
+
+        async def run():
+            [alice] = await loadtest.open_sockets(websocket_urlpatterns, '/ws/online-status/', [self.alice])
+            await loadtest.drain(alice)
+            others = await loadtest.open_sockets(websocket_urlpatterns, '/ws/online-status/', [self.bob, self.carol])
+            frames = [(await loadtest.next_frame(alice, 1))['text']]
+            await loadtest.close_sockets(others)
+            frames.append((await loadtest.next_frame(alice, 1))['text'])
+            frames.append(await loadtest.drain(alice))
+            await loadtest.close_sockets([alice])
+            return frames
+
+        came_online, went_offline, more_frames = async_to_sync(run)()
+        self.assertIn('1 online', came_online)
+        self.assertNotIn('chats-list', came_online)
+        self.assertNotIn('online', went_offline.replace('online-user-count', ''))
+        self.assertEqual(more_frames, 0)
+        # bob's two changes went to alice only, carol has no contacts
+        self.assertEqual(metrics.get('presence.deltas_sent'), 2)
+
+    def test_disconnect_after_a_failed_connect(self):
+        consumer = OnlineStatusConsumer()
+        consumer.scope = {'type': 'websocket', 'user': self.alice}
+        consumer.channel_layer = get_channel_layer()
+        consumer.base_send = mock.AsyncMock()
+
+        async def run():
+            consumer.channel_name = await consumer.channel_layer.new_channel()
+            with mock.patch.object(MemoryPresence, 'join', side_effect=ConnectionError('presence down')):
+                with self.assertRaisesMessage(ConnectionError, 'presence down'):
+                    await consumer.connect()
+            await consumer.disconnect(1006)
+
+        async_to_sync(run)()
+
+    def test_room_dot_is_sent_to_members(self):
+        async def run():
+            [alice] = await loadtest.open_sockets(websocket_urlpatterns, '/ws/online-status/', [self.alice])
+            await loadtest.drain(alice)
+            room = await loadtest.open_sockets(websocket_urlpatterns, '/ws/chatroom/room', [self.bob])
+            await OnlineCountBroadcaster(window=0).flush('room')
+            frame = await loadtest.next_frame(alice, 1)
+            await loadtest.close_sockets(room + [alice])
+            return frame['text']
+
+        html = async_to_sync(run)()
+        self.assertIn('id="chat-dot-room" class="green-dot', html)
+        self.assertIn('online_in_chats', html)
+
+
+class PrivateChatTests(TestCase):
+
+    def setUp(self):
+        self.alice = User.objects.create(username='alice')
+        self.bob = User.objects.create(username='bob')
+        self.carol = User.objects.create(username='carol')
+
+    def start_chat(self, user, other_user):
+        self.client.force_login(user)
+        response = self.client.get(reverse('start-chat', args=[other_user.username]))
+        self.assertEqual(response.status_code, 302)
+        return response.url
+
+    def test_one_room_per_pair(self):
+        # a chat with someone else used to make the lookup create a room on every call
+        self.start_chat(self.alice, self.carol)
+        url = self.start_chat(self.alice, self.bob)
+        self.assertEqual(self.start_chat(self.alice, self.bob), url)
+        self.assertEqual(self.start_chat(self.bob, self.alice), url)
+        self.assertEqual(ChatGroup.objects.filter(is_private=True).count(), 2)
+
+        room = ChatGroup.objects.get(dm_key=dm_key_for(self.bob, self.alice))
+        self.assertEqual(set(room.members.all()), {self.alice, self.bob})
+
+        # leaving and coming back is the same room
+        room.members.remove(self.alice)
+        self.assertEqual(self.start_chat(self.alice, self.bob), url)
+        self.assertIn(self.alice, room.members.all())
+
+        # and so is the other user's, they are added back
+        room.members.remove(self.bob)
+        self.assertEqual(self.start_chat(self.alice, self.bob), url)
+        self.assertIn(self.bob, room.members.all())
+
+    def test_merge_command(self):
+        rooms = []
+        for body in ['first', 'second', 'third']:
+            room = ChatGroup.objects.create(is_private=True)
+            room.members.add(self.alice, self.bob)
+            message = GroupMessage.objects.create(body=body, author=self.bob, group=room)
+            unread.message_created(message)
+            rooms.append(room)
+        unread.mark_read(self.alice, rooms[1])
+        other = ChatGroup.objects.create(is_private=True)
+        other.members.add(self.alice, self.carol)
+
+        call_command('merge_private_chats', stdout=io.StringIO())
+
+        room = ChatGroup.objects.get(dm_key=dm_key_for(self.alice, self.bob))
+        self.assertEqual(room.id, rooms[0].id)
+        self.assertEqual(ChatGroup.objects.filter(is_private=True).count(), 2)
+        self.assertEqual(list(room.chat_messages.values_list('body', flat=True)), ['third', 'second', 'first'])
+        self.assertEqual(ChatMember.objects.get(group=room, user=self.alice).unread_count, 1)
+        self.assertEqual(ChatGroup.objects.get(id=other.id).dm_key, dm_key_for(self.alice, self.carol))
+
+
+class AccessTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.alice = User.objects.create(username='alice')
+        self.bob = User.objects.create(username='bob')
+        self.room = ChatGroup.objects.create(group_name='room', groupchat_name='Room', admin=self.alice)
+        self.room.members.add(self.alice, self.bob)
+        self.private_chat = ChatGroup.objects.create(group_name='private', is_private=True)
+        self.private_chat.members.add(self.alice)
+
+    def test_lookups_are_cached_until_members_or_bans_change(self):
+        self.assertTrue(access.can_join(self.room, self.bob))
+        with self.assertNumQueries(0):
+            self.assertTrue(access.can_join(self.room, self.bob))
+            self.assertFalse(access.is_banned(self.room, self.bob))
+
+        self.room.ban_user(self.bob)
+        self.assertEqual((access.is_member(self.room, self.bob), access.is_banned(self.room, self.bob)), (False, True))
+        self.room.banned_users.remove(self.bob)
+        self.assertFalse(access.is_banned(self.room, self.bob))
+
+        self.assertFalse(access.can_join(self.private_chat, self.bob))
+        self.bob.chat_groups.add(self.private_chat)
+        self.assertTrue(access.can_join(self.private_chat, self.bob))
+
+    def test_sockets_of_outsiders_are_refused(self):
+        self.room.ban_user(self.bob)
+
+        async def run():
+            refused = []
+            for path in ['/ws/chatroom/room', '/ws/chatroom/private']:
+                sockets = await loadtest.open_sockets(websocket_urlpatterns, path, [self.bob])
+                refused.append(not sockets)
+            return refused
+
+        self.assertEqual(async_to_sync(run)(), [True, True])
+
+    def test_leaving_closes_access(self):
+        message = GroupMessage.objects.create(body='hello', author=self.alice, group=self.room)
+        url = reverse('chat-history', args=['room'])
+        before = {'before': history.encode_cursor(message)}
+        self.client.force_login(self.bob)
+        self.assertEqual(self.client.get(url, before).status_code, 200)
+
+        self.client.post(reverse('chatroom-leave', args=['room']))
+        self.assertFalse(access.can_join(self.room, self.bob))
+        self.assertEqual(self.client.get(url, before).status_code, 404)
+
+
+class FragmentCacheTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.alice = User.objects.create(username='alice')
+        self.bob = User.objects.create(username='bob')
+        self.room = ChatGroup.objects.create(group_name='room', groupchat_name='Room')
+        self.room.members.add(self.alice, self.bob)
+        GroupMessage.objects.bulk_create([
+            GroupMessage(body=f'message {i}', author=[self.alice, self.bob][i % 2], group=self.room)
+            for i in range(100)
+        ])
+
+    def load(self, user):
+        self.client.force_login(user)
+        response = self.client.get(reverse('chatroom', args=['room']))
+        self.assertEqual(response.status_code, 200)
+        return response.content.decode()
+
+    def test_warm_page_is_not_rendered_again(self):
+        with self.settings(CHAT_HISTORY_FIRST_PAGE=100):
+            metrics.reset()
+            cold = self.load(self.alice)
+            self.assertEqual(metrics.get('fragments.misses'), 100)
+
+            metrics.reset()
+            self.assertIn('message 99', self.load(self.alice))
+            self.assertEqual((metrics.get('fragments.hits'), metrics.get('fragments.misses')), (100, 0))
+
+            # bob sees the same messages from the other side
+            metrics.reset()
+            self.assertNotEqual(self.load(self.bob), cold)
+            self.assertEqual(metrics.get('fragments.misses'), 100)
+
+    def test_profile_changes_render_again(self):
+        self.load(self.alice)
+        self.bob.profile.displayname = 'Bobby'
+        self.bob.profile.save()
+        self.assertIn('Bobby', self.load(self.alice))
+
+        self.bob.username = 'robert'
+        self.bob.save()
+        self.assertIn('@robert', self.load(self.alice))
+
+
+class ProtocolTests(TestCase):
+
+    def setUp(self):
+        self.alice = User.objects.create(username='alice')
+        self.bob = User.objects.create(username='bob')
+        self.room = ChatGroup.objects.create(group_name='room', groupchat_name='Room')
+        self.room.members.add(self.alice, self.bob)
+
+    def test_data_sockets_get_frames(self):
+        async def run():
+            sockets = await loadtest.open_sockets(
+                websocket_urlpatterns, '/ws/chatroom/room?protocol=json', [self.alice, self.bob]
+            )
+            await OnlineCountBroadcaster(window=0).flush('room')
+            for communicator in sockets:
+                await loadtest.drain(communicator)
+
+            await sockets[0].send_to(text_data=json.dumps({'body': 'hello'}))
+            frames = [json.loads((await loadtest.next_frame(communicator, 1))['text']) for communicator in sockets]
+            await loadtest.close_sockets(sockets[:1])
+            await OnlineCountBroadcaster(window=0).flush('room')
+            frames.append(json.loads((await loadtest.next_frame(sockets[1], 1))['text']))
+            await loadtest.close_sockets(sockets[1:])
+            return frames
+
+        mine, theirs, presence = async_to_sync(run)()
+        self.assertEqual((mine['v'], mine['type'], mine['mine'], theirs['mine']), (protocol.VERSION, 'message.new', True, False))
+        self.assertEqual(theirs['message']['body'], 'hello')
+        self.assertEqual(theirs['message']['author']['username'], 'alice')
+        self.assertEqual(
+            presence, {'v': protocol.VERSION, 'type': 'presence.delta', 'online': [], 'offline': [self.alice.id], 'count': 0}
+        )
+
+    def test_msgpack_frames(self):
+        import msgpack
+
+        async def run():
+            [communicator] = await loadtest.open_sockets(
+                websocket_urlpatterns, '/ws/chatroom/room?protocol=msgpack', [self.alice]
+            )
+            await loadtest.drain(communicator)
+            await communicator.send_to(bytes_data=msgpack.packb({'body': 'packed'}))
+            output = await loadtest.next_frame(communicator, 1)
+            await loadtest.close_sockets([communicator])
+            return msgpack.unpackb(output['bytes'])
+
+        frame = async_to_sync(run)()
+        self.assertEqual((frame['type'], frame['message']['body']), ('message.new', 'packed'))
+
+    def test_rooms_without_html_sockets_skip_rendering(self):
+        members = User.objects.bulk_create([User(username=f'member-{i}') for i in range(200)])
+        Profile.objects.bulk_create([Profile(user=user) for user in members])
+        self.room.members.add(*members)
+        online_ids = {user.id for user in members}
+
+        html_event = online_count_event('room', online_ids)
+        with self.assertNumQueries(0):
+            data_event = online_count_event('room', online_ids, html=False)
+
+        # what a socket is sent: the whole partial, or the ids that changed
+        frame = protocol.encode('json', 'presence.delta', online=[members[0].id], offline=[], count=199)
+        self.assertLess(len(frame['text_data']) * 10, len(html_event['html']))
+        self.assertNotIn('html', data_event)
+
+    def test_notifications_and_chat_list(self):
+        message = GroupMessage.objects.create(body='hi', author=self.bob, group=self.room)
+        unread.message_created(message)
+
+        async def run():
+            [notis] = await loadtest.open_sockets(websocket_urlpatterns, '/ws/notifications/?protocol=json', [self.alice])
+            [status] = await loadtest.open_sockets(websocket_urlpatterns, '/ws/online-status/?protocol=json', [self.alice])
+            frames = [json.loads((await loadtest.next_frame(socket, 1))['text']) for socket in [notis, status]]
+            await database_sync_to_async(unread.mark_read)(self.alice, self.room)
+            await get_channel_layer().group_send(notification_group(self.alice.id), {'type': 'notification_handler'})
+            frames.append(json.loads((await loadtest.next_frame(notis, 1))['text']))
+            await loadtest.close_sockets([notis, status])
+            return frames
+
+        unread_frame, chats_frame, delta = async_to_sync(run)()
+        self.assertEqual(unread_frame['chats'], [{'id': self.room.id, 'room': 'room', 'name': 'Room', 'unread': 1}])
+        self.assertEqual(chats_frame['chats'][0]['preview'], 'hi')
+        self.assertEqual(delta, {'v': protocol.VERSION, 'type': 'unread.delta', 'changed': [], 'read': [self.room.id]})
+
+    def test_pages_opt_in(self):
+        self.client.force_login(self.alice)
+        self.assertNotContains(self.client.get(reverse('chatroom', args=['room'])), 'protocol=json')
+        with self.settings(CHAT_SOCKET_PROTOCOL='json'):
+            response = self.client.get(reverse('chatroom', args=['room']))
+        self.assertContains(response, '/ws/chatroom/room?protocol=json')
+        self.assertContains(response, 'js/chat_protocol.js')
+
+
+class BatchingTests(TestCase):
+
+    def setUp(self):
+        self.alice = User.objects.create(username='alice')
+        self.bob = User.objects.create(username='bob')
+        self.room = ChatGroup.objects.create(group_name='room', groupchat_name='Room')
+        self.room.members.add(self.alice, self.bob)
+        metrics.reset()
+
+    def send_burst(self, query):
+        async def run():
+            sockets = await loadtest.open_sockets(websocket_urlpatterns, '/ws/chatroom/room' + query, [self.alice, self.bob])
+            for communicator in sockets:
+                await loadtest.drain(communicator)
+
+            # events that reach the socket within the window share a frame
+            for body in ['one', 'two', 'three']:
+                await sockets[0].send_to(text_data=json.dumps({'body': body}))
+            await asyncio.sleep(0.1)
+            frames = []
+            while not await sockets[1].receive_nothing(0.05):
+                frames.append(await sockets[1].receive_output())
+            await loadtest.close_sockets(sockets)
+            return frames
+
+        with self.settings(CHAT_SOCKET_BATCH_WINDOW=0.05):
+            return async_to_sync(run)()
+
+    def test_data_frames_are_batched(self):
+        frames = self.send_burst('?protocol=json')
+        self.assertEqual(len(frames), 1)
+        frame = json.loads(frames[0]['text'])
+        self.assertEqual(frame['type'], 'batch')
+        self.assertEqual([inner['message']['body'] for inner in frame['frames']], ['one', 'two', 'three'])
+        self.assertGreater(metrics.get('socket.events'), metrics.get('socket.frames'))
+
+    def test_html_partials_are_concatenated(self):
+        frames = self.send_burst('')
+        self.assertEqual(len(frames), 1)
+        for body in ['one', 'two', 'three']:
+            self.assertIn(body, frames[0]['text'])
+        self.assertGreater(metrics.get('socket.bytes'), len(frames[0]['text']))
+
+    def test_compression_is_accepted_per_consumer(self):
+        from autobahn.websocket.compress import PerMessageDeflateOffer, PerMessageDeflateOfferAccept
+        from .consumers import ChatRoomConsumer, NotificationConsumer
+        from .server import accept_deflate, consumer_class
+
+        self.assertIs(consumer_class('/ws/chatroom/room'), ChatRoomConsumer)
+        self.assertIs(consumer_class('/ws/notifications/'), NotificationConsumer)
+        self.assertIsNone(consumer_class('/ws/unknown/'))
+        self.assertIsInstance(accept_deflate([PerMessageDeflateOffer()]), PerMessageDeflateOfferAccept)
+        self.assertIsNone(accept_deflate([]))
+
+
+class ReplayTests(TestCase):
+
+    def setUp(self):
+        self.alice = User.objects.create(username='alice')
+        self.bob = User.objects.create(username='bob')
+        self.room = ChatGroup.objects.create(group_name='room', groupchat_name='Room')
+        self.room.members.add(self.alice, self.bob)
+        metrics.reset()
+
+    def send(self, body):
+        return GroupMessage.objects.create(body=body, author=self.alice, group=self.room)
+
+    def reconnect(self, query, *since):
+        async def run():
+            [communicator] = await loadtest.open_sockets(websocket_urlpatterns, '/ws/chatroom/room' + query, [self.bob])
+            await loadtest.drain(communicator)
+            for value in since:
+                await communicator.send_to(text_data=json.dumps({'since': value}))
+            frames = []
+            while not await communicator.receive_nothing(0.1):
+                frames.append((await communicator.receive_output())['text'])
+            await loadtest.close_sockets([communicator])
+            return frames
+
+        with self.settings(CHAT_SOCKET_BATCH_WINDOW=0):
+            return async_to_sync(run)()
+
+    def test_sequence_numbers_per_room(self):
+        other = ChatGroup.objects.create(group_name='other')
+        first, second = self.send('one'), self.send('two')
+        third = GroupMessage.objects.create(body='elsewhere', author=self.alice, group=other)
+        self.assertEqual((first.seq, second.seq, third.seq), (1, 2, 1))
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.last_seq, 2)
+
+    def test_missed_messages_are_replayed(self):
+        seen = self.send('seen')
+        self.send('missed one')
+        self.send('missed two')
+
+        frames = [json.loads(frame) for frame in self.reconnect('?protocol=json', seen.seq)]
+        self.assertEqual([frame['message']['body'] for frame in frames], ['missed one', 'missed two'])
+        self.assertEqual([frame['message']['seq'] for frame in frames], [2, 3])
+        self.assertEqual(metrics.get('replay.messages'), 2)
+
+        with self.assertNumQueries(1):
+            history.replay(self.room.id, seen.seq)
+
+    def test_one_replay_per_socket(self):
+        seen = self.send('seen')
+        self.send('missed')
+        frames = [json.loads(frame) for frame in self.reconnect('?protocol=json', seen.seq, 0)]
+        self.assertEqual([frame['message']['body'] for frame in frames], ['missed'])
+
+    def test_live_messages_are_only_tracked_until_the_replay_limit(self):
+        for body in ['one', 'two', 'three']:
+            self.send(body)
+
+        async def run():
+            [communicator] = await loadtest.open_sockets(websocket_urlpatterns, '/ws/chatroom/room?protocol=json', [self.bob])
+            await loadtest.drain(communicator)
+            channel_layer = get_channel_layer()
+            for seq in range(10, 13):
+                await channel_layer.group_send('room', {
+                    'type': 'message_handler', 'message_id': seq, 'author_id': self.alice.id, 'data': {'seq': seq},
+                })
+            await loadtest.drain(communicator)
+            # too late, this socket is not tracked any more and gets no replay (nor a reload)
+            await communicator.send_to(text_data=json.dumps({'since': 0}))
+            frames = await loadtest.drain(communicator)
+            await loadtest.close_sockets([communicator])
+            return frames
+
+        with self.settings(CHAT_REPLAY_LIMIT=2, CHAT_SOCKET_BATCH_WINDOW=0):
+            self.assertEqual(async_to_sync(run)(), 0)
+
+    def test_html_replay(self):
+        seen = self.send('seen')
+        missed = self.send('missed')
+        [frame] = self.reconnect('', seen.seq)
+        self.assertIn('hx-swap-oob="beforeend"', frame)
+        self.assertIn(f'data-seq="{missed.seq}"', frame)
+        self.assertNotIn('>seen<', frame)
+
+    def test_large_gap_reloads(self):
+        for body in ['one', 'two', 'three']:
+            self.send(body)
+        with self.settings(CHAT_REPLAY_LIMIT=2):
+            frames = self.reconnect('?protocol=json', 0)
+        self.assertEqual([json.loads(frame)['type'] for frame in frames], ['reload'])
+        self.assertEqual(metrics.get('replay.reloads'), 1)
+
+    def test_backfill_command(self):
+        old = GroupMessage.objects.bulk_create([
+            GroupMessage(body=body, author=self.alice, group=self.room) for body in ['old one', 'old two']
+        ])
+        call_command('backfill_message_seq', stdout=io.StringIO())
+        new = self.send('new')
+        old_seqs = GroupMessage.objects.filter(id__in=[message.id for message in old]).order_by('id').values_list('seq', flat=True)
+        self.assertEqual((list(old_seqs), new.seq), ([1, 2], 3))
+
+
+class ParallelSequenceTests(TransactionTestCase):
+
+    def test_parallel_saves_get_unique_gap_free_numbers(self):
+        alice = User.objects.create(username='alice')
+        room = ChatGroup.objects.create(group_name='room')
+        barrier = threading.Barrier(8)
+
+        def write(writer):
+            try:
+                barrier.wait()
+                for i in range(10):
+                    while True:
+                        try:
+                            GroupMessage.objects.create(body=f'{writer} {i}', author=alice, group=room)
+                            break
+                        except OperationalError:
+                            # SQLite's in-memory test database fails a writer that would wait for the lock
+                            time.sleep(0.001)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=write, args=(writer,)) for writer in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # failed attempts took no number, and the numbers follow the commit order
+        seqs = list(GroupMessage.objects.order_by('id').values_list('seq', flat=True))
+        self.assertEqual(seqs, list(range(1, 81)))
+        room.refresh_from_db()
+        self.assertEqual(room.last_seq, 80)
+
+
+class ChannelLayerShardingTests(TestCase):
+
+    def test_ring_spreads_rooms(self):
+        ring = HashRing(['redis://a', 'redis://b', 'redis://c'])
+        rooms = [f'room-{index}' for index in range(3000)]
+        placed = [ring.index(room) for room in rooms]
+        self.assertEqual(placed, [ring.index(room) for room in rooms])
+        for index in range(3):
+            self.assertGreater(placed.count(index), 700)
+
+    def test_adding_a_host_moves_only_its_share(self):
+        before = HashRing(['redis://a', 'redis://b', 'redis://c'])
+        after = HashRing(['redis://a', 'redis://b', 'redis://c', 'redis://d'])
+        rooms = [f'room-{index}' for index in range(3000)]
+        moved = [room for room in rooms if before.node(room) != after.node(room)]
+        self.assertLess(len(moved), 1000)
+        self.assertTrue(all(after.node(room) == 'redis://d' for room in moved))
+
+    def test_layers_use_the_ring(self):
+        hosts = ['redis://a:6379', 'redis://b:6379']
+        ring = HashRing(hosts)
+        core = ShardedRedisChannelLayer(hosts=hosts)
+        pubsub = ShardedRedisPubSubLoopLayer(hosts=list(reversed(hosts)))
+        for room in ['public-chat', 'room-1', 'room-2', 'room-3']:
+            self.assertEqual(core.consistent_hash(room), ring.index(room))
+            # placed by address, not by position in the list
+            self.assertEqual(pubsub._get_shard(room).host['address'], ring.node(room))
+
+
+class BenchmarkTests(TestCase):
+
+    def setUp(self):
+        self.users = benchmarks.create_users(3)
+
+    def test_connect_storm(self):
+        result = async_to_sync(benchmarks.connect_storm)(self.users)
+        self.assertEqual(result['connected'], 3)
+        self.assertGreater(result['memory_per_socket_kb'], 0)
+        self.assertIsNotNone(result['p99_ms'])
+
+    def test_message_fanout(self):
+        result = async_to_sync(benchmarks.message_fanout)(self.users, 2)
+        self.assertEqual(result['deliveries_lost'], 0)
+        self.assertGreater(result['queries_per_message'], 0)
+        self.assertIsNotNone(result['p50_ms'])
+
+    def test_chat_view_render(self):
+        result = benchmarks.chat_view_render(self.users, 5, 2)
+        self.assertGreater(result['cold_queries'], 0)
+        self.assertEqual(result['requests'], 2)
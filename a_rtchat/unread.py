@@ -0,0 +1,114 @@
+from django.contrib.auth.models import User
+from django.db.models import Count, F, Q, Subquery
+from django.db.models.functions import Coalesce
+from .models import ChatMember, GroupMessage, members_with_profiles
+from . import inbox
+
+
+# Creates the ChatMember rows for users that joined a group.
+# New members start with everything already read.
+def add_members(group_ids, user_ids):
+    latest = {}
+    for group_id in group_ids:
+        latest[group_id] = GroupMessage.objects.filter(group_id=group_id).first()
+
+    ChatMember.objects.bulk_create(
+        [
+            ChatMember(
+                group_id=group_id, user_id=user_id,
+                last_read_message_id=latest[group_id].id if latest[group_id] else None,
+                **inbox.last_message_fields(latest[group_id]),
+            )
+            for group_id in group_ids for user_id in user_ids
+        ],
+        ignore_conflicts=True,
+    )
+
+
+def remove_members(group_ids, user_ids):
+    ChatMember.objects.filter(group_id__in=group_ids, user_id__in=user_ids).delete()
+
+
+# A new message is unread for every other member and read for its author.
+# Two UPDATE statements no matter how many members the group has.
+def message_created(message):
+    last_message = {'last_message_preview': inbox.preview(message), 'last_message_at': message.created}
+    ChatMember.objects.filter(group_id=message.group_id).exclude(user_id=message.author_id).update(
+        unread_count=F('unread_count') + 1, **last_message
+    )
+    ChatMember.objects.filter(group_id=message.group_id, user_id=message.author_id).update(
+        last_read_message_id=message.id, unread_count=0, **last_message
+    )
+
+
+# Same as message_created() for a batch of saved messages, in one UPDATE per
+# group plus one per author of the batch
+def messages_created(messages):
+    by_group = {}
+    for message in messages:
+        by_group.setdefault(message.group_id, []).append(message)
+
+    for group_id, group_messages in by_group.items():
+        # an author has read up to their last message, the newer ones of others are unread
+        authors = {}
+        for position, message in enumerate(group_messages):
+            authors[message.author_id] = position
+
+        newest = group_messages[-1]
+        last_message = {'last_message_preview': inbox.preview(newest), 'last_message_at': newest.created}
+
+        ChatMember.objects.filter(group_id=group_id).exclude(user_id__in=authors).update(
+            unread_count=F('unread_count') + len(group_messages), **last_message
+        )
+        for author_id, position in authors.items():
+            newer = [message for message in group_messages[position + 1:] if message.author_id != author_id]
+            ChatMember.objects.filter(group_id=group_id, user_id=author_id).update(
+                last_read_message_id=group_messages[position].id, unread_count=len(newer), **last_message
+            )
+
+
+# Moves the user's read cursor forward to `message_id` and recounts what is
+# left unread above it, as a single UPDATE. The cursor never moves back.
+# Returns True if the cursor moved.
+def mark_read_up_to(user, group_id, message_id):
+    unread_messages = GroupMessage.objects.filter(
+        group_id=group_id, id__gt=message_id,
+    ).exclude(
+        author_id=user.id,
+    ).order_by().values('group_id').annotate(count=Count('id')).values('count')
+
+    return bool(ChatMember.objects.filter(group_id=group_id, user_id=user.id).filter(
+        Q(last_read_message_id__lt=message_id) | Q(last_read_message_id__isnull=True)
+    ).update(
+        last_read_message_id=message_id,
+        unread_count=Coalesce(Subquery(unread_messages), 0),
+    ))
+
+
+# The user has seen every message of the group
+def mark_read(user, group):
+    latest_id = group.chat_messages.values_list('id', flat=True).first()
+    if latest_id is None:
+        return False
+    return mark_read_up_to(user, group.id, latest_id)
+
+
+# Members whose read cursor is at or past the message
+def readers(message):
+    return User.objects.filter(
+        chat_states__group_id=message.group_id,
+        chat_states__last_read_message_id__gte=message.id,
+    ).exclude(id=message.author_id)
+
+
+# Groups of the user with unread messages. One row per group, so the cost
+# depends on the number of groups and not on the number of unread messages
+def states_for(user):
+    return ChatMember.objects.filter(user=user, unread_count__gt=0).exclude(
+        group__group_name='public-chat'
+    ).select_related('group').order_by('-group_id')
+
+
+# member names are only needed for the entries that are rendered
+def members_prefetch():
+    return members_with_profiles('group__members')
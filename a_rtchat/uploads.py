@@ -0,0 +1,128 @@
+"""
+Limits and spooling for chat file uploads.
+
+Uploads are checked as early as possible: the ASGI middleware turns away
+request bodies that are too large before they are read, the upload handler
+stops the multipart parser as soon as the file goes over the size limit or
+announces a type that is not allowed. Accepted files are streamed to a temp
+file on disk and moved to a spool directory, from where a background worker
+writes them to storage.
+"""
+
+import fnmatch
+import os
+import shutil
+import uuid
+
+from django.conf import settings
+from django.core.files.uploadhandler import FileUploadHandler, StopUpload, TemporaryFileUploadHandler
+from django.urls import Resolver404, resolve
+
+# room for the csrf token and the multipart boundaries around the file
+FORM_OVERHEAD = 64 * 1024
+
+
+def is_allowed_type(content_type):
+    return any(fnmatch.fnmatch(content_type or '', pattern) for pattern in settings.CHAT_UPLOAD_ALLOWED_TYPES)
+
+
+class LimitedUploadHandler(FileUploadHandler):
+    """
+    Passes the file on to the next handler while it stays within the limits,
+    otherwise stops reading the upload and keeps the reason in `error`.
+    """
+
+    def __init__(self, request=None):
+        super().__init__(request)
+        self.error = None
+        self.status = None
+
+    def stop(self, error, status):
+        self.error, self.status = error, status
+        raise StopUpload(connection_reset=True)
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        if not is_allowed_type(self.content_type):
+            self.stop('This file type is not allowed.', 415)
+
+    def receive_data_chunk(self, raw_data, start):
+        if start + len(raw_data) > settings.CHAT_UPLOAD_MAX_SIZE:
+            self.stop('This file is too large.', 413)
+        return raw_data
+
+    def file_complete(self, file_size):
+        return None
+
+
+# Upload handlers for the chat upload view, files always go to a temp file on disk
+def upload_handlers(request):
+    return [LimitedUploadHandler(request), TemporaryFileUploadHandler(request)]
+
+
+# Moves an uploaded temp file out of the request, it is deleted with the request otherwise
+def spool(upload):
+    os.makedirs(settings.CHAT_UPLOAD_SPOOL_DIR, exist_ok=True)
+    path = os.path.join(settings.CHAT_UPLOAD_SPOOL_DIR, uuid.uuid4().hex)
+    shutil.move(upload.temporary_file_path(), path)
+    return path
+
+
+def is_upload_path(path):
+    try:
+        return resolve(path).url_name == 'chat-file-upload'
+    except Resolver404:
+        return False
+
+
+class UploadSizeLimitMiddleware:
+    """
+    ASGI middleware answering chat uploads that are larger than the upload
+    limit with 413, before their body is read into the server. Other forms
+    (like the avatar upload) are left to their views.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope['method'] != 'POST':
+            return await self.app(scope, receive, send)
+
+        headers = dict(scope['headers'])
+        if not headers.get(b'content-type', b'').startswith(b'multipart/form-data') or not is_upload_path(scope['path']):
+            return await self.app(scope, receive, send)
+
+        limit = settings.CHAT_UPLOAD_MAX_SIZE + FORM_OVERHEAD
+        try:
+            content_length = int(headers.get(b'content-length', b''))
+        except ValueError:
+            content_length = None
+        if content_length is not None and content_length > limit:
+            return await self.reject(send)
+
+        # without a content length the body is counted while it streams in
+        received = 0
+        too_large = False
+
+        async def limited_receive():
+            nonlocal received, too_large
+            message = await receive()
+            if message['type'] == 'http.request':
+                received += len(message.get('body', b''))
+                if received > limit:
+                    too_large = True
+                    return {'type': 'http.disconnect'}
+            return message
+
+        await self.app(scope, limited_receive, send)
+        if too_large:
+            await self.reject(send)
+
+    async def reject(self, send):
+        await send({
+            'type': 'http.response.start',
+            'status': 413,
+            'headers': [(b'content-type', b'text/plain; charset=utf-8')],
+        })
+        await send({'type': 'http.response.body', 'body': b'This file is too large.'})
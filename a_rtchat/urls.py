@@ -5,10 +5,13 @@ urlpatterns = [
     path('', chat_view, name="home"),
     path('chat/<username>',get_or_create_chatroom, name="start-chat"),
     path('chat/room/<chatroom_name>', chat_view, name="chatroom"),
+    path('chat/room/<chatroom_name>/history', chat_history, name="chat-history"),
     path('chat/new_groupchat/',create_groupchat,name='new-groupchat'),
     path('chat/edit/<chatroom_name>' , chatroom_edit_view, name="edit-chatroom"),
     path('chat/delete/<chatroom_name>' , chatroom_delete_view, name="chatroom-delete"),
     path('chat/leave/<chatroom_name>' , chatroom_leave_view, name="chatroom-leave"),
     path('chat/fileupload/<chatroom_name>',chat_file_upload, name="chat-file-upload"),
-    path('notifications/mark_seen/<int:message_id>/', mark_seen, name='mark_seen'),
+    path('chat/metrics/', chat_metrics, name='chat-metrics'),
+    path('chat/search/', chat_search, name='chat-search'),
+    path('notifications/mark_read/<chatroom_name>/<int:message_id>/', mark_read, name='mark-read'),
 ]
\ No newline at end of file
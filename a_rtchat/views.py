@@ -3,31 +3,42 @@ from django.contrib import messages
 from .models import *
 from django.contrib.auth.decorators import login_required
 from .forms import ChatMessageCreateForm, NewGroupForm, ChatRoomEditForm
+from .broadcast import message_event
+from . import access, fragments, history, metrics, notifications, search, tasks, unread, uploads, workers
+from .presence import get_presence
 from django.http import Http404, HttpResponse, JsonResponse
 from channels.layers import get_channel_layer
 from asgiref.sync import async_to_sync
 from django.views.decorators.http import require_POST
+from django.views.decorators.csrf import csrf_exempt, csrf_protect
 import json
 from django.urls import reverse
+from django.conf import settings
+from django.db import transaction
 
 
 @login_required
 def chat_view(request, chatroom_name = 'public-chat'):
-    chat_group = get_object_or_404(ChatGroup, group_name=chatroom_name)
-    chat_messages = chat_group.chat_messages.all()[:100]
+    # members and their profiles are loaded once for the whole page
+    chat_group = get_object_or_404(
+        ChatGroup.objects.prefetch_related(members_with_profiles()),
+        group_name=chatroom_name
+    )
+    chat_messages, older_cursor = history.get_page(chat_group, size=settings.CHAT_HISTORY_FIRST_PAGE)
     form = ChatMessageCreateForm()
 
+    members = chat_group.members.all()
     other_user = None
 
     # if this chatroom is private
     if chat_group.is_private:
 
         # make sure user is in the chatroom
-        if request.user not in chat_group.members.all():
+        if not access.is_member(chat_group, request.user):
             raise Http404() 
         
         # find the other user
-        for member in chat_group.members.all():
+        for member in members:
             if member != request.user:
                 other_user = member
                 break
@@ -35,12 +46,12 @@ def chat_view(request, chatroom_name = 'public-chat'):
     if chat_group.groupchat_name:
 
         # Banned logic for groupchats
-        if request.user in chat_group.banned_users.all():
+        if access.is_banned(chat_group, request.user):
             messages.warning(request, "You have been banned from this group.")
             return redirect('home')  # Redirect to a safe page
 
         # Add user to groupchat
-        if request.user not in chat_group.members.all():
+        if not access.is_member(chat_group, request.user):
             if request.user.emailaddress_set.filter(verified=True).exists():
                 chat_group.members.add(request.user)
             else:
@@ -55,15 +66,23 @@ def chat_view(request, chatroom_name = 'public-chat'):
             new_message.author = request.user
             new_message.group = chat_group
             new_message.save()
+            unread.message_created(new_message)
             context = {
                 'message':new_message,
                 'user':request.user,
+                'author_online':True,
 
             }
             return render(request, 'a_rtchat/partials/chat_message_p.html', context)
         
+    # opening the chat reads everything in it
+    if unread.mark_read(request.user, chat_group):
+        async_to_sync(notifications.dispatcher.notify)([request.user.id])
+
     context = {
         'chat_messages':chat_messages,
+        'message_html':fragments.render_messages(chat_messages[::-1], request.user),
+        'older_cursor':older_cursor,
         'form':form,
         'other_user':other_user,
         'chatroom_name':chatroom_name,
@@ -72,6 +91,47 @@ def chat_view(request, chatroom_name = 'public-chat'):
         
     return render(request, 'a_rtchat/chat.html', context) 
 
+# older messages of a chatroom, loaded by the infinite scroll in chat.html
+@login_required
+def chat_history(request, chatroom_name):
+    chat_group = get_object_or_404(ChatGroup, group_name=chatroom_name)
+
+    # make sure user may read the chatroom
+    if not access.can_join(chat_group, request.user):
+        raise Http404()
+
+    before = history.decode_cursor(request.GET.get('before'))
+    if before is None:
+        raise Http404()
+
+    chat_messages, older_cursor = history.get_page(chat_group, before=before)
+    context = {
+        'chat_messages':chat_messages,
+        'message_html':fragments.render_messages(chat_messages[::-1], request.user),
+        'older_cursor':older_cursor,
+        'chat_group':chat_group,
+    }
+    return render(request, 'a_rtchat/partials/chat_history.html', context)
+
+# messages matching the search box in the header, in the user's rooms only
+@login_required
+def chat_search(request):
+    query = request.GET.get('q', '').strip()
+    before = None
+    if 'before' in request.GET:
+        before = history.decode_cursor(request.GET['before'])
+        if before is None:
+            raise Http404()
+
+    results, older_cursor = search.search(request.user, query, before=before)
+    context = {
+        'results':results,
+        'older_cursor':older_cursor,
+        'query':query,
+        'first_page':before is None,
+    }
+    return render(request, 'a_rtchat/partials/search_results.html', context)
+
 @login_required
 def get_or_create_chatroom(request, username):
     if request.user.username == username:
@@ -80,26 +140,14 @@ def get_or_create_chatroom(request, username):
     # fetching user object and binding it to other_user
     other_user = User.objects.get(username=username)
 
-    # checking if chatroom exists between the two users already
-    my_chatrooms = request.user.chat_groups.filter(is_private = True)
-    
-    # if private chatroom exists
-    if my_chatrooms.exists():
-        for chatroom in my_chatrooms:
-
-            # if chatroom exists, bind it to chatroom
-            if other_user in chatroom.members.all():
-                chatroom = chatroom
-                break
+    # one private chatroom per pair of users, found through its unique key.
+    # a request racing this one waits on the key and then gets the same room
+    with transaction.atomic():
+        chatroom, _ = ChatGroup.objects.get_or_create(
+            dm_key=dm_key_for(request.user, other_user), defaults={'is_private': True}
+        )
 
-            # if chatroom doesn't exist, create it
-            else:
-                chatroom = ChatGroup.objects.create(is_private=True)
-                chatroom.members.add(other_user,request.user)
-    
-    # if private chatroom doesn't exist, create it
-    else:
-        chatroom = ChatGroup.objects.create(is_private=True)
+        # new room, or either of them left it before, add() skips who is in it
         chatroom.members.add(other_user,request.user)
 
     return redirect('chatroom',chatroom.group_name)
@@ -128,7 +176,13 @@ def create_groupchat(request):
 # chatroom edit feature for admin
 @login_required
 def chatroom_edit_view(request, chatroom_name):
-    chat_group = get_object_or_404(ChatGroup, group_name=chatroom_name)
+    chat_group = get_object_or_404(
+        ChatGroup.objects.prefetch_related(
+            members_with_profiles(),
+            members_with_profiles('banned_users'),
+        ),
+        group_name=chatroom_name
+    )
 
     # if not admin then show error
     if request.user != chat_group.admin:
@@ -146,8 +200,7 @@ def chatroom_edit_view(request, chatroom_name):
 
             # Ban logic
             ban_members = request.POST.getlist('ban_members')
-            for member_id in ban_members:
-                member = User.objects.get(id=member_id)
+            for member in User.objects.filter(id__in=ban_members):
                 chat_group.ban_user(member)  # Calls the `ban_user` method in the model 
 
                 # Notify frontend via WebSockets
@@ -161,19 +214,17 @@ def chatroom_edit_view(request, chatroom_name):
             
             # Unban logic 
             unban_members = request.POST.getlist('unban_members')
-            for member_id in unban_members:
-                member = User.objects.get(id=member_id)
-                if member in chat_group.banned_users.all():
-                    chat_group.banned_users.remove(member)  # Remove from ban list
-                    
-                    # Notify frontend via WebSockets
-                    async_to_sync(channel_layer.group_send)(
-                        chat_group.group_name,
-                        {
-                            "type": "user_unbanned",
-                            "user_id": member.id,
-                        }
-                    )
+            for member in list(chat_group.banned_users.filter(id__in=unban_members)):
+                chat_group.banned_users.remove(member)  # Remove from ban list
+                
+                # Notify frontend via WebSockets
+                async_to_sync(channel_layer.group_send)(
+                    chat_group.group_name,
+                    {
+                        "type": "user_unbanned",
+                        "user_id": member.id,
+                    }
+                )
 
             return redirect('chatroom', chatroom_name)
         
@@ -211,47 +262,72 @@ def chatroom_leave_view(request, chatroom_name):
     
     return redirect('chatroom', chatroom_name)
 
-# upload file view
+# upload file view, the upload is streamed to a temp file and checked against
+# the size and type limits while it is read (see uploads.py)
+@csrf_exempt
+@login_required
 def chat_file_upload(request,chatroom_name):
+    request.upload_handlers = uploads.upload_handlers(request)
+    return _chat_file_upload(request, chatroom_name)
+
+@csrf_protect
+def _chat_file_upload(request,chatroom_name):
     chat_group = get_object_or_404(ChatGroup,group_name=chatroom_name)
 
-    # HTMX specified requests
-    if request.htmx and request.FILES:
+    # only users that may open the chatroom can post to it
+    if not access.can_join(chat_group, request.user):
+        raise Http404()
 
-        # uploading the file
-        file = request.FILES['file']
+    # HTMX specified requests
+    if request.htmx and request.method == 'POST':
+
+        # uploading the file, stopped early if the upload handler turned it away
+        file = request.FILES.get('file')
+        limits = request.upload_handlers[0]
+        if limits.error:
+            return HttpResponse(limits.error, status=limits.status)
+        if file is None:
+            return HttpResponse(status=400)
+
+        # the upload is inspected once here and never on render, the browser's
+        # content type is only a hint
+        message = GroupMessage(file=file,author=request.user,group=chat_group)
+        message.read_file_metadata()
+        if not uploads.is_allowed_type(message.content_type):
+            return HttpResponse('This file type is not allowed.', status=415)
+
+        # the storage write happens in the background, the message is created
+        # and broadcast by the worker once the file is stored
+        metadata = {
+            'content_type': message.content_type,
+            'width': message.width,
+            'height': message.height,
+            'size': message.size,
+        }
+        workers.submit(
+            tasks.store_upload, uploads.spool(file), file.name, request.user.id, chat_group.id, metadata
+        )
+        return HttpResponse(status=202)
 
-        # creating group message
-        message = GroupMessage.objects.create(file=file,author=request.user,group=chat_group)
+# mark everything in a chat read up to a message, one UPDATE on the read cursor
+@login_required
+@require_POST
+def mark_read(request, chatroom_name, message_id):
+    chat_group = get_object_or_404(ChatGroup, group_name=chatroom_name)
 
+    # Make sure the message belongs to this chat group
+    if not chat_group.chat_messages.filter(id=message_id).exists():
+        raise Http404()
 
-        # retrieve channel layer instance
-        channel_layer = get_channel_layer()
-        event = {
-            'type':'message_handler',
-            'message_id':message.id,
-        }
+    if unread.mark_read_up_to(request.user, chat_group.id, message_id):
+        async_to_sync(notifications.dispatcher.notify)([request.user.id])
 
-        # calling the group_send fucntion to broadcast to everyone in the chat room
-        async_to_sync(channel_layer.group_send)(
-            chatroom_name,event
-        )
+    return HttpResponse(status=204)
 
-        return HttpResponse()
-    
+# counters of this worker for tuning the real-time paths
 @login_required
-def mark_seen(request, message_id):
-    # Make sure the message belongs to one of the user's chat groups
-    message = get_object_or_404(
-        GroupMessage,
-        id=message_id,
-        group__in=request.user.chat_groups.all()
-    )
-    message.is_seen = True
-    message.save()
-
-    # Prepare a response with an HX-Redirect header to redirect to the chatroom
-    response = HttpResponse(status=204)
-    redirect_url = reverse('chatroom', args=[message.group.group_name])
-    response['HX-Redirect'] = redirect_url
-    return response
\ No newline at end of file
+def chat_metrics(request):
+    if not request.user.is_staff:
+        raise Http404()
+    return JsonResponse(metrics.snapshot())
+
@@ -0,0 +1,76 @@
+"""
+Background worker pool for slow work that should not hold up a request,
+like resizing images or writing uploads to storage.
+
+Jobs run in a shared thread pool of settings.CHAT_WORKERS threads. With
+settings.CHAT_WORKERS_EAGER they run inline instead, which is what tests
+use to check the results right after the request.
+
+Async state like the notification dispatcher or the redis clients of the
+presence service belongs to the server's event loop, jobs hand that work
+back to it with on_loop().
+"""
+
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.db import close_old_connections, transaction
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+# the event loop of the server, see track_loop()
+_loop = None
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=settings.CHAT_WORKERS, thread_name_prefix='chat-worker')
+    return _executor
+
+
+def run(func, *args):
+    try:
+        return func(*args)
+    except Exception:
+        logger.exception('background job %s failed', func.__name__)
+    finally:
+        # worker threads are not request threads, release their connections here
+        if not settings.CHAT_WORKERS_EAGER:
+            close_old_connections()
+
+
+# Runs func(*args) in the pool
+def submit(func, *args):
+    if settings.CHAT_WORKERS_EAGER:
+        run(func, *args)
+        return
+    get_executor().submit(run, func, *args)
+
+
+# Runs func(*args) in the pool once the current transaction commits,
+# so the job sees the rows written by the request
+def on_commit(func, *args):
+    transaction.on_commit(lambda: submit(func, *args))
+
+
+# ASGI middleware remembering the server's event loop for on_loop()
+def track_loop(application):
+    async def app(scope, receive, send):
+        global _loop
+        _loop = asyncio.get_running_loop()
+        return await application(scope, receive, send)
+    return app
+
+
+# Runs coroutine_function(*args) on the server's event loop from a job and
+# waits for its result. Without a running server loop (tests, management
+# commands) it runs on a loop of its own.
+def on_loop(coroutine_function, *args):
+    if _loop is None or not _loop.is_running():
+        return async_to_sync(coroutine_function)(*args)
+    return asyncio.run_coroutine_threadsafe(coroutine_function(*args), _loop).result()
@@ -0,0 +1,170 @@
+"""
+Write-behind persistence of chat messages, on with settings.CHAT_WRITE_BEHIND.
+
+A message from a socket is validated in memory and broadcast right away
+under a provisional id. It is then queued and saved with bulk_create in
+batches, every CHAT_WRITE_BEHIND_INTERVAL seconds or as soon as
+CHAT_WRITE_BEHIND_BATCH messages are waiting. The sequence numbers of a
+room's messages in a batch are taken at once, in the transaction that
+saves them. Once a batch is committed the rooms are told the real id and
+sequence number of their newest message (read cursors only ever use real
+ids) and the members get their notification update.
+
+A batch that cannot be saved is logged, counted as writebehind.failures
+and put back at the front of the queue to be retried with the next one.
+Whatever is still queued when the process exits is saved by close().
+"""
+
+import asyncio
+import atexit
+import logging
+import threading
+import uuid
+
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from . import metrics, notifications, unread
+from .models import ChatGroup, GroupMessage
+
+logger = logging.getLogger(__name__)
+
+# A message ready to be broadcast and queued, not saved yet
+def prepare_message(body, author, group):
+    message = GroupMessage(body=body, author=author, group=group, created=timezone.now())
+    # the author and group are the socket's own, no need to look them up again
+    message.full_clean(exclude=['author', 'group'])
+    message.provisional_id = f'p-{uuid.uuid4().hex}'
+    return message
+
+
+# Saves a batch in one transaction.
+# Returns {group_name: (newest id, newest seq, member ids to notify)}
+def persist(messages):
+    by_group = {}
+    for message in messages:
+        by_group.setdefault(message.group_id, []).append(message)
+
+    with transaction.atomic():
+        # one range of sequence numbers per room and batch
+        for group_messages in by_group.values():
+            first_seq = group_messages[0].group.allocate_seq(len(group_messages))
+            for offset, message in enumerate(group_messages):
+                message.seq = first_seq + offset
+        GroupMessage.objects.bulk_create(messages)
+        unread.messages_created(messages)
+
+    members = {}
+    for group_id, user_id in ChatGroup.members.through.objects.filter(
+        chatgroup_id__in=by_group
+    ).values_list('chatgroup_id', 'user_id'):
+        members.setdefault(group_id, set()).add(user_id)
+
+    persisted = {}
+    for group_id, group_messages in by_group.items():
+        # every member has something new except the author of the newest message
+        newest = group_messages[-1]
+        persisted[newest.group.group_name] = (
+            newest.id, newest.seq, sorted(members.get(group_id, set()) - {newest.author_id})
+        )
+    return persisted
+
+
+class MessageWriter:
+    """
+    Queue of messages waiting to be saved. add() and flush() run on the
+    event loop, the database work runs in the database thread.
+    """
+
+    def __init__(self, interval=None, batch_size=None):
+        self._interval = interval
+        self._batch_size = batch_size
+        self.lock = threading.Lock()
+        self.pending = []
+        self.loop = None
+        self.timer = None
+
+    @property
+    def interval(self):
+        if self._interval is None:
+            return settings.CHAT_WRITE_BEHIND_INTERVAL
+        return self._interval
+
+    @property
+    def batch_size(self):
+        if self._batch_size is None:
+            return settings.CHAT_WRITE_BEHIND_BATCH
+        return self._batch_size
+
+    async def add(self, message):
+        loop = asyncio.get_running_loop()
+
+        # timers from another (closed) event loop never fire, the queue is kept
+        if self.loop is not loop:
+            self.loop = loop
+            self.timer = None
+
+        with self.lock:
+            self.pending.append(message)
+            waiting = len(self.pending)
+
+        if waiting >= self.batch_size:
+            await self.flush()
+        elif self.timer is None:
+            self.timer = loop.call_later(self.interval, lambda: asyncio.ensure_future(self.flush()))
+
+    def take(self):
+        with self.lock:
+            batch, self.pending = self.pending, []
+        return batch
+
+    # Logs why a batch failed and puts it back in front of what was queued
+    # since, called from the except block
+    def requeue(self, batch):
+        logger.exception('saving %d chat messages failed, they stay queued', len(batch))
+        metrics.incr('writebehind.failures')
+        # ids bulk_create may have set before the transaction rolled back
+        for message in batch:
+            message.id = None
+        with self.lock:
+            self.pending[:0] = batch
+
+    async def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+        batch = self.take()
+        if not batch:
+            return
+        try:
+            persisted = await database_sync_to_async(persist)(batch)
+        except Exception:
+            self.requeue(batch)
+            if self.timer is None:
+                self.timer = asyncio.get_running_loop().call_later(self.interval, lambda: asyncio.ensure_future(self.flush()))
+            return
+        metrics.incr('writebehind.batches')
+        metrics.incr('writebehind.messages', len(batch))
+
+        channel_layer = get_channel_layer()
+        for group_name, (last_id, last_seq, member_ids) in persisted.items():
+            await channel_layer.group_send(group_name, {'type': 'messages_persisted', 'last_id': last_id, 'last_seq': last_seq})
+            await notifications.dispatcher.notify(member_ids)
+
+    # Saves what is still queued, without broadcasting. Called at exit.
+    def close(self):
+        batch = self.take()
+        if not batch:
+            return
+        try:
+            persist(batch)
+        except Exception:
+            self.requeue(batch)
+
+
+writer = MessageWriter()
+atexit.register(writer.close)
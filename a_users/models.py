@@ -1,12 +1,15 @@
 from django.db import models
 from django.contrib.auth.models import User
 from django.conf import settings
+from a_rtchat import images
 
 class Profile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
     image = models.ImageField(upload_to='avatars/', null=True, blank=True)
+    image_variants = models.JSONField(default=dict, blank=True) # resized copies of the avatar, see a_rtchat/images.py
     displayname = models.CharField(max_length=20, null=True, blank=True)
     info = models.TextField(null=True, blank=True) 
+    version = models.PositiveIntegerField(default=0) # bumped on every change, keys the cached chat messages
     
     def __str__(self):
         return str(self.user)
@@ -28,4 +31,12 @@ class Profile(models.Model):
                 bucket_name = settings.AWS_STORAGE_BUCKET_NAME
                 region = settings.AWS_S3_REGION_NAME
                 return f"https://{bucket_name}.s3.{region}.amazonaws.com/{self.image.name}"
-        return f'{settings.STATIC_URL}images/avatar.svg'
\ No newline at end of file
+        return f'{settings.STATIC_URL}images/avatar.svg'
+
+    @property
+    def avatar_webp_srcset(self):
+        return images.srcset(self.image.storage, self.image_variants, 'webp')
+
+    @property
+    def avatar_jpeg_srcset(self):
+        return images.srcset(self.image.storage, self.image_variants, 'jpeg')
\ No newline at end of file
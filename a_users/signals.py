@@ -1,4 +1,5 @@
 from django.dispatch import receiver
+from django.db.models import F
 from django.db.models.signals import post_save, pre_save
 from allauth.account.models import EmailAddress
 from django.contrib.auth.models import User
@@ -14,6 +15,10 @@ def user_postsave(sender, instance, created, **kwargs):
             user = user,
         )
     else:
+        # the username is shown in cached chat messages, logins only touch last_login
+        if kwargs.get('update_fields') != frozenset(['last_login']):
+            Profile.objects.filter(user=user).update(version=F('version') + 1)
+
         # update allauth emailaddress if exists 
         try:
             email_address = EmailAddress.objects.get_primary(user)
@@ -34,4 +39,11 @@ def user_postsave(sender, instance, created, **kwargs):
 @receiver(pre_save, sender=User)
 def user_presave(sender, instance, **kwargs):
     if instance.username:
-        instance.username = instance.username.lower()
\ No newline at end of file
+        instance.username = instance.username.lower()
+
+
+# cached chat messages of the user are rendered again after any change
+@receiver(pre_save, sender=Profile)
+def profile_presave(sender, instance, **kwargs):
+    if instance.pk:
+        instance.version += 1
@@ -7,6 +7,7 @@ from django.contrib.auth.models import User
 from django.contrib.auth.views import redirect_to_login
 from django.contrib import messages
 from .forms import *
+from a_rtchat import tasks, workers
 
 def profile_view(request, username=None):
     if username:
@@ -26,7 +27,15 @@ def profile_edit_view(request):
     if request.method == 'POST':
         form = ProfileForm(request.POST, request.FILES, instance=request.user.profile)
         if form.is_valid():
-            form.save()
+            profile = form.save(commit=False)
+
+            # a new avatar gets its resized variants built in the background
+            if 'image' in form.changed_data:
+                old_variants, profile.image_variants = profile.image_variants, {}
+            profile.save()
+            if 'image' in form.changed_data:
+                # the old variants stay until the save is committed and the new ones are built
+                workers.on_commit(tasks.build_avatar_variants, profile.id, profile.image.name or None, old_variants)
             return redirect('profile')
         
     if request.path == reverse('profile-onboarding'):
@@ -0,0 +1,237 @@
+// Renders the data frames of the chat sockets opened with ?protocol=json,
+// see a_rtchat/protocol.py for the frame types. Html frames are left to htmx.
+(function () {
+    const VERSION = 2;
+    const onlineRooms = new Set();
+
+    function el(tag, className, text) {
+        const node = document.createElement(tag);
+        if (className) node.className = className;
+        if (text !== undefined && text !== null) node.textContent = text;
+        return node;
+    }
+
+    function setDot(node, online, offClass) {
+        if (!node) return;
+        node.classList.remove('green-dot', offClass);
+        node.classList.add(online ? 'green-dot' : offClass);
+    }
+
+    function profileUrl(username) {
+        return '/@' + encodeURIComponent(username) + '/';
+    }
+
+    function messageContent(message) {
+        const file = message.file;
+        if (message.body) return el('span', '', message.body);
+        if (file && file.content_type && file.content_type.startsWith('image/')) {
+            const link = el('a', 'lightbox-link');
+            link.href = file.url;
+            link.dataset.lightbox = 'chat-images';
+            link.dataset.title = file.name;
+            const img = el('img', 'max-w-72 min-w-8 rounded-lg');
+            img.src = file.url;
+            img.alt = file.name;
+            link.appendChild(img);
+            return link;
+        }
+        const wrapper = el('span', '', '\u{1F4CE} ');
+        const link = el('a', 'cursor-pointer italic hover:underline', file ? file.name : '');
+        if (file) link.href = file.url;
+        link.setAttribute('download', '');
+        wrapper.appendChild(link);
+        return wrapper;
+    }
+
+    // same markup as a_rtchat/chat_message.html
+    function renderMessage(frame) {
+        const list = document.getElementById('chat_messages');
+        if (!list) return;
+        const message = frame.message;
+        const item = el('li', frame.mine ? 'flex justify-end mb-4' : '');
+        if (message.seq) item.dataset.seq = message.seq;
+
+        if (frame.mine) {
+            const bubble = el('div', 'bg-green-200 rounded-l-lg rounded-tr-lg p-4 max-w-[75%]');
+            bubble.appendChild(messageContent(message));
+            item.appendChild(bubble);
+        } else {
+            const row = el('div', 'flex justify-start');
+            const avatarLink = el('a', 'flex items-end mr-2');
+            avatarLink.href = profileUrl(message.author.username);
+            const avatar = el('div', 'relative');
+            const dot = el('div', 'green-dot border-2 border-gray-800 absolute -bottom-1 right-1');
+            dot.id = 'user-' + message.author.id;
+            const img = el('img', 'w-8 h-8 rounded-full object-cover');
+            img.src = message.author.avatar;
+            avatar.append(dot, img);
+            avatarLink.appendChild(avatar);
+            const bubble = el('div', 'bg-white p-4 max-w-[75%] rounded-r-lg rounded-tl-lg');
+            bubble.appendChild(messageContent(message));
+            row.append(avatarLink, bubble);
+
+            const name = el('div', 'text-sm font-light py-1 ml-10');
+            name.append(el('span', 'text-white', message.author.name), ' ', el('span', 'text-gray-400', '@' + message.author.username));
+            item.append(row, name);
+        }
+        list.appendChild(item);
+        if (typeof scrollToBottom === 'function') scrollToBottom(100);
+    }
+
+    function renderPresence(frame) {
+        const count = document.getElementById('online-count');
+        if (count) count.textContent = frame.count;
+        setDot(document.getElementById('online-icon'), frame.count > 0, 'gray-dot');
+        frame.online.forEach(function (id) { setDot(document.getElementById('user-' + id), true, 'gray-dot'); });
+        frame.offline.forEach(function (id) { setDot(document.getElementById('user-' + id), false, 'gray-dot'); });
+    }
+
+    function renderContacts(count) {
+        const target = document.getElementById('online-user-count');
+        if (!target) return;
+        target.replaceChildren();
+        if (count) target.appendChild(el('span', 'bg-red-500 rounded-lg py-1 px-3 text-white text-sm ml-4 inline-block', count + ' online'));
+    }
+
+    function renderChatsIndicator() {
+        const target = document.getElementById('online_in_chats');
+        if (!target) return;
+        target.replaceChildren();
+        if (onlineRooms.size) target.appendChild(el('div', 'green-dot absolute top-2 right-2 z-20'));
+    }
+
+    function renderRoom(room, online) {
+        if (online) onlineRooms.add(room); else onlineRooms.delete(room);
+        setDot(document.getElementById('chat-dot-' + room), online, 'graylight-dot');
+        renderChatsIndicator();
+    }
+
+    // same markup as a_rtchat/partials/online_status.html
+    function renderChats(frame) {
+        const list = document.getElementById('chats-list');
+        if (!list) return;
+        list.className = 'hoverlist [&>li>a]:justify-end';
+        list.replaceChildren();
+        onlineRooms.clear();
+
+        const rooms = [{room: 'public-chat', name: 'Public Chat', online: frame.public_chat_online, url: '/'}].concat(frame.chats);
+        rooms.forEach(function (chat) {
+            const item = el('li', 'relative');
+            const dot = el('div', 'absolute top-1 left-1');
+            dot.id = 'chat-dot-' + chat.room;
+            item.appendChild(dot);
+            const link = el('a', 'leading-5 flex flex-col items-end');
+            link.href = chat.url || '/chat/room/' + encodeURIComponent(chat.room);
+            const name = el('span', '', chat.name.slice(0, 30));
+            if (chat.unread) name.append(' ', el('span', 'text-sm text-gray-400', chat.unread));
+            link.appendChild(name);
+            if (chat.preview) {
+                link.title = chat.preview;
+                link.appendChild(el('span', 'text-xs text-gray-400 truncate max-w-full', chat.preview));
+            }
+            item.appendChild(link);
+            list.appendChild(item);
+            renderRoom(chat.room, chat.online);
+        });
+        renderContacts(frame.online_count);
+    }
+
+    // same markup as a_rtchat/partials/notification_item.html
+    function unreadItem(chat) {
+        const item = el('li', 'relative');
+        item.id = 'notis-' + chat.id;
+        item.appendChild(el('span', 'blue-dot absolute top-1 left-1'));
+        const link = el('a', '', chat.name + ' ');
+        link.href = '/chat/room/' + encodeURIComponent(chat.room);
+        link.appendChild(el('span', 'text-sm text-gray-400', chat.unread));
+        item.appendChild(link);
+        return item;
+    }
+
+    function renderUnreadState() {
+        const list = document.getElementById('notis-list');
+        const entries = list.querySelectorAll('li[id^="notis-"]:not(#notis-empty)').length;
+        let empty = document.getElementById('notis-empty');
+        if (!empty) {
+            empty = el('li', 'relative');
+            empty.id = 'notis-empty';
+            empty.appendChild(el('span', '', 'No new notifications.'));
+            list.appendChild(empty);
+        }
+        empty.classList.toggle('hidden', entries > 0);
+
+        const badge = document.getElementById('notis_in_chats');
+        badge.replaceChildren();
+        if (entries) badge.appendChild(el('div', 'blue-dot absolute top-2 right-2 z-20'));
+    }
+
+    function renderUnread(frame) {
+        const list = document.getElementById('notis-list');
+        if (!list) return;
+        list.replaceChildren();
+        frame.chats.forEach(function (chat) { list.appendChild(unreadItem(chat)); });
+        renderUnreadState();
+    }
+
+    function renderUnreadDelta(frame) {
+        const list = document.getElementById('notis-list');
+        if (!list) return;
+        frame.changed.forEach(function (chat) {
+            const existing = document.getElementById('notis-' + chat.id);
+            if (existing) existing.replaceWith(unreadItem(chat));
+            else list.prepend(unreadItem(chat));
+        });
+        frame.read.forEach(function (id) {
+            const existing = document.getElementById('notis-' + id);
+            if (existing) existing.remove();
+        });
+        renderUnreadState();
+    }
+
+    function renderRateLimited(frame) {
+        const input = document.querySelector('#chat_message_form input[name="body"]');
+        if (!input) return;
+        input.placeholder = 'Slow down, try again in a moment ...';
+        setTimeout(function () { input.placeholder = 'Add message ...'; }, frame.retry_after * 1000);
+    }
+
+    const renderers = {
+        'message.new': renderMessage,
+        'presence.delta': renderPresence,
+        'presence.contacts': function (frame) { renderContacts(frame.count); },
+        'presence.room': function (frame) { renderRoom(frame.room, frame.online); },
+        'chats': renderChats,
+        'unread': renderUnread,
+        'unread.delta': renderUnreadDelta,
+        'rate_limited': renderRateLimited,
+        'reload': function () { location.reload(); },
+        'persisted': function (frame) {
+            const list = document.getElementById('chat_messages');
+            if (list) list.dataset.lastSeq = Math.max(parseInt(list.dataset.lastSeq || '0', 10), frame.last_seq);
+        },
+        'ban': function (frame) {
+            if (frame.banned) {
+                alert('You have been banned from this chat.');
+                window.location.href = '/';
+            } else {
+                alert('You have been unbanned! You can rejoin.');
+                location.reload();
+            }
+        },
+    };
+
+    // frames that were queued together on the server
+    renderers.batch = function (frame) {
+        frame.frames.forEach(function (inner) {
+            if (renderers[inner.type]) renderers[inner.type](inner);
+        });
+    };
+
+    document.body.addEventListener('htmx:wsBeforeMessage', function (event) {
+        if (!event.detail.message.startsWith('{')) return;
+        const frame = JSON.parse(event.detail.message);
+        if (frame.v !== VERSION || !renderers[frame.type]) return;
+        event.preventDefault();
+        renderers[frame.type](frame);
+    });
+})();